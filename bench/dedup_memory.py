@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# This file is part of tcollector.
+# Copyright (C) 2013  The tcollector Authors.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser
+# General Public License for more details.  You should have received a copy
+# of the GNU Lesser General Public License along with this program.  If not,
+# see <http://www.gnu.org/licenses/>.
+"""Measures how much memory the dedup cache takes, with the dict of tuples
+   holding the raw line it used to be and with DedupCache.
+
+   Usage: bench/dedup_memory.py [series...]
+
+   Every measurement runs in a process of its own so that they don't share
+   their peak RSS.  The RSS also covers what it took to parse the lines,
+   e.g. the parse caches of parse_line(), so the size of the objects the
+   dedup cache is made of is printed as well."""
+
+import gc
+import os
+import re
+import resource
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import tcollector
+
+LINE = ('proc.net.tcp 1500000000 %d host=web%d state=established'
+        ' endpoint=foo.example.com')
+
+
+def fill_old(count):
+    """Fills the cache the way process_line() used to."""
+    values = {}
+    for i in xrange(count):
+        line = LINE % (i, i)
+        parsed = re.match('^([-_./a-zA-Z0-9]+)\s+' # Metric name.
+                          '(\d+)\s+'               # Timestamp.
+                          '(\S+?)'                 # Value (int or float).
+                          '((?:\s+[-_./a-zA-Z0-9]+=[-_./a-zA-Z0-9]+)*)$', # Tags
+                          line)
+        metric, timestamp, value, tags = parsed.groups()
+        values[(metric, tags)] = (value, False, line, int(timestamp))
+    return values, None
+
+
+def fill_new(count):
+    """Fills the cache of a collector through the ReaderThread."""
+    reader = tcollector.ReaderThread(300, 6000)
+    col = tcollector.Collector('bench', 0, 'bench')
+    for i in xrange(count):
+        reader.process_line(col, LINE % (i, i))
+        if len(reader.pending) >= 1000:
+            reader.pending = []
+    reader.pending = []
+    return col.values, col.values_size()
+
+
+def walk_size(values):
+    """Returns the number of bytes taken by the objects `values' is made of,
+       counting shared objects once."""
+    seen = set()
+    size = 0
+    todo = [values]
+    while todo:
+        obj = todo.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            todo.extend(obj.iterkeys())
+            todo.extend(obj.itervalues())
+        elif isinstance(obj, (tuple, list)):
+            todo.extend(obj)
+        elif isinstance(obj, tcollector.DedupEntry):
+            todo.extend((obj.value, obj.timestamp, obj.last_timestamp))
+        if isinstance(obj, tcollector.DedupCache):
+            todo.append(obj.wheel)
+    return size
+
+
+def measure(name, count):
+    """Prints the RSS growth of filling the cache, and its dedup.bytes."""
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    values, size = {'old': fill_old, 'new': fill_new}[name](count)
+    gc.collect()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+    assert len(values) == count, (len(values), count)
+    print '%-4s %8d series  %7.1f MB RSS  %7.1f MB objects  %s' % (
+        name, count, rss / 1024.0, walk_size(values) / 1024.0 / 1024,
+        'dedup.bytes %.1f MB' % (size / 1024.0 / 1024) if size else '')
+
+
+def main(argv):
+    if len(argv) == 3 and argv[1] in ('old', 'new'):
+        measure(argv[1], int(argv[2]))
+        return
+    for count in argv[1:] or (100000, 1000000):
+        for name in ('old', 'new'):
+            subprocess.check_call([sys.executable, __file__, name,
+                                   str(count)])
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# This file is part of tcollector.
+# Copyright (C) 2013  The tcollector Authors.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser
+# General Public License for more details.  You should have received a copy
+# of the GNU Lesser General Public License along with this program.  If not,
+# see <http://www.gnu.org/licenses/>.
+"""Measures how many lines per second parse_line() parses, compared with
+   the regular expression ReaderThread.process_line() used to match every
+   line against.
+
+   Usage: bench/parse_line.py [lines]"""
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import tcollector
+
+
+def old_parse_line(line):
+    """What process_line() used to do to every line."""
+    parsed = re.match('^([-_./a-zA-Z0-9]+)\s+' # Metric name.
+                      '(\d+)\s+'               # Timestamp.
+                      '(\S+?)'                 # Value (int or float).
+                      '((?:\s+[-_./a-zA-Z0-9]+=[-_./a-zA-Z0-9]+)*)$', # Tags
+                      line)
+    if parsed is None:
+        return None
+    metric, timestamp, value, tags = parsed.groups()
+    return metric, int(timestamp), value, tags
+
+
+def workloads(count):
+    """Returns a list of (name, lines) to parse."""
+    return [
+        # What collectors print all day long: the same few thousand time
+        # series over and over again.
+        ('valid', ['proc.net.tcp %d %d user=root endpoint=ns state=%d'
+                   % (1500000000 + i, i, i % 2000) for i in xrange(count)]),
+        # A host with a hundred thousand time series.
+        ('100k', ['proc.net.tcp %d %d user=root endpoint=ns state=%d'
+                  % (1500000000 + i, i, i % 100000) for i in xrange(count)]),
+        # As many different time series as lines, nothing is cached.
+        ('unique', ['proc.net.tcp %d %d user=root endpoint=ns state=%d'
+                    % (1500000000 + i, i, i) for i in xrange(count)]),
+        ('no tags', ['proc.loadavg.1min %d 0.%d' % (1500000000 + i, i)
+                     for i in xrange(count)]),
+        # Valid, but oddly spaced.
+        ('edge', ['proc.net.tcp  %d\t%d  user=root   state=%d'
+                  % (1500000000 + i, i, i % 2000) for i in xrange(count)]),
+        ('invalid', ['proc.net.tcp %d %d user=root state=%d bad=tag='
+                     % (1500000000 + i, i, i % 2000)
+                     for i in xrange(count)]),
+    ]
+
+
+def rate(parse, lines, runs=3):
+    """Returns how many of `lines' `parse' parses per second, at best over
+       `runs' runs starting with empty caches."""
+    best = None
+    for _ in xrange(runs):
+        tcollector.METRICS_CACHE.reset()
+        tcollector.TAGS_CACHE.reset()
+        start = time.time()
+        for line in lines:
+            parse(line)
+        elapsed = time.time() - start
+        best = min(best or elapsed, elapsed)
+    return len(lines) / best
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 500000
+    print '%-8s %12s %12s %8s' % ('', 'regex', 'parse_line', 'speedup')
+    for name, lines in workloads(count):
+        old = rate(old_parse_line, lines)
+        new = rate(tcollector.parse_line, lines)
+        print '%-8s %10d/s %10d/s %7.1fx' % (name, old, new, new / old)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
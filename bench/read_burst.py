@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# This file is part of tcollector.
+# Copyright (C) 2013  The tcollector Authors.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser
+# General Public License for more details.  You should have received a copy
+# of the GNU Lesser General Public License along with this program.  If not,
+# see <http://www.gnu.org/licenses/>.
+"""Measures how fast a burst of output is split into lines, with the string
+   buffer Collector.read() used to slice one line at a time and with the
+   preallocated bytearray it uses now.
+
+   Usage: bench/read_burst.py [megabytes] [pipe buffer size]
+
+   The burst is written to a pipe by another thread, the way a collector
+   dumping its output at once would, and we read it until we got it all."""
+
+import errno
+import os
+import select
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import tcollector
+
+LINE = 'proc.net.tcp 1500000000 %d user=root endpoint=ns state=established\n'
+
+
+class OldCollector(tcollector.Collector):
+    """Collector.read() and collect() as they used to be."""
+
+    def read(self):
+        if not self.buffer:
+            self.buffer = ''
+        try:
+            self.buffer += self.proc.stdout.read()
+        except IOError, (err, msg):
+            if err != errno.EAGAIN:
+                raise
+        while self.buffer:
+            idx = self.buffer.find('\n')
+            if idx == -1:
+                break
+            line = self.buffer[0:idx].strip()
+            if line:
+                self.datalines.append(line)
+                self.last_datapoint = int(time.time())
+            self.buffer = self.buffer[idx+1:]
+
+    def collect(self):
+        self.datalines = list(self.datalines)
+        while self.proc is not None:
+            self.read()
+            if not len(self.datalines):
+                return
+            while len(self.datalines):
+                yield self.datalines.pop(0)
+
+
+class Proc(object):
+    """Stands for a collector process writing `data' to its stdout."""
+
+    def __init__(self, data, pipe_size):
+        out_r, self.out_w = os.pipe()
+        err_r, self.err_w = os.pipe()
+        if pipe_size:
+            tcollector.set_pipe_size(out_r, pipe_size)
+        self.stdout = os.fdopen(out_r)
+        self.stderr = os.fdopen(err_r)
+        tcollector.set_nonblocking(out_r)
+        tcollector.set_nonblocking(err_r)
+        self.writer = threading.Thread(target=self.write, args=(data,))
+        self.writer.start()
+
+    def write(self, data):
+        view = buffer(data)
+        while view:
+            view = view[os.write(self.out_w, view):]
+
+    def close(self):
+        self.writer.join()
+        for f in (self.stdout, self.stderr):
+            f.close()
+        for fd in (self.out_w, self.err_w):
+            os.close(fd)
+
+
+def measure(cls, data, count, pipe_size):
+    """Returns how many seconds it took `cls' to read the `count' lines of
+       `data'."""
+    col = cls('bench', 0, 'bench')
+    start = time.time()
+    col.proc = Proc(data, pipe_size)
+    received = 0
+    while received < count:
+        select.select([col.proc.stdout], [], [])
+        for line in col.collect():
+            received += 1
+    elapsed = time.time() - start
+    col.proc.close()
+    return elapsed
+
+
+def main(argv):
+    megabytes = float(argv[1]) if len(argv) > 1 else 10
+    pipe_size = int(argv[2]) if len(argv) > 2 else 0
+    lines = []
+    size = 0
+    while size < megabytes * 1024 * 1024:
+        lines.append(LINE % len(lines))
+        size += len(lines[-1])
+    data = ''.join(lines)
+    print '%.1f MB, %d lines' % (len(data) / 1024.0 / 1024, len(lines))
+    for name, cls in (('str slices', OldCollector),
+                      ('bytearray', tcollector.Collector)):
+        elapsed = measure(cls, data, len(lines), pipe_size)
+        print '%-10s %7.3fs  %9d lines/s' % (name, elapsed,
+                                              len(lines) / elapsed)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# This file is part of tcollector.
+# Copyright (C) 2013  The tcollector Authors.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser
+# General Public License for more details.  You should have received a copy
+# of the GNU Lesser General Public License along with this program.  If not,
+# see <http://www.gnu.org/licenses/>.
+"""Measures how long datapoints take to go from collectors to the reader
+   queue, with the reader polling every collector once a second (the way it
+   used to) and with it waiting on epoll.
+
+   Usage: bench/reader_latency.py [collectors] [seconds]
+
+   Every collector prints its current time as the value of a datapoint at
+   random intervals, and we compare that with when the datapoint shows up
+   in the reader queue."""
+
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import tcollector
+
+COLLECTOR = """#!%s
+import random
+import sys
+import time
+ts = 1500000000
+while True:
+    time.sleep(random.uniform(0.05, 0.5))
+    ts += 1
+    print 'bench.latency %%d %%.6f' %% (ts, time.time())
+    sys.stdout.flush()
+""" % sys.executable
+
+
+class Options(object):
+    in_process = ()
+    pipe_buffer_size = 0
+
+
+def measure(poller, count, duration):
+    """Returns the sorted latencies in seconds of what `count' collectors
+       printed over `duration' seconds."""
+    tcollector.POLLER = poller
+    tcollector.ALIVE = True
+    tmpdir = tempfile.mkdtemp()
+    collectors = []
+    reader = tcollector.ReaderThread(0, 1)
+    try:
+        for i in xrange(count):
+            filename = os.path.join(tmpdir, 'bench%d' % i)
+            f = open(filename, 'w')
+            f.write(COLLECTOR)
+            f.close()
+            os.chmod(filename, stat.S_IRWXU)
+            col = tcollector.Collector('bench%d' % i, 0, filename)
+            tcollector.register_collector(col)
+            tcollector.spawn_collector(col, Options())
+            collectors.append(col)
+        reader.start()
+        start = time.time()
+        latencies = []
+        while time.time() < start + duration:
+            dps = reader.readerq.get_batch(0.1)
+            now = time.time()
+            # Leave out what was printed before we started reading.
+            latencies.extend(now - float(dp.value) for dp in dps
+                             if float(dp.value) >= start)
+    finally:
+        tcollector.ALIVE = False
+        if reader.isAlive():
+            reader.join()
+        for col in collectors:
+            col.shutdown()
+            del tcollector.COLLECTORS[col.name]
+        shutil.rmtree(tmpdir)
+    latencies.sort()
+    return latencies
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 50
+    duration = float(argv[2]) if len(argv) > 2 else 20
+    for name, poller in (('sleep loop', None),
+                         ('epoll', tcollector.CollectorPoller())):
+        latencies = measure(poller, count, duration)
+        print '%-10s %6d datapoints  median %6.1fms  p99 %6.1fms' % (
+            name, len(latencies),
+            latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
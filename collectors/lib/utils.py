@@ -19,6 +19,7 @@ import stat
 import pwd
 import errno
 import sys
+import threading
 
 # If we're running as root and this user exists, we'll drop privileges.
 USER = "nobody"
@@ -33,6 +34,11 @@ def drop_privileges(user=USER):
 
     if os.getuid() != 0:
         return
+    if threading.current_thread().name != 'MainThread':
+        # We're run in-process by tcollector, whose privileges these are.
+        err("warning: running in-process as root, can't drop privileges"
+            " to %s" % user)
+        return
 
     os.setgid(ent.pw_gid)
     os.setuid(ent.pw_uid)
@@ -21,27 +21,50 @@
 #
 
 import atexit
+import bisect
+import ctypes
+import ctypes.util
 import errno
 import fcntl
+import gzip
+import hashlib
+import heapq
+import httplib
+import imp
+import io
+import json
 import logging
 import os
 import random
 import re
+import resource
+import runpy
+import select
+import shutil
 import signal
 import socket
+import struct
 import subprocess
 import sys
+import tempfile
+import termios
 import threading
 import time
+import traceback
+import zlib
+from collections import deque
 from logging.handlers import RotatingFileHandler
-from Queue import Queue
-from Queue import Empty
-from Queue import Full
 from optparse import OptionParser
 
 
 # global variables.
 COLLECTORS = {}
+# Maps the name of a collector to its DedupCache.  This is kept apart from
+# the Collector objects, which get replaced whenever a collector is
+# respawned, so that the dedup state of a collector survives from one run
+# to the next.  It's bounded by the eviction of old entries and by
+# --dedup-max-series, like the caches themselves.
+DEDUP_CACHES = {}
 GENERATION = 0
 DEFAULT_LOG = '/var/log/tcollector.log'
 LOG = logging.getLogger('tcollector')
@@ -57,12 +80,110 @@ MAX_REASONABLE_TIMESTAMP = 1600000000  # Good until September 2020 :)
 ALLOWED_INACTIVITY_TIME = 600  # seconds
 MAX_SENDQ_SIZE = 10000
 MAX_READQ_SIZE = 100000
+# Weight of the new value in the moving averages of the TSDHealth.
+EWMA_WEIGHT = 0.3
+# How long the circuit breaker of a TSD stays open after a failure, at first
+# and at most, in seconds.
+BREAKER_MIN_DELAY = 10
+BREAKER_MAX_DELAY = 600
+# The latency of the TSDs we don't know anything about yet, the least latency
+# we consider, and how much the error rate of a TSD inflates its latency when
+# choosing one.
+DEFAULT_TSD_LATENCY = 0.1
+MIN_TSD_LATENCY = 0.001
+ERROR_RATE_PENALTY = 10
+# How many times slower than another TSD the current one has to be for us to
+# switch.
+SLOW_TSD_FACTOR = 3
+# How long to wait for a connection to a TSD, and how long to wait for one
+# before also trying the next address in parallel.
+CONNECT_TIMEOUT = 15
+CONNECT_RACE_DELAY = 0.25
+# How often to check the connection to the TSD, probing it if it has been idle
+# meanwhile, and how often to report our own stats, in seconds.
+VERIFY_INTERVAL = 60
+STATS_INTERVAL = 60
+# How many points each TSD gets on the HashRing in --shard mode.
+HASH_RING_REPLICAS = 160
+# How long to use the addresses of a TSD before resolving its name again, and
+# how long to remember that it doesn't resolve, in seconds.
+DEFAULT_DNS_TTL = 300
+DEFAULT_DNS_NEGATIVE_TTL = 10
+# Default maximum size of the batches of data points we send to the TSD.
+MAX_BATCH_BYTES = 1024 * 1024
+# How many lines to write to the TSD at once.
+SEND_CHUNK_LINES = 1024
+# The ioctl giving how much data sent on a socket wasn't acknowledged yet.
+SIOCOUTQ = getattr(termios, 'TIOCOUTQ', None)
+# Width, in seconds, of the buckets in which the dedup cache files its entries
+# by the time they were last seen, and how many entries the ReaderThread may
+# look at per iteration to evict the old ones.
+EVICT_BUCKET_WIDTH = 60
+EVICT_BATCH_SIZE = 10000
+# Initial size of the buffer we read the output of a collector into.  It
+# grows if a collector ever writes a line longer than that.
+READ_BUFFER_SIZE = 65536
+# Maximum size of a segment file of the DiskSpool, before we start a new one.
+SPOOL_SEGMENT_SIZE = 16 * 1024 * 1024
+# Linux-specific fcntl(2) command to resize a pipe (since 2.6.35).
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+# How long to wait for an in-process collector to exit once killed.
+THREAD_KILL_TIMEOUT = 5
+# The modules the fork server imports once and for all, so that the Python
+# collectors it spawns don't have to, and how long to wait for it to spawn
+# one, in seconds.
+FORK_SERVER_MODULES = ('collectors.lib.utils', 'errno', 'httplib', 'json',
+                       'os', 're', 'socket', 'subprocess', 'sys', 'time',
+                       'urllib2')
+FORK_SERVER_TIMEOUT = 5
+# How often to look for new, changed or removed collectors, when inotify(7)
+# tells us about them as they happen and when it doesn't, in seconds.
+FULL_SCAN_INTERVAL = 600
+SCAN_INTERVAL = 15
+# The inotify(7) events we care about, from <sys/inotify.h>.
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x80000
+IN_NONBLOCK = 0x800
+INOTIFY_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+                | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+                | IN_ONLYDIR)
+# Characters allowed in metric names, tag names and tag values.
+VALID_CHARS = ('-_./abcdefghijklmnopqrstuvwxyz'
+               'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')
+# The characters that can go in a JSON string as they are.
+JSON_PLAIN_CHARS = ''.join(chr(c) for c in xrange(0x20, 0x7f)
+                           if chr(c) not in '"\\')
+# How many metric names, tags sections, etc. a ParseCache remembers in each
+# of its generations.
+MAX_PARSE_CACHE_SIZE = 100000
+# The CollectorPoller used by the ReaderThread to wait for output on the
+# pipes of our collectors.  None if we have to fall back to polling them
+# every second (no epoll or stdin mode).
+POLLER = None
+# The ForkServer spawning the Python interval collectors, if any.
+FORK_SERVER = None
 
 
 def register_collector(collector):
-    """Register a collector with the COLLECTORS global"""
+    """Register a collector with the COLLECTORS global, and hook it to the
+       dedup state of any previous collector with the same name."""
 
     assert isinstance(collector, Collector), "collector=%r" % (collector,)
+    if collector.name in DEDUP_CACHES:
+        collector.values = DEDUP_CACHES[collector.name]
+    else:
+        DEDUP_CACHES[collector.name] = collector.values
     # store it in the global list and initiate a kill for anybody with the
     # same name that happens to still be hanging around
     if collector.name in COLLECTORS:
@@ -75,18 +196,514 @@ def register_collector(collector):
     COLLECTORS[collector.name] = collector
 
 
-class ReaderQueue(Queue):
-    """A Queue for the reader thread"""
+class ParseCache(dict):
+    """Remembers what we already parsed or formatted for the time series we
+       keep seeing, so the hot paths are a single dict lookup.
+
+       The cache holds at most `max_size' entries per generation.  Once it's
+       full, its entries become the previous generation and it starts over
+       empty.  Entries of the previous generation found with get_old() are
+       carried over, the others go away with their generation, so the time
+       series we still see stay cached whatever their number."""
+
+    def __init__(self, max_size):
+        super(ParseCache, self).__init__()
+        self.max_size = max_size
+        self.old = {}
+
+    def add(self, key, value):
+        """Caches the given value and returns it."""
+        if len(self) >= self.max_size:
+            self.old = dict(self)
+            self.clear()
+        self[key] = value
+        return value
+
+    def get_old(self, key):
+        """Returns the value the previous generation has for the given key,
+           moving it to the current generation, or None."""
+        value = self.old.pop(key, None)
+        if value is not None:
+            self.add(key, value)
+        return value
+
+    def reset(self):
+        """Forgets everything."""
+        self.clear()
+        self.old = {}
+
+
+# The metric names that parse_line() has already validated, mapped to their
+# interned version, and the tags sections it has already validated mapped to
+# their normalized and interned version.  This way all the datapoints (and
+# the dedup cache entries) of a time series share the same strings.
+METRICS_CACHE = ParseCache(MAX_PARSE_CACHE_SIZE)
+TAGS_CACHE = ParseCache(MAX_PARSE_CACHE_SIZE)
+
+
+def parse_metric(metric):
+    """Validates a metric name.
+
+    Returns: the interned metric name, or None if it's invalid.
+    """
+    interned = METRICS_CACHE.get_old(metric)
+    if interned is not None:
+        return interned
+    if metric.translate(None, VALID_CHARS):
+        return None
+    return METRICS_CACHE.add(metric, intern(metric))
+
+
+def format_tags(tags):
+    """Formats a tags section the way the TSD expects it, preceded by a
+       space."""
+    if not tags:
+        return ''
+    return ' ' + tags
+
+
+def format_json(line):
+    """Formats a line, as sent with a `put' command, into the JSON object the
+       TSD's /api/put expects.  Returns None if the line isn't valid UTF-8
+       and can't be sent that way."""
+    fields = line.split()
+    tags = [tag.split('=', 1) for tag in fields[3:]]
+    if line.translate(None, JSON_PLAIN_CHARS):
+        try:
+            return json.dumps({'metric': fields[0],
+                               'timestamp': int(fields[1]),
+                               'value': fields[2], 'tags': dict(tags)})
+        except UnicodeDecodeError:
+            return None
+    # Fast path, nothing needs to be escaped.
+    return ('{"metric":"%s","timestamp":%s,"value":"%s","tags":{%s}}'
+            % (fields[0], fields[1], fields[2],
+               ','.join(['"%s":"%s"' % (k, v) for k, v in tags])))
+
+
+def dedup_value(value):
+    """Returns what to compare the given value against to detect duplicates,
+       so that e.g. "1", "1.0" and "1e0" are considered the same value."""
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            value = float(value)
+        except ValueError:
+            return value
+        if value != value:  # NaN isn't equal to itself
+            return 'nan'
+        return value
+
+
+class Datapoint(object):
+    """A datapoint, as read from a collector.
+
+       The tags are the name=value tags the collector printed, sorted so
+       that their order doesn't matter, separated by single spaces and
+       interned, or an empty string.  The value is kept as
+       the string the collector printed.  A datapoint is
+       only formatted back into a line when we send it to the TSD.  The
+       collector is the name of the collector it came from, if any."""
+
+    __slots__ = ('metric', 'timestamp', 'value', 'tags', 'collector')
+
+    def __init__(self, metric, timestamp, value, tags='', collector=None):
+        self.metric = metric
+        self.timestamp = timestamp
+        self.value = value
+        self.tags = tags
+        self.collector = collector
+
+    def __str__(self):
+        return '%s %d %s%s' % (self.metric, self.timestamp, self.value,
+                               format_tags(self.tags))
+
+    def __repr__(self):
+        return 'Datapoint(%r)' % str(self)
+
+
+def valid_tags(tags):
+    """Returns whether the given string is made of name=value tags separated
+       by single spaces."""
+    # Deleting all the valid characters from the tags must leave exactly one
+    # '=' per tag, and each '=' must have something on both sides.
+    return (tags.translate(None, VALID_CHARS) == '= ' * tags.count(' ') + '='
+            and tags[0] != '=' and tags[-1] != '='
+            and ' =' not in tags and '= ' not in tags)
+
+
+def parse_tags(tags):
+    """Validates a string of whitespace-separated name=value tags.
+
+    Returns: the tags sorted, separated by single spaces and interned, or
+      None if they're invalid.
+    """
+    normalized = TAGS_CACHE.get_old(tags)
+    if normalized is not None:
+        return normalized
+    normalized = tags
+    if not valid_tags(tags):
+        normalized = ' '.join(tags.split())
+        if normalized == tags or not valid_tags(normalized):
+            return None
+    # So that the order in which the collector prints them doesn't matter.
+    # They're usually printed in the same order, sorted or not.
+    split = normalized.split(' ')
+    if len(split) > 1:
+        split.sort()
+        normalized = ' '.join(split)
+    return TAGS_CACHE.add(tags, intern(normalized))
+
+
+def parse_line(line):
+    """Parses a line in the format collectors print datapoints in:
+       "<metric> <timestamp> <value> [<name>=<value> ...]", where the metric
+       and the tags are made of VALID_CHARS and the timestamp of digits.
+
+    Returns: a Datapoint, or None if the line is invalid.
+    """
+    # Collectors print the same metrics and tags over and over again, so
+    # we only validate them the first time we see them.
+    fields = line.split(None, 3)
+    if len(fields) < 3 or not fields[1].isdigit():
+        return None
+    metric = METRICS_CACHE.get(fields[0]) or parse_metric(fields[0])
+    if metric is None:
+        return None
+    if len(fields) == 3:
+        return Datapoint(metric, int(fields[1]), fields[2])
+    tags = TAGS_CACHE.get(fields[3]) or parse_tags(fields[3])
+    if tags is None:
+        return None
+    return Datapoint(metric, int(fields[1]), fields[2], tags)
+
+
+class ReaderQueue(object):
+    """The queue between the reader thread and the sender thread.
+
+       The reader hands over whole batches of lines (typically everything it
+       just read from one collector) and the sender takes everything that's
+       pending at once, so we only pay one lock round-trip per batch instead
+       of one per line.  The capacity is still expressed in lines."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.batches = deque()
+        self.size = 0  # Number of lines currently queued.
+        self.cond = threading.Condition(threading.Lock())
+
+    def qsize(self):
+        return self.size
 
     def nput(self, value):
         """A nonblocking put, that simply logs and discards the value when the
            queue is full, and returns false if we dropped."""
+        return not self.nput_batch([value])
+
+    def nput_batch(self, values):
+        """A nonblocking put of a list of values.  Whatever doesn't fit in
+           the queue is logged and discarded.  Returns how many values were
+           dropped."""
+        dropped = ()
+        self.cond.acquire()
         try:
-            self.put(value, False)
-        except Full:
+            room = self.maxsize - self.size
+            if len(values) > room:
+                dropped = values[max(room, 0):]
+                values = values[:max(room, 0)]
+            if values:
+                self.batches.append(values)
+                self.size += len(values)
+                self.cond.notify()
+        finally:
+            self.cond.release()
+        for value in dropped:
             LOG.error("DROPPED LINE: %s", value)
-            return False
-        return True
+        return len(dropped)
+
+    def get_batch(self, timeout, max_values=None):
+        """Returns a list of all the values queued, waiting up to `timeout'
+           seconds for some to show up.  If `max_values' is given, at most
+           that many values are returned, the rest stays in the queue.
+           Returns an empty list if nothing showed up in time."""
+        self.cond.acquire()
+        try:
+            if not self.size and timeout > 0:
+                deadline = time.time() + timeout
+                while not self.size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+            if max_values is None or max_values >= self.size:
+                values = [value for batch in self.batches for value in batch]
+                self.batches.clear()
+            else:
+                values = []
+                while len(values) < max_values:
+                    batch = self.batches.popleft()
+                    room = max_values - len(values)
+                    if len(batch) > room:
+                        self.batches.appendleft(batch[room:])
+                        batch = batch[:room]
+                    values.extend(batch)
+            self.size -= len(values)
+            return values
+        finally:
+            self.cond.release()
+
+
+class CollectorPoller(object):
+    """Waits for output from collectors using epoll(7).
+
+       The stdout and stderr pipes of every collector are registered when
+       the collector is spawned and unregistered when it's reaped, so the
+       ReaderThread only wakes up when there is actually something to read
+       instead of walking every collector once a second."""
+
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.fds = {}  # Maps a file descriptor to its Collector.
+
+    def register(self, col):
+        """Starts watching the pipes of the given collector."""
+        for pipe in (col.proc.stdout, col.proc.stderr):
+            fd = pipe.fileno()
+            self.fds[fd] = col
+            try:
+                self.epoll.register(fd, select.EPOLLIN)
+            except IOError, e:
+                # The fd number was recycled before we noticed the old one
+                # went away.
+                if e.errno != errno.EEXIST:
+                    raise
+                self.epoll.modify(fd, select.EPOLLIN)
+
+    def unregister(self, col):
+        """Stops watching the pipes of the given collector."""
+        for fd, owner in self.fds.items():
+            if owner is col:
+                self.unregister_fd(fd, col)
+
+    def unregister_fd(self, fd, col):
+        """Stops watching the given pipe of the given collector, unless the
+           fd number has been handed over to another collector since."""
+        if self.fds.get(fd) is not col:
+            return
+        del self.fds[fd]
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, ValueError):
+            pass  # Already closed, the kernel dropped it for us.
+
+    def poll(self, timeout):
+        """Waits up to `timeout' seconds for collectors to have output.
+
+        Returns: a tuple (collectors, hungup) where `collectors' is a list of
+          the collectors that have something to read and `hungup' is a list
+          of (fd, collector) pairs whose writing end was closed.  Those must
+          be unregistered once drained or epoll will keep reporting them.
+        """
+        try:
+            events = self.epoll.poll(timeout)
+        except IOError, e:
+            if e.errno != errno.EINTR:
+                raise
+            return [], []
+        collectors = []
+        hungup = []
+        for fd, event in events:
+            col = self.fds.get(fd)
+            if col is None:
+                continue
+            if col not in collectors:
+                collectors.append(col)
+            if event & (select.EPOLLHUP | select.EPOLLERR):
+                hungup.append((fd, col))
+        return collectors, hungup
+
+
+class Inotify(object):
+    """Tells about changes to directories using inotify(7), through ctypes.
+       Raises an OSError if inotify isn't available."""
+
+    EVENT = struct.Struct('iIII')  # wd, mask, cookie, len of the name.
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not supported')
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.paths = {}  # Maps a watch descriptor to its directory.
+
+    def watch(self, path):
+        """Starts watching the given directory, if we aren't already."""
+        wd = self.libc.inotify_add_watch(self.fd, path, INOTIFY_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        self.paths[wd] = path
+
+    def read(self, timeout):
+        """Waits up to `timeout' seconds for something to change.
+
+        Returns: a list of (directory, name, mask) events.  The name is empty
+          for events about the directory itself.  A mask of IN_Q_OVERFLOW
+          means some events were lost.
+        """
+        try:
+            if not select.select([self.fd], [], [], timeout)[0]:
+                return []
+            data = os.read(self.fd, 65536)
+        except (OSError, select.error), e:
+            if e[0] not in (errno.EINTR, errno.EAGAIN):
+                raise
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            path = self.paths.get(wd)
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)  # The watch is gone.
+            if path is not None or mask & IN_Q_OVERFLOW:
+                events.append((path, name, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DedupEntry(object):
+    """What we remember about a time series to detect duplicate values.
+
+       The key of the entry already holds the metric and tags, so the last
+       datapoint of the series can be rebuilt from them when it needs to be
+       replayed, instead of being stored."""
+
+    __slots__ = ('value', 'timestamp', 'last_timestamp')
+
+    # Approximate size of an entry in the cache, with its key, to report
+    # the memory used by the cache without walking it.  The metric in the
+    # key is shared with other entries and not accounted for, the tags are
+    # accounted for by the DedupCache.
+    SIZE = None
+
+    def __init__(self, value, timestamp):
+        self.value = value  # Last value seen, as printed by the collector.
+        self.timestamp = timestamp  # When we first saw this value.
+        self.last_timestamp = timestamp  # When we last saw this value.
+
+    def repeated(self):
+        """Returns whether the value was seen more than once."""
+        return self.last_timestamp != self.timestamp
+
+
+DedupEntry.SIZE = (sys.getsizeof(DedupEntry('0', 0)) + sys.getsizeof(('', ''))
+                   + sys.getsizeof('1234567')
+                   + sys.getsizeof(1500000000)  # The timestamps, often one.
+                   + 8)  # 8: the reference in the timing wheel.
+
+
+class DedupCache(dict):
+    """Maps (metric, tags) to a DedupEntry.
+
+       Entries are also filed in a timing wheel, in buckets by the time at
+       which they were last seen, so that old entries can be evicted a few
+       at a time without scanning the whole cache.  Entries aren't moved
+       when they're seen again, instead they're filed again in the right
+       bucket when the one they're in expires.  Entries must only be added
+       with add() and removed with evict() or evict_lru()."""
+
+    def __init__(self):
+        super(DedupCache, self).__init__()
+        self.wheel = {}  # Maps a bucket number to a list of keys.
+        self.buckets = []  # Heap of the bucket numbers in self.wheel.
+        # How many entries were evicted to stay under --dedup-max-series.
+        self.lru_evictions = 0
+        # Bytes taken by the tags in the keys.  They're interned, so series
+        # with the same tags share them, but that's rare enough that we
+        # count them once per entry.
+        self.tags_size = 0
+
+    def add(self, key, entry):
+        if key not in self:
+            self.tags_size += sys.getsizeof(key[1])
+        self[key] = entry
+        self.file(key, entry.last_timestamp)
+
+    def remove(self, key):
+        del self[key]
+        self.tags_size -= sys.getsizeof(key[1])
+
+    def file(self, key, timestamp):
+        bucket = timestamp // EVICT_BUCKET_WIDTH
+        keys = self.wheel.get(bucket)
+        if keys is None:
+            keys = self.wheel[bucket] = []
+            heapq.heappush(self.buckets, bucket)
+        keys.append(key)
+
+    def evict(self, cut_off, limit):
+        """Removes the entries last seen before `cut_off', looking at no more
+           than `limit' entries.  Returns how many entries were looked at."""
+        work = 0
+        while self.buckets and work < limit:
+            bucket = self.buckets[0]
+            # Only look at buckets entirely before the cut off.
+            if (bucket + 1) * EVICT_BUCKET_WIDTH > cut_off:
+                break
+            keys = self.wheel[bucket]
+            while keys and work < limit:
+                key = keys.pop()
+                work += 1
+                entry = self.get(key)
+                if entry is None:
+                    continue
+                if entry.last_timestamp < cut_off:
+                    self.remove(key)
+                else:
+                    self.file(key, entry.last_timestamp)
+            if not keys:
+                heapq.heappop(self.buckets)
+                del self.wheel[bucket]
+        return work
+
+    def oldest(self):
+        """Returns the number of the oldest bucket, None if empty."""
+        if self.buckets:
+            return self.buckets[0]
+        return None
+
+    def evict_lru(self, count):
+        """Removes up to `count' of the least recently seen entries, all from
+           the oldest bucket.  Returns how many entries were removed."""
+        bucket = self.buckets[0]
+        keys = self.wheel[bucket]
+        evicted = 0
+        while keys and evicted < count:
+            key = keys.pop()
+            entry = self.get(key)
+            if entry is None:
+                continue
+            if entry.last_timestamp // EVICT_BUCKET_WIDTH <= bucket:
+                self.remove(key)
+                evicted += 1
+            else:
+                self.file(key, entry.last_timestamp)
+        if not keys:
+            heapq.heappop(self.buckets)
+            del self.wheel[bucket]
+        self.lru_evictions += evicted
+        return evicted
 
 
 class Collector(object):
@@ -96,6 +713,9 @@ class Collector(object):
        collector and gives us utility methods for working with
        it."""
 
+    # Whether collect() blocks until the collector is done.
+    blocking = False
+
     def __init__(self, colname, interval, filename, mtime=0, lastspawn=0):
         """Construct a new Collector."""
         self.name = colname
@@ -108,21 +728,22 @@ class Collector(object):
         self.dead = False
         self.mtime = mtime
         self.generation = GENERATION
-        self.buffer = ""
-        self.datalines = []
-        # Maps (metric, tags) to (value, repeated, line, timestamp) where:
-        #  value: Last value seen.
-        #  repeated: boolean, whether the last value was seen more than once.
-        #  line: The last line that was read from that collector.
-        #  timestamp: Time at which we saw the value for the first time.
+        # stdout is read into a preallocated buffer, of which only the first
+        # `buffered' bytes are valid.  Once we're done splitting it into
+        # lines, whatever partial line remains is moved at the beginning.
+        self.buffer = None
+        self.buffered = 0
+        self.datalines = deque()
+        # Maps (metric, tags) to a DedupEntry.
         # This dict is used to keep track of and remove duplicate values.
         # Since it might grow unbounded (in case we see many different
         # combinations of metrics and tags) someone needs to regularly call
         # evict_old_keys() to remove old entries.
-        self.values = {}
+        self.values = DedupCache()
         self.lines_sent = 0
         self.lines_received = 0
         self.lines_invalid = 0
+        self.lines_rejected = 0  # By the TSD, when we can tell.
         self.last_datapoint = int(time.time())
 
     def read(self):
@@ -150,12 +771,22 @@ class Collector(object):
 
         # we have to use a buffer because sometimes the collectors will write
         # out a bunch of data points at one time and we get some weird sized
-        # chunk.  This read call is non-blocking.
+        # chunk.  These read calls are non-blocking, we read until the pipe
+        # is drained.
+        if self.buffer is None:
+            self.buffer = bytearray(READ_BUFFER_SIZE)
         try:
-            self.buffer += self.proc.stdout.read()
-            if len(self.buffer):
-                LOG.debug('reading %s, buffer now %d bytes',
-                          self.name, len(self.buffer))
+            stdout = io.FileIO(self.proc.stdout.fileno(), 'r', closefd=False)
+            while True:
+                if self.buffered == len(self.buffer):
+                    # A single line fills up the entire buffer, grow it.
+                    self.buffer.extend(bytearray(len(self.buffer)))
+                n = stdout.readinto(memoryview(self.buffer)[self.buffered:])
+                if not n:  # None when we'd block, 0 on EOF.
+                    break
+                LOG.debug('reading %s got %d bytes on stdout', self.name, n)
+                self.buffered += n
+                self.split_lines()
         except IOError, (err, msg):
             if err != errno.EAGAIN:
                 raise
@@ -165,20 +796,25 @@ class Collector(object):
             LOG.exception('caught exception, collector process went away while reading stdout')
         except:
             LOG.exception('uncaught exception in stdout read')
-            return
-
-        # iterate for each line we have
-        while self.buffer:
-            idx = self.buffer.find('\n')
-            if idx == -1:
-                break
 
-            # one full line is now found and we can pull it out of the buffer
-            line = self.buffer[0:idx].strip()
+    def split_lines(self):
+        """Moves all the complete lines from our buffer to self.datalines."""
+        end = self.buffer.rfind('\n', 0, self.buffered)
+        if end == -1:
+            return
+        # one copy to pull all the lines out and one pass to split them
+        lines = memoryview(self.buffer)[:end].tobytes().split('\n')
+        # keep the trailing partial line for the next read
+        tail = self.buffered - end - 1
+        self.buffer[:tail] = self.buffer[end + 1:self.buffered]
+        self.buffered = tail
+        received = len(self.datalines)
+        for line in lines:
+            line = line.strip()
             if line:
                 self.datalines.append(line)
-                self.last_datapoint = int(time.time())
-            self.buffer = self.buffer[idx+1:]
+        if len(self.datalines) > received:
+            self.last_datapoint = int(time.time())
 
     def collect(self):
         """Reads input from the collector and returns the lines up to whomever
@@ -189,8 +825,8 @@ class Collector(object):
             self.read()
             if not len(self.datalines):
                 return
-            while len(self.datalines):
-                yield self.datalines.pop(0)
+            while self.datalines:
+                yield self.datalines.popleft()
 
     def shutdown(self):
         """Cleanly shut down the collector"""
@@ -212,17 +848,22 @@ class Collector(object):
             # we really don't want to die as we're trying to exit gracefully
             LOG.exception('ignoring uncaught exception while shutting down')
 
-    def evict_old_keys(self, cut_off):
+    def evict_old_keys(self, cut_off, limit=EVICT_BATCH_SIZE):
         """Remove old entries from the cache used to detect duplicate values.
 
         Args:
-          cut_off: A UNIX timestamp.  Any value that's older than this will be
-            removed from the cache.
+          cut_off: A UNIX timestamp.  Any value that hasn't been seen since
+            then will be removed from the cache.
+          limit: How many entries we may look at, at most.
+        Returns: how many entries were looked at.
         """
-        for key in self.values.keys():
-            time = self.values[key][3]
-            if time < cut_off:
-                del self.values[key]
+        return self.values.evict(cut_off, limit)
+
+    def values_size(self):
+        """Returns the approximate number of bytes used by self.values."""
+        values = self.values
+        return (sys.getsizeof(values) + len(values) * DedupEntry.SIZE
+                + values.tags_size)
 
 
 class StdinCollector(Collector):
@@ -231,6 +872,8 @@ class StdinCollector(Collector):
        ReaderThread, although unlike a normal collector, read()/collect()
        will be blocking."""
 
+    blocking = True
+
     def __init__(self):
         super(StdinCollector, self).__init__('stdin', 0, '<stdin>')
 
@@ -257,13 +900,429 @@ class StdinCollector(Collector):
         pass
 
 
+class ThreadOutput(object):
+    """Stands for sys.stdout or sys.stderr: what the threads running
+       in-process collectors print goes to their own pipe, and what the
+       other threads print goes to the real stream."""
+
+    softspace = 0  # For the print statement.
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def redirect(self, stream):
+        """Makes what the current thread prints go to the given stream."""
+        self.local.stream = stream
+
+    def target(self):
+        return getattr(self.local, 'stream', None) or self.stream
+
+    def write(self, data):
+        self.target().write(data)
+
+    def writelines(self, lines):
+        self.target().writelines(lines)
+
+    def flush(self):
+        self.target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.target(), name)
+
+
+class CollectorThread(threading.Thread):
+    """Runs a Python collector in a thread of ours instead of in a process of
+       its own: imports its module afresh and calls its main().  It acts
+       enough like a subprocess.Popen for Collector and the main loop: what
+       the collector prints comes out of the stdout and stderr pipes, and
+       its exit status is what main() returns or passes to sys.exit().
+
+       Killing it raises SystemExit in the collector's thread, which happens
+       as soon as it runs Python code again, e.g. once it's done sleeping.
+       A collector blocked in a C call (e.g. reading from a socket without a
+       timeout) can't be killed: once wait() gives up on it, we leave its
+       thread behind and consider it dead."""
+
+    def __init__(self, name, filename):
+        super(CollectorThread, self).__init__(name='collector ' + name)
+        self.setDaemon(True)
+        self.filename = filename
+        self.module_name = 'tcollector_' + re.sub(r'\W', '_', name)
+        self.pid = os.getpid()  # For the logs, we don't have our own.
+        self.returncode = None
+        self.killed = None  # The last signal we were sent, if any.
+        stdout, self.out = os.pipe()
+        self.stdout = os.fdopen(stdout, 'rb', 0)
+        self.out = os.fdopen(self.out, 'wb')
+        stderr, self.err = os.pipe()
+        self.stderr = os.fdopen(stderr, 'rb', 0)
+        self.err = os.fdopen(self.err, 'wb')
+
+    def start(self):
+        if not isinstance(sys.stdout, ThreadOutput):
+            sys.stdout = ThreadOutput(sys.stdout)
+        if not isinstance(sys.stderr, ThreadOutput):
+            sys.stderr = ThreadOutput(sys.stderr)
+        super(CollectorThread, self).start()
+
+    def run(self):
+        status = 1
+        try:
+            # Being killed may interrupt any of this.
+            try:
+                sys.stdout.redirect(self.out)
+                sys.stderr.redirect(self.err)
+                module = imp.load_source(self.module_name, self.filename)
+                status = module.main()
+            except SystemExit, e:
+                status = e.code
+            except:
+                traceback.print_exc()
+            status = exit_status(status)
+        finally:
+            sys.stdout.redirect(None)
+            sys.stderr.redirect(None)
+            if self.returncode is None:  # Unless wait() gave up on us.
+                self.close_output()
+                if self.killed is not None:
+                    status = -self.killed
+                self.returncode = status
+                sys.modules.pop(self.module_name, None)
+
+    def close_output(self):
+        for stream in (self.out, self.err):
+            try:
+                stream.close()  # Flushes it, and the reader gets EOF.
+            except IOError:
+                pass
+
+    def poll(self):
+        if self.returncode is None and not self.is_alive():
+            # Killed at a point where we couldn't clean up after it.
+            self.close_output()
+            self.returncode = -(self.killed or 1)
+        return self.returncode
+
+    def wait(self):
+        self.join(THREAD_KILL_TIMEOUT)
+        if self.poll() is None:
+            LOG.error('%s is still running, giving up on it', self.name)
+            self.close_output()
+            self.returncode = -(self.killed or signal.SIGKILL)
+            sys.modules.pop(self.module_name, None)
+        return self.returncode
+
+    def send_signal(self, signum):
+        if self.returncode is not None or not self.is_alive():
+            return
+        self.killed = signum
+        ctypes.pythonapi.PyThreadState_SetAsyncExc(
+            ctypes.c_long(self.ident), ctypes.py_object(SystemExit))
+
+
+def exit_status(code):
+    """Returns the exit status of a Python program that raised
+       SystemExit(code), printing the code if it's a message, like the
+       interpreter does."""
+    if code is None:
+        return 0
+    if isinstance(code, (int, long)):
+        return code
+    print >>sys.stderr, code
+    return 1
+
+
+class ForkServer(object):
+    """Spawns Python collectors by forking a process which has already
+       imported the modules they typically use, rather than by starting a
+       new interpreter for each run.
+
+       The server is forked from tcollector before it starts any thread.  We
+       send it the filename of a collector and the paths of two FIFOs, which
+       it opens as the stdout and stderr of a child which runs the collector
+       as __main__.  It replies with the pid of the child, and tells us the
+       exit status of its children as they exit."""
+
+    def __init__(self, modules=FORK_SERVER_MODULES):
+        # What a new interpreter costs, to report what we save.
+        startup_cpu = startup_cpu_time()
+        self.fifo_dir = tempfile.mkdtemp(prefix='tcollector-')
+        self.sock, server_sock = socket.socketpair()
+        self.pid = os.fork()
+        if self.pid == 0:
+            status = 1
+            try:
+                self.sock.close()
+                serve_forks(server_sock, modules)
+                status = 0
+            finally:
+                os._exit(status)
+        server_sock.close()
+        self.lock = threading.Lock()
+        self.dead = False
+        self.responses = ''  # Incomplete line the server sent us.
+        self.statuses = {}   # Maps the pid of exited children to their status.
+        self.fifos = 0       # How many FIFOs we've made, to name them.
+        self.spawns = 0
+        self.spawn_time = 0.0  # Total, in seconds.
+        # The server tells us what a child costs it once it's ready.
+        try:
+            ready = self.read(FORK_SERVER_TIMEOUT)
+        except:
+            self.close()
+            raise
+        self.cpu_saved = max(startup_cpu - float(ready.split()[1]), 0)
+
+    def spawn(self, filename):
+        """Spawns the given Python collector.
+
+        Returns: a ForkedProcess.
+        Raises: an EnvironmentError if the server failed to spawn it.
+        """
+        with self.lock:
+            self.fifos += 1
+            paths = [os.path.join(self.fifo_dir, '%d.%s' % (self.fifos, name))
+                     for name in ('out', 'err')]
+            fds = []
+            try:
+                for path in paths:
+                    os.mkfifo(path, 0600)
+                    # Doesn't wait for a writer, unlike a blocking open.
+                    fds.append(os.open(path, os.O_RDONLY | os.O_NONBLOCK))
+                start = time.time()
+                self.sock.sendall('%s\0%s\0%s\n' % (filename, paths[0],
+                                                     paths[1]))
+                reply = self.read(FORK_SERVER_TIMEOUT)
+                if not reply.startswith('pid '):
+                    raise OSError(reply)
+            except:
+                for fd in fds:
+                    os.close(fd)
+                raise
+            finally:
+                for path in paths:
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+            self.spawns += 1
+            self.spawn_time += time.time() - start
+            return ForkedProcess(self, int(reply[4:]),
+                                 os.fdopen(fds[0], 'rb', 0),
+                                 os.fdopen(fds[1], 'rb', 0))
+
+    def read(self, timeout):
+        """Reads what the server sent us, up to the reply to our last
+           request, which is returned, or until we'd wait for more than
+           `timeout' seconds."""
+        deadline = time.time() + timeout
+        while True:
+            while '\n' in self.responses:
+                line, self.responses = self.responses.split('\n', 1)
+                if not line.startswith('exit '):
+                    return line
+                _, pid, status = line.split()
+                self.statuses[int(pid)] = int(status)
+            remaining = max(deadline - time.time(), 0)
+            if not select.select([self.sock], [], [], remaining)[0]:
+                if timeout:
+                    self.dead = True  # Or as good as.
+                    raise socket.timeout('the fork server did not reply')
+                return None
+            try:
+                data = self.sock.recv(65536)
+            except socket.error:
+                data = ''
+            if not data:
+                self.dead = True
+                raise socket.error('the fork server exited')
+            self.responses += data
+
+    def status(self, pid):
+        """Returns the exit status of the given child, or None if it's still
+           running."""
+        with self.lock:
+            if not self.dead:
+                try:
+                    self.read(0)
+                except socket.error:
+                    pass
+            if pid in self.statuses:
+                return self.statuses.pop(pid)
+            if self.dead:
+                # Nobody can tell us any more, see if it's still there.
+                try:
+                    os.kill(pid, 0)
+                except OSError:
+                    return 0
+            return None
+
+    def close(self):
+        """Stops the server."""
+        self.sock.close()
+        try:
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+        shutil.rmtree(self.fifo_dir, ignore_errors=True)
+
+
+class ForkedProcess(object):
+    """A collector spawned by the ForkServer.  It acts like a
+       subprocess.Popen, except that it's not our child."""
+
+    def __init__(self, server, pid, stdout, stderr):
+        self.server = server
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            self.returncode = self.server.status(self.pid)
+        return self.returncode
+
+    def wait(self):
+        while self.poll() is None:
+            time.sleep(0.1)
+        return self.returncode
+
+
+def startup_cpu_time():
+    """Returns how many seconds of CPU it takes a new Python interpreter to
+       start and import the collectors' library, which is the least a
+       Python collector does."""
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    subprocess.call([sys.executable, '-c',
+                     'try: import collectors.lib.utils\n'
+                     'except ImportError: pass'])
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (after.ru_utime + after.ru_stime
+            - before.ru_utime - before.ru_stime)
+
+
+def serve_forks(sock, modules):
+    """The main loop of the ForkServer's process.  Returns when tcollector
+       goes away."""
+    # Ctrl-C is for tcollector, which stops us when it's done.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for name in modules:
+        try:
+            __import__(name)
+        except ImportError:
+            pass
+    # What a child costs us, to tell tcollector how much we save.
+    pid = os.fork()
+    if pid == 0:
+        os.closerange(3, subprocess.MAXFD)
+        os._exit(0)
+    usage = os.wait4(pid, 0)[2]
+    sock.sendall('ready %f\n' % (usage.ru_utime + usage.ru_stime))
+    # Wake up as soon as a child exits.
+    wakeup, wakeup_w = os.pipe()
+    set_nonblocking(wakeup)
+    set_nonblocking(wakeup_w)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    requests = ''
+    while True:
+        try:
+            readable = select.select([sock, wakeup], [], [])[0]
+        except select.error, e:
+            if e[0] != errno.EINTR:
+                raise
+            readable = []
+        if wakeup in readable:
+            os.read(wakeup, 4096)
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                break  # No children.
+            if not pid:
+                break
+            if os.WIFSIGNALED(status):
+                status = -os.WTERMSIG(status)
+            else:
+                status = os.WEXITSTATUS(status)
+            sock.sendall('exit %d %d\n' % (pid, status))
+        if sock not in readable:
+            continue
+        data = sock.recv(65536)
+        if not data:
+            return
+        requests += data
+        while '\n' in requests:
+            request, requests = requests.split('\n', 1)
+            filename, stdout, stderr = request.split('\0')
+            sock.sendall(fork_collector(filename, stdout, stderr))
+
+
+def fork_collector(filename, stdout, stderr):
+    """Forks a child running the given collector, with its output going to
+       the given FIFOs.  Returns the reply to send to tcollector."""
+    try:
+        out = os.open(stdout, os.O_WRONLY)
+        try:
+            err = os.open(stderr, os.O_WRONLY)
+            # The child closes its end once it has its own session.
+            ready, ready_w = os.pipe()
+            try:
+                try:
+                    pid = os.fork()
+                    if pid == 0:
+                        run_forked_collector(filename, out, err)
+                finally:
+                    os.close(ready_w)
+                os.read(ready, 1)
+            finally:
+                os.close(ready)
+                os.close(err)
+        finally:
+            os.close(out)
+    except OSError, e:
+        return 'error %s\n' % e
+    return 'pid %d\n' % pid
+
+
+def run_forked_collector(filename, stdout, stderr):
+    """Runs the given collector in a child of the ForkServer, the way the
+       interpreter would run it.  Never returns."""
+    status = 1
+    try:
+        # Like spawn_collector() does.
+        os.setsid()
+        os.dup2(stdout, 1)
+        os.dup2(stderr, 2)
+        os.closerange(3, subprocess.MAXFD)
+        signal.set_wakeup_fd(-1)
+        for signum in (signal.SIGINT, signal.SIGCHLD):
+            signal.signal(signum, signal.SIG_DFL)
+        sys.argv = [filename]
+        sys.path.insert(0, os.path.dirname(filename))
+        runpy.run_path(filename, run_name='__main__')
+        status = 0
+    except SystemExit, e:
+        status = exit_status(e.code)
+    except:
+        traceback.print_exc()
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(status)
+
+
 class ReaderThread(threading.Thread):
     """The main ReaderThread is responsible for reading from the collectors
        and assuring that we always read from the input no matter what.
-       All data read is put into the self.readerq Queue, which is
+       All data read is put into the self.readerq ReaderQueue, which is
        consumed by the SenderThread."""
 
-    def __init__(self, dedupinterval, evictinterval):
+    def __init__(self, dedupinterval, evictinterval, max_series=0,
+                 state_file=None, state_interval=600):
         """Constructor.
             Args:
               dedupinterval: If a metric sends the same value over successive
@@ -275,16 +1334,33 @@ class ReaderThread(threading.Thread):
                 combination of (metric, tags).  Values older than
                 evictinterval will be removed from the cache to save RAM.
                 Invariant: evictinterval > dedupinterval
+              max_series: If non-zero, the maximum number of combinations of
+                (metric, tags) to keep track of, across all collectors.  The
+                least recently seen ones are evicted first.
+              state_file: If given, where to save the dedup state every
+                state_interval seconds and when we exit, so that it can be
+                restored with load_dedup_state() when we restart.
         """
         assert evictinterval > dedupinterval, "%r <= %r" % (evictinterval,
                                                             dedupinterval)
         super(ReaderThread, self).__init__()
 
         self.readerq = ReaderQueue(MAX_READQ_SIZE)
+        # Datapoints accepted by process_line() that haven't been handed over
+        # to the readerq yet.
+        self.pending = []
         self.lines_collected = 0
         self.lines_dropped = 0
         self.dedupinterval = dedupinterval
         self.evictinterval = evictinterval
+        self.max_series = max_series
+        self.state_file = state_file
+        self.state_interval = state_interval
+        # Time spent evicting old entries from the dedup caches, during
+        # which we're not reading from the collectors.
+        self.pause_time = 0.0
+        # The thread writing the last snapshot of the dedup state.
+        self.state_writer = None
 
     def run(self):
         """Main loop for this thread.  Just reads from collectors,
@@ -293,30 +1369,112 @@ class ReaderThread(threading.Thread):
 
         LOG.debug("ReaderThread up and running")
 
-        lastevict_time = 0
-        # we loop every second for now.  ideally we'll setup some
-        # select or other thing to wait for input on our children,
-        # while breaking out every once in a while to setup selects
-        # on new children.
+        last_save = time.time()
+        # without a poller we loop every second and try to read from every
+        # collector, otherwise we wake up as soon as one of them has data,
+        # but at least once a second to take care of evictions.
         while ALIVE:
-            for col in all_living_collectors():
+            if POLLER is None:
+                collectors = all_living_collectors()
+                hungup = ()
+            else:
+                collectors, hungup = POLLER.poll(1)
+            for col in collectors:
                 for line in col.collect():
                     self.process_line(col, line)
+                    if col.blocking:
+                        # collect() only returns at EOF, don't sit on
+                        # the lines until then.
+                        self.flush()
+                self.flush()
+            # collect() drained whatever was left in the pipes.
+            for fd, col in hungup:
+                POLLER.unregister_fd(fd, col)
 
             if self.dedupinterval != 0:  # if 0 we do not use dedup
-                now = int(time.time())
-                if now - lastevict_time > self.evictinterval:
-                    lastevict_time = now
-                    now -= self.evictinterval
-                    for col in all_collectors():
-                        col.evict_old_keys(now)
+                self.evict_old_keys()
+                if (self.state_file
+                    and time.time() - last_save >= self.state_interval):
+                    self.save_state()
+                    last_save = time.time()
 
-            # and here is the loop that we really should get rid of, this
-            # just prevents us from spinning right now
-            time.sleep(1)
+            if POLLER is None:
+                time.sleep(1)
+
+        if self.state_file and self.dedupinterval != 0:
+            self.save_state(wait=True)
+
+    def save_state(self, wait=False):
+        """Saves the dedup state to self.state_file.
+
+           Only taking a snapshot of the state holds up the reader, it's
+           written by another thread.  If the previous snapshot is still
+           being written, we skip this one, unless `wait' is true, in which
+           case we also wait for this one to be written."""
+        if self.state_writer is not None and self.state_writer.isAlive():
+            if not wait:
+                LOG.warning('Still saving the dedup state to %s, skipping',
+                            self.state_file)
+                return
+            self.state_writer.join()
+        start = time.time()
+        snapshot = snapshot_dedup_state()
+        self.pause_time += time.time() - start
+        self.state_writer = threading.Thread(target=self.write_state,
+                                             args=(snapshot,))
+        self.state_writer.setDaemon(True)
+        self.state_writer.start()
+        if wait:
+            self.state_writer.join()
+
+    def write_state(self, snapshot):
+        """Writes a snapshot of the dedup state to self.state_file."""
+        try:
+            write_dedup_state(self.state_file, snapshot)
+        except (IOError, OSError), e:
+            LOG.error('Failed to save the dedup state to %s: %s',
+                      self.state_file, e)
+
+    def evict_old_keys(self):
+        """Evicts what has expired from the dedup caches of our collectors,
+           a slice at a time so we don't stall while lines pile up in the
+           pipes."""
+        start = time.time()
+        cut_off = int(start) - self.evictinterval
+        limit = EVICT_BATCH_SIZE
+        caches = DEDUP_CACHES.values()
+        for cache in caches:
+            limit -= cache.evict(cut_off, limit)
+            if limit <= 0:
+                break
+        if self.max_series:
+            self.evict_least_recently_seen(caches)
+        self.pause_time += time.time() - start
+
+    def evict_least_recently_seen(self, caches):
+        """Evicts the least recently seen entries of the given dedup caches
+           until they're under self.max_series in total, no more than
+           EVICT_BATCH_SIZE at a time: the rest goes on the next passes."""
+        excess = sum(len(cache) for cache in caches) - self.max_series
+        limit = EVICT_BATCH_SIZE
+        caches = [cache for cache in caches if cache]
+        while excess > 0 and limit > 0 and caches:
+            cache = min(caches, key=DedupCache.oldest)
+            evicted = cache.evict_lru(min(excess, limit))
+            excess -= evicted
+            limit -= evicted
+            if not cache:
+                caches = [other for other in caches if other is not cache]
+
+    def flush(self):
+        """Hands over the pending datapoints to the reader queue."""
+        if self.pending:
+            self.lines_dropped += self.readerq.nput_batch(self.pending)
+            self.pending = []
 
     def process_line(self, col, line):
-        """Parses the given line and appends the result to the reader queue."""
+        """Parses the given line and appends the resulting Datapoint to the
+           pending ones, see flush()."""
 
         self.lines_collected += 1
 
@@ -325,17 +1483,12 @@ class ReaderThread(threading.Thread):
             LOG.warning('%s line too long: %s', col.name, line)
             col.lines_invalid += 1
             return
-        parsed = re.match('^([-_./a-zA-Z0-9]+)\s+' # Metric name.
-                          '(\d+)\s+'               # Timestamp.
-                          '(\S+?)'                 # Value (int or float).
-                          '((?:\s+[-_./a-zA-Z0-9]+=[-_./a-zA-Z0-9]+)*)$', # Tags
-                          line)
-        if parsed is None:
+        dp = parse_line(line)
+        if dp is None:
             LOG.warning('%s sent invalid data: %s', col.name, line)
             col.lines_invalid += 1
             return
-        metric, timestamp, value, tags = parsed.groups()
-        timestamp = int(timestamp)
+        dp.collector = col.name
 
         # De-dupe detection...  To reduce the number of points we send to the
         # TSD, we suppress sending values of metrics that don't change to
@@ -347,66 +1500,402 @@ class ReaderThread(threading.Thread):
         # slopes of graphs correct).
         #
         if self.dedupinterval != 0:  # if 0 we do not use dedup
-            key = (metric, tags)
-            if key in col.values:
+            key = (dp.metric, dp.tags)
+            timestamp = dp.timestamp
+            entry = col.values.get(key)
+            if entry is not None:
                 # if the timestamp isn't > than the previous one, ignore this value
-                if timestamp <= col.values[key][3]:
+                if timestamp <= entry.timestamp:
                     LOG.error("Timestamp out of order: metric=%s%s,"
                               " old_ts=%d >= new_ts=%d - ignoring data point"
-                              " (value=%r, collector=%s)", metric, tags,
-                              col.values[key][3], timestamp, value, col.name)
+                              " (value=%r, collector=%s)", dp.metric,
+                              format_tags(dp.tags), entry.timestamp,
+                              timestamp, dp.value, col.name)
                     col.lines_invalid += 1
                     return
                 elif timestamp >= MAX_REASONABLE_TIMESTAMP:
                     LOG.error("Timestamp is too far out in the future: metric=%s%s"
                               " old_ts=%d, new_ts=%d - ignoring data point"
-                              " (value=%r, collector=%s)", metric, tags,
-                              col.values[key][3], timestamp, value, col.name)
+                              " (value=%r, collector=%s)", dp.metric,
+                              format_tags(dp.tags), entry.timestamp,
+                              timestamp, dp.value, col.name)
                     return
 
+                same = (entry.value == dp.value
+                        or dedup_value(entry.value) == dedup_value(dp.value))
+
                 # if this data point is repeated, store it but don't send.
                 # store the previous timestamp, so when/if this value changes
                 # we send the timestamp when this metric first became the current
                 # value instead of the last.  Fall through if we reach
                 # the dedup interval so we can print the value.
-                if (col.values[key][0] == value and
-                    (timestamp - col.values[key][3] < self.dedupinterval)):
-                    col.values[key] = (value, True, line, col.values[key][3])
+                if same and timestamp - entry.timestamp < self.dedupinterval:
+                    entry.value = dp.value
+                    entry.last_timestamp = timestamp
                     return
 
                 # we might have to append two lines if the value has been the same
                 # for a while and we've skipped one or more values.  we need to
                 # replay the last value we skipped (if changed) so the jumps in
                 # our graph are accurate,
-                if ((col.values[key][1] or
-                    (timestamp - col.values[key][3] >= self.dedupinterval))
-                    and col.values[key][0] != value):
+                if ((entry.repeated()
+                     or timestamp - entry.timestamp >= self.dedupinterval)
+                    and not same):
                     col.lines_sent += 1
-                    if not self.readerq.nput(col.values[key][2]):
-                        self.lines_dropped += 1
-
-            # now we can reset for the next pass and send the line we actually
-            # want to send
-            # col.values is a dict of tuples, with the key being the metric and
-            # tags (essentially the same as wthat TSD uses for the row key).
-            # The array consists of:
-            # [ the metric's value, if this value was repeated, the line of data,
-            #   the value's timestamp that it last changed ]
-            col.values[key] = (value, False, line, timestamp)
+                    self.pending.append(Datapoint(dp.metric,
+                                                  entry.last_timestamp,
+                                                  entry.value, dp.tags,
+                                                  col.name))
+
+                # now we can reset for the next pass and send the line we
+                # actually want to send
+                entry.value = dp.value
+                entry.timestamp = entry.last_timestamp = timestamp
+            else:
+                # col.values is keyed by metric and tags (essentially the
+                # same as what TSD uses for the row key).
+                col.values.add(key, DedupEntry(dp.value, timestamp))
 
         col.lines_sent += 1
-        if not self.readerq.nput(line):
-            self.lines_dropped += 1
+        self.pending.append(dp)
+
+
+def save_dedup_state(path):
+    """Saves the dedup caches of all the collectors in the given file."""
+    write_dedup_state(path, snapshot_dedup_state())
+
+
+def snapshot_dedup_state():
+    """Returns a copy of the dedup caches of all the collectors, that
+       write_dedup_state() can save while they keep changing: a list of
+       (name, entries), where entries is a list of (metric, tags, value,
+       timestamp, last timestamp)."""
+    return [(name, [(metric, tags, entry.value, entry.timestamp,
+                     entry.last_timestamp)
+                    for (metric, tags), entry in cache.iteritems()])
+            for name, cache in DEDUP_CACHES.items() if '\n' not in name]
+
+
+def write_dedup_state(path, snapshot):
+    """Saves a snapshot_dedup_state() in the given file.
+
+    The file is a gzip'ed text file, with a "collector <name>" line before the
+    entries of each collector, one per line: "<metric> <value> <timestamp>
+    <last timestamp> <tags...>".  None of these fields can contain spaces.
+    It's written to a temporary file that's synced to disk before replacing
+    the previous one, so that a crash leaves one or the other intact.
+    """
+    tmp = path + '.tmp'
+    raw = open(tmp, 'wb')
+    try:
+        f = gzip.GzipFile(tmp, 'wb', 1, raw)
+        try:
+            f.write('# tcollector dedup state\n')
+            for name, entries in snapshot:
+                f.write('collector %s\n' % name)
+                f.writelines(['%s %s %d %d%s\n'
+                              % (metric, value, timestamp, last_timestamp,
+                                 format_tags(tags))
+                              for metric, tags, value, timestamp,
+                                  last_timestamp in entries])
+        finally:
+            f.close()
+        raw.flush()
+        os.fsync(raw.fileno())
+    finally:
+        raw.close()
+    os.rename(tmp, path)
+
+
+def load_dedup_state(path, cut_off):
+    """Restores the dedup caches saved by save_dedup_state().
+
+    Args:
+      path: The file to load the state from.
+      cut_off: A UNIX timestamp.  Entries last seen before then are stale
+        and aren't restored.
+    Returns: how many entries were restored.
+    """
+    if not os.path.exists(path):
+        return 0
+    loaded = 0
+    cache = None
+    f = gzip.open(path, 'rb')
+    try:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            if line.startswith('collector '):
+                name = line[len('collector '):-1]
+                cache = DEDUP_CACHES.get(name)
+                if cache is None:
+                    cache = DEDUP_CACHES[name] = DedupCache()
+                continue
+            fields = line.split()
+            if len(fields) < 4 or cache is None:
+                raise ValueError('invalid line: %r' % line)
+            metric, value, timestamp, last_timestamp = fields[:4]
+            if int(last_timestamp) < cut_off:
+                continue
+            tags = intern(' '.join(sorted(fields[4:])))
+            entry = DedupEntry(value, int(timestamp))
+            entry.last_timestamp = int(last_timestamp)
+            cache.add((intern(metric), tags), entry)
+            loaded += 1
+    finally:
+        f.close()
+    return loaded
+
+
+class TokenBucket(object):
+    """A token bucket, to rate limit something to `rate' units per second,
+       with bursts of at most a second worth of units."""
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last_refill = time.time()
+
+    def refill(self):
+        now = time.time()
+        if now > self.last_refill:
+            self.tokens = min(self.rate, self.tokens
+                              + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def delay(self):
+        """Returns how many seconds until there's at least one token."""
+        self.refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, count):
+        """Takes `count' tokens, possibly more than there are."""
+        self.tokens -= count
+
+
+def write_spool_segment(path, lines, compress):
+    """Appends lines to a segment file of the DiskSpool, and returns the new
+       size of the file."""
+    data = '\n'.join(lines) + '\n'
+    f = open(path, 'ab')
+    try:
+        if compress:
+            # Each write adds a gzip member to the segment, gzip reads
+            # them back one after the other.
+            g = gzip.GzipFile(fileobj=f, mode='wb', compresslevel=1)
+            g.write(data)
+            g.close()
+        else:
+            f.write(data)
+        return f.tell()
+    finally:
+        f.close()
+
+
+def lines_size(lines):
+    """Returns how many bytes the given lines take in a spool segment, when
+       not compressed."""
+    return sum(len(line) for line in lines) + len(lines)
+
+
+def read_spool_segment(path):
+    """Generates the lines of a segment file of the DiskSpool.
+
+    Whatever is left of an interrupted write at the end of the file is
+    skipped.  We don't use the gzip module as it chokes on those.
+    """
+    f = open(path, 'rb')
+    try:
+        if path.endswith('.gz'):
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            decompressor = None
+        pending = ''
+        while True:
+            data = f.read(READ_BUFFER_SIZE)
+            if not data:
+                break
+            if decompressor is not None:
+                compressed, data = data, ''
+                # Every write is a gzip member of its own.
+                while compressed:
+                    data += decompressor.decompress(compressed)
+                    compressed = decompressor.unused_data
+                    if compressed:
+                        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            lines = (pending + data).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line
+    finally:
+        f.close()
+
+
+class DiskSpool(object):
+    """An append-only spool on disk for the lines we couldn't send.
+
+    The lines are written to numbered segment files in a directory, which are
+    read back oldest first.  Once entirely read, a segment is deleted.  If the
+    segments grow past their byte budget on disk, the oldest ones are
+    dropped, but never the one we're writing to.  The
+    segments left behind by a previous run are picked up again on startup.
+    Lines that were read but couldn't be sent can be put back with unread(),
+    to be read again before anything else.
+    """
+
+    def __init__(self, directory, max_bytes, compress=False):
+        """Constructor.
+
+        Args:
+          directory: The directory where to keep the segment files.
+          max_bytes: How many bytes the segments may use on disk in total.
+          compress: If true, the segments we write are gzip'ed.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.segment_size = min(SPOOL_SEGMENT_SIZE, max(1, max_bytes // 8))
+        self.segments = deque()  # [path, size] of each segment, oldest first.
+        self.bytes = 0           # Size of all the segments on disk.
+        self.dropped_bytes = 0   # How many bytes we dropped over budget.
+        self.writing = None      # Path of the segment we append to.
+        self.reading = None      # File of the segment we're reading.
+        self.head = []           # Lines put back by unread().
+        self.head_bytes = 0      # Size of these lines.
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        names = [name for name in os.listdir(directory)
+                 if name.endswith(('.spool', '.spool.gz'))
+                 and name.split('.', 1)[0].isdigit()]
+        names.sort(key=lambda name: int(name.split('.', 1)[0]))
+        for name in names:
+            path = os.path.join(directory, name)
+            size = os.path.getsize(path)
+            self.segments.append([path, size])
+            self.bytes += size
+        if names:
+            self.next_segment = int(names[-1].split('.', 1)[0]) + 1
+        else:
+            self.next_segment = 0
+
+    def write(self, lines):
+        """Appends the given lines (without the trailing newline)."""
+        if not lines:
+            return
+        if (self.writing is None
+            or self.segments[-1][1] >= self.segment_size):
+            name = '%d.spool' % self.next_segment
+            if self.compress:
+                name += '.gz'
+            self.next_segment += 1
+            self.writing = os.path.join(self.directory, name)
+            self.segments.append([self.writing, 0])
+        size = write_spool_segment(self.writing, lines, self.compress)
+        self.bytes += size - self.segments[-1][1]
+        self.segments[-1][1] = size
+        while self.bytes > self.max_bytes and len(self.segments) > 1:
+            path, size = self.segments[0]
+            LOG.warning('Spool over budget, dropping %d bytes from %s',
+                        size, path)
+            self.dropped_bytes += size
+            self.remove_oldest()
+
+    def read(self, max_lines):
+        """Removes and returns up to `max_lines' lines, oldest first."""
+        lines = self.head[:max_lines]
+        del self.head[:max_lines]
+        self.head_bytes -= lines_size(lines)
+        while len(lines) < max_lines and self.segments:
+            if self.reading is None:
+                path = self.segments[0][0]
+                if path == self.writing:
+                    self.writing = None  # Further lines go to a new segment.
+                self.reading = read_spool_segment(path)
+            try:
+                for line in self.reading:
+                    lines.append(line)
+                    if len(lines) >= max_lines:
+                        break
+                else:
+                    self.remove_oldest()
+            except (IOError, zlib.error), e:
+                LOG.error('Skipping the rest of the corrupted spool segment '
+                          '%s: %s', self.segments[0][0], e)
+                self.remove_oldest()
+        return lines
+
+    def unread(self, lines):
+        """Puts back lines returned by read(), so that they're the next ones
+           read."""
+        self.head[:0] = lines
+        self.head_bytes += lines_size(lines)
+
+    def empty(self):
+        """Returns true if there's nothing left to read."""
+        return not self.segments and not self.head
+
+    def close(self):
+        """Rewrites the segment we're reading without the lines we already
+           read, so they don't get sent again after a restart.  The lines
+           put back by unread() go at its beginning."""
+        head, self.head = self.head, []
+        self.head_bytes = 0
+        if self.reading is None:
+            if not head:
+                return
+            if not self.segments:
+                self.write(head)
+                return
+            self.reading = read_spool_segment(self.segments[0][0])
+        path, size = self.segments[0]
+        try:
+            lines = head + list(self.reading)
+        except (IOError, zlib.error):
+            lines = head
+        if not lines:
+            self.remove_oldest()
+            return
+        self.reading.close()
+        self.reading = None
+        tmp = path + '.tmp'
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        new_size = write_spool_segment(tmp, lines, path.endswith('.gz'))
+        os.rename(tmp, path)
+        self.bytes += new_size - size
+        self.segments[0][1] = new_size
+
+    def remove_oldest(self):
+        """Deletes the oldest segment."""
+        path, size = self.segments.popleft()
+        if self.reading is not None:
+            self.reading.close()
+            self.reading = None
+        if path == self.writing:
+            self.writing = None
+        self.bytes -= size
+        try:
+            os.unlink(path)
+        except OSError, e:
+            LOG.error('Failed to remove the spool segment %s: %s', path, e)
 
 
 class SenderThread(threading.Thread):
     """The SenderThread is responsible for maintaining a connection
        to the TSD and sending the data we're getting over to it.  This
        thread is also responsible for doing any sort of emergency
-       buffering we might need to do if we can't establish a connection
-       and we need to spool to disk.  That isn't implemented yet."""
-
-    def __init__(self, reader, dryrun, hosts, self_report_stats, tags, reconnectinterval):
+       buffering we might need to do if we can't establish a connection:
+       given a DiskSpool, it spools to disk whatever it can't send, and
+       replays it once it's connected again."""
+
+    def __init__(self, reader, dryrun, hosts, self_report_stats, tags,
+                 reconnectinterval, spool=None, replay_points=0,
+                 replay_bytes=0, batch_lines=MAX_SENDQ_SIZE,
+                 batch_bytes=MAX_BATCH_BYTES, batch_delay=1, http=False,
+                 http_compress=False, send_buffer_size=0, queue=None,
+                 standby=False, dns=None, shared_stats=True, stats_tags=''):
         """Constructor.
 
         Args:
@@ -418,86 +1907,221 @@ class SenderThread(threading.Thread):
             stats into the metrics reported to TSD, as if those metrics had
             been read from a collector.
           tags: A dictionary of tags to append for every data point.
+          reconnectinterval: If positive, how often to reconnect to the TSD.
+          spool: An optional DiskSpool where to write the data points we
+            can't send.
+          replay_points: If positive, how many data points per second we may
+            send from the spool.
+          replay_bytes: If positive, how many bytes per second we may send
+            from the spool.
+          batch_lines: How many data points to send at most at once.
+          batch_bytes: How many bytes to send at most at once (roughly).
+          batch_delay: How many seconds a data point may wait for its batch
+            to fill up before we send it anyway.
+          http: If true, send the data points to the TSD's HTTP API instead
+            of using `put' commands.
+          http_compress: If true, gzip the data points sent over HTTP.
+          send_buffer_size: If positive, the size of the send buffer of our
+            sockets to the TSD.  Otherwise the kernel sizes it.
+          queue: The ReaderQueue to take the data points from, if not the
+            reader's.
+          standby: If true, keep a connection to another TSD ready, to fail
+            over to it right away.
+          dns: The DNSCache to resolve the names of the TSDs with, if any.
+          shared_stats: If false, only report the stats of this sender and
+            its spool, another sender reports those of the rest of us.
+          stats_tags: The tags of the stats of this sender and its spool,
+            to tell them apart from those of the other senders.
         """
         super(SenderThread, self).__init__()
 
         self.dryrun = dryrun
         self.reader = reader
+        if queue is None and reader is not None:
+            queue = reader.readerq
+        self.readerq = queue
+        self.router = None  # The ShardRouter feeding our queue, if any.
         self.tags = sorted(tags.items())
+        # The global tags, formatted once and for all, their names, and the
+        # tag section of the lines for the tags of the data points we've
+        # seen, global tags included.
+        self.tags_suffix = ''.join([' %s=%s' % tag for tag in self.tags])
+        self.tag_names = frozenset(name for name, _ in self.tags)
+        self.tag_sections = ParseCache(MAX_PARSE_CACHE_SIZE)
         self.hosts = hosts  # A list of (host, port) pairs.
         # Randomize hosts to help even out the load.
         random.shuffle(self.hosts)
-        self.blacklisted_hosts = set()  # The 'bad' (host, port) pairs.
-        self.current_tsd = -1  # Index in self.hosts where we're at.
+        # The TSDHealth of each (host, port) pair, and its current weight in
+        # the smooth weighted round-robin of pick_connection().
+        self.health = dict((hostport, TSDHealth()) for hostport in hosts)
+        self.current_weights = dict((hostport, 0.0) for hostport in hosts)
         self.host = None  # The current TSD host we've selected.
         self.port = None  # The port of the current TSD.
         self.tsd = None   # The socket connected to the aforementioned TSD.
-        self.last_verify = 0
+        self.standby_enabled = standby
+        # The (host, port), socket and when we started to connect (None once
+        # connected) of our standby connection to another TSD.
+        self.standby = None
+        if dns is None:
+            dns = DNSCache(0)  # Always resolve the names again.
+        self.dns = dns
+        self.last_verify = 0   # When we last checked the connection.
+        self.last_healthy = 0  # When the TSD last took data or answered us.
+        self.probe_sent = None  # When we sent a `version' still unanswered.
+        self.next_stats = 0    # When to report our own stats next.
         self.reconnectinterval = reconnectinterval    # reconnectinterval in seconds.
         self.time_reconnect = 0                 # if reconnectinterval > 0, used to track the time.
-        self.sendq = []
+        self.sendq = []  # The lines of the batch we're about to send.
+        self.sendq_sources = []  # The collector each line came from.
+        self.sendq_bytes = 0  # The size of these lines, without "put ".
+        self.batch_start = 0  # When the first of these lines was queued.
+        self.batch_lines = batch_lines
+        self.batch_bytes = batch_bytes
+        self.batch_delay = batch_delay
         self.self_report_stats = self_report_stats
+        self.shared_stats = shared_stats
+        self.stats_tags = stats_tags
+        self.spool = spool
+        self.replay_limits = []  # TokenBuckets of points and bytes.
+        self.replay_points = None
+        if replay_points > 0:
+            self.replay_points = TokenBucket(replay_points)
+            self.replay_limits.append(self.replay_points)
+        self.replay_bytes = None
+        if replay_bytes > 0:
+            self.replay_bytes = TokenBucket(replay_bytes)
+            self.replay_limits.append(self.replay_bytes)
+        self.lines_replayed = 0
+        self.bytes_replayed = 0
+        self.http = http
+        self.http_compress = http_compress
+        self.http_conn = None  # The httplib.HTTPConnection to the TSD.
+        self.lines_rejected = 0
+        self.send_buffer_size = send_buffer_size
+        self.responses = ''  # Incomplete line the TSD sent us.
+        self.tsd_errors = 0  # Error messages the TSD sent us.
+        self.written = 0  # Bytes of the current lines written to the TSD.
 
     def pick_connection(self):
-        """Picks up a random host/port connection."""
-        # Try to get the next host from the list, until we find a host that
-        # isn't in the blacklist, or until we run out of hosts (i.e. they
-        # are all blacklisted, which typically happens when we lost our
-        # connectivity to the outside world).
-        for self.current_tsd in xrange(self.current_tsd + 1, len(self.hosts)):
-            hostport = self.hosts[self.current_tsd]
-            if hostport not in self.blacklisted_hosts:
-                break
+        """Picks up a host/port connection, among the ones whose circuit
+           breaker lets us try them, favoring the fast and reliable ones."""
+        now = time.time()
+        candidates = [hostport for hostport in self.hosts
+                      if self.health[hostport].available(now)]
+        if not candidates:
+            # They are all blacklisted, which typically happens when we lost
+            # our connectivity to the outside world.
+            LOG.info('No more healthy hosts, retry with the one blacklisted '
+                     'the longest ago')
+            hostport = min(self.hosts,
+                           key=lambda hostport: self.health[hostport].retry_at)
         else:
-            LOG.info('No more healthy hosts, retry with previously blacklisted')
-            random.shuffle(self.hosts)
-            self.blacklisted_hosts.clear()
-            self.current_tsd = 0
-            hostport = self.hosts[self.current_tsd]
+            # Smooth weighted round-robin: every candidate earns its weight,
+            # the richest one gets picked and pays for it.  With equal
+            # weights, that's a plain round-robin.
+            known = [self.health[hostport].latency() for hostport in candidates]
+            known = [latency for latency in known if latency is not None]
+            if known:
+                default = sum(known) / len(known)
+            else:
+                default = DEFAULT_TSD_LATENCY
+            total = 0
+            for hostport in candidates:
+                weight = self.health[hostport].weight(default)
+                self.current_weights[hostport] += weight
+                total += weight
+            hostport = max(candidates,
+                           key=lambda hostport: self.current_weights[hostport])
+            self.current_weights[hostport] -= total
 
         self.host, self.port = hostport
         LOG.info('Selected connection: %s:%d', self.host, self.port)
 
+    def healthy(self):
+        """Returns true if we're connected to a TSD we didn't blacklist."""
+        health = self.health.get((self.host, self.port))
+        return (self.tsd is not None
+                and (health is None or not health.failures))
+
     def blacklist_connection(self):
         """Marks the current TSD host we're trying to use as blacklisted.
 
-           Blacklisted hosts will get another chance to be elected once there
-           will be no more healthy hosts."""
-        # FIXME: Enhance this naive strategy.
-        LOG.info('Blacklisting %s:%s for a while', self.host, self.port)
-        self.blacklisted_hosts.add((self.host, self.port))
+           Blacklisted hosts open their circuit breaker: they get another
+           chance to be elected, for one try, after a delay which grows with
+           every failure in a row, or once there are no more healthy hosts."""
+        health = self.health.setdefault((self.host, self.port), TSDHealth())
+        health.record_failure()
+        LOG.info('Blacklisting %s:%s for %d seconds', self.host, self.port,
+                 health.retry_at - time.time())
+
+    def record_send(self, start):
+        """Records in the health of the current TSD that it took it since
+           `start' to take our data."""
+        health = self.health.get((self.host, self.port))
+        if health is not None:
+            health.record_send(time.time() - start)
+        self.last_healthy = time.time()
+
+    def slower_than_others(self):
+        """Returns true if the current TSD is a lot slower than another one
+           we could use instead."""
+        latency = self.health[(self.host, self.port)].latency()
+        if latency is None:
+            return False
+        now = time.time()
+        others = [health.latency() for hostport, health in self.health.items()
+                  if hostport != (self.host, self.port)
+                  and not health.failures and health.available(now)]
+        others = [other for other in others if other is not None]
+        return bool(others) and latency > SLOW_TSD_FACTOR * min(others)
 
     def run(self):
         """Main loop.  A simple scheduler.  Loop waiting for 5
            seconds for data on the queue.  If there's no data, just
            loop and make sure our connection is still open.  If there
-           is data, wait 5 more seconds and grab all of the pending data and
-           send it.  A little better than sending every line as its
-           own packet."""
+           is data, keep taking it off the queue until we have a full batch
+           (batch_lines lines or batch_bytes bytes) or the oldest data point
+           of the batch has waited batch_delay seconds, and send it.  When
+           the queue fills up faster than that, we send full batches back to
+           back.  While there is data in the spool, don't wait more than the
+           replay rate limits require, and after the new data, send a batch
+           of the spooled data on every iteration."""
 
         errors = 0  # How many uncaught exceptions in a row we got.
         while ALIVE:
             try:
                 self.maintain_conn()
-                try:
-                    line = self.reader.readerq.get(True, 5)
-                except Empty:
-                    continue
-                self.sendq.append(line)
-                time.sleep(5)  # Wait for more data
-                while True:
-                    # prevents self.sendq fast growing in case of sending fails
-                    # in send_data()
-                    if len(self.sendq) > MAX_SENDQ_SIZE:
-                        break
-                    try:
-                        line = self.reader.readerq.get(False)
-                    except Empty:
-                        break
-                    self.sendq.append(line)
-
-                if ALIVE:
-                    self.send_data()
+                if self.self_report_stats and time.time() >= self.next_stats:
+                    # Our meta stats help to see what is going on with the
+                    # tcollector.
+                    self.next_stats = time.time() + STATS_INTERVAL
+                    self.report_stats()
+                backlog = self.spool is not None and not self.spool.empty()
+                if backlog:
+                    timeout = min(5, self.replay_delay())
+                else:
+                    timeout = 5
+                if not self.sendq:
+                    self.enqueue(self.readerq.get_batch(
+                        timeout, self.batch_lines))
+                if self.sendq:
+                    deadline = self.batch_start + self.batch_delay
+                    if backlog:
+                        deadline = min(deadline,
+                                       time.time() + self.replay_delay())
+                    while (ALIVE and len(self.sendq) < self.batch_lines
+                           and self.sendq_bytes < self.batch_bytes):
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self.enqueue(self.readerq.get_batch(
+                            remaining, self.batch_lines - len(self.sendq)))
+
+                    if ALIVE:
+                        self.send_data()
+                # New data goes first, the backlog gets what's left.
+                if backlog and ALIVE and (self.tsd is not None or self.dryrun):
+                    self.replay_spool()
                 errors = 0  # We managed to do a successful iteration.
             except (ArithmeticError, EOFError, EnvironmentError, LookupError,
                     ValueError), e:
@@ -512,91 +2136,173 @@ class SenderThread(threading.Thread):
                 LOG.exception('Uncaught exception in SenderThread, going to exit')
                 shutdown()
                 raise
+        # Keep what we didn't get to send for the next time we're started.
+        if self.spool is not None:
+            if self.router is not None and self.router.isAlive():
+                # Wait for the router to hand us the rest of the reader's.
+                self.router.join()
+            if not self.dryrun:
+                self.spill()
+            self.spool.close()
 
     def verify_conn(self):
-        """Periodically verify that our connection to the TSD is OK
-           and that the TSD is alive/working."""
+        """Checks that our connection to the TSD is OK, without waiting for
+           the TSD.  As long as it takes our data and answers us, it's deemed
+           alive.  If the connection has been idle for a while, we probe the
+           TSD with a `version' command, which it must answer before long."""
         if self.tsd is None:
             return False
 
-        # if the last verification was less than a minute ago, don't re-verify
-        if self.last_verify > time.time() - 60:
-            return True
-
+        now = time.time()
         # in case reconnect is activated, check if it's time to reconnect
-        if self.reconnectinterval > 0 and self.time_reconnect < time.time() - self.reconnectinterval:
+        if self.reconnectinterval > 0 and self.time_reconnect < now - self.reconnectinterval:
             # closing the connection and indicating that we need to reconnect.
             try:
                 self.tsd.close()
             except socket.error, msg:
                 pass    # not handling that
-            self.time_reconnect = time.time()
-            return False
-            
-        # we use the version command as it is very low effort for the TSD
-        # to respond
-        LOG.debug('verifying our TSD connection is alive')
-        try:
-            self.tsd.sendall('version\n')
-        except socket.error, msg:
-            self.tsd = None
-            self.blacklist_connection()
+            self.time_reconnect = now
             return False
 
-        bufsize = 4096
-        while ALIVE:
-            # try to read as much data as we can.  at some point this is going
-            # to block, but we have set the timeout low when we made the
-            # connection
+        if not self.http:
+            # Whatever the TSD sent us may answer our probe.
             try:
-                buf = self.tsd.recv(bufsize)
+                self.read_responses()
             except socket.error, msg:
-                self.tsd = None
-                self.blacklist_connection()
-                return False
+                LOG.error('Lost the connection to %s:%d: %s', self.host,
+                          self.port, msg)
+                return self.drop_connection()
+            if (self.probe_sent is not None
+                and self.probe_sent < now - CONNECT_TIMEOUT):
+                # The TSD must be dead or overloaded.
+                LOG.error('%s:%d did not answer our probe', self.host,
+                          self.port)
+                return self.drop_connection()
 
-            # If we don't get a response to the `version' request, the TSD
-            # must be dead or overloaded.
-            if not buf:
-                self.tsd = None
-                self.blacklist_connection()
-                return False
+        # if the last verification was less than a minute ago, don't re-verify
+        if self.last_verify > now - VERIFY_INTERVAL:
+            return True
+        self.last_verify = now
 
-            # Woah, the TSD has a lot of things to tell us...  Let's make
-            # sure we read everything it sent us by looping once more.
-            if len(buf) == bufsize:
-                continue
+        # Don't stick with a slow TSD if there's a faster one.
+        if self.slower_than_others():
+            LOG.info('%s:%d is slow, switching to another TSD',
+                     self.host, self.port)
+            self.tsd.close()
+            self.tsd = None
+            return False
 
-            # If everything is good, send out our meta stats.  This
-            # helps to see what is going on with the tcollector.
-            if self.self_report_stats:
-                strs = [
-                        ('reader.lines_collected',
-                         '', self.reader.lines_collected),
-                        ('reader.lines_dropped',
-                         '', self.reader.lines_dropped)
-                       ]
-
-                for col in all_living_collectors():
-                    strs.append(('collector.lines_sent', 'collector='
-                                 + col.name, col.lines_sent))
-                    strs.append(('collector.lines_received', 'collector='
-                                 + col.name, col.lines_received))
-                    strs.append(('collector.lines_invalid', 'collector='
-                                 + col.name, col.lines_invalid))
-
-                ts = int(time.time())
-                strout = ["tcollector.%s %d %d %s"
-                          % (x[0], ts, x[2], x[1]) for x in strs]
-                for string in strout:
-                    self.sendq.append(string)
-
-            break  # TSD is alive.
-
-        # if we get here, we assume the connection is good
-        self.last_verify = time.time()
+        if (self.last_healthy > now - VERIFY_INTERVAL
+            or self.probe_sent is not None):
+            return True
+        LOG.debug('verifying our TSD connection is alive')
+        if self.http:
+            # Only idle connections get probed, so this doesn't hold up any
+            # data.
+            if not self.verify_http():
+                return self.drop_connection()
+            self.record_send(now)
+            return True
+        # we use the version command as it is very low effort for the TSD
+        # to respond.  The answer is read along with the TSD's other
+        # responses.
+        self.probe_sent = now
+        try:
+            self.write_telnet('version\n')
+        except socket.error, msg:
+            LOG.error('Failed to probe %s:%d: %s', self.host, self.port, msg)
+            return self.drop_connection()
         return True
 
+    def drop_connection(self):
+        """Closes our connection to the current TSD, which failed, and
+           blacklists it.  Returns false."""
+        try:
+            self.tsd.close()
+        except socket.error:
+            pass
+        self.tsd = None
+        self.probe_sent = None
+        self.blacklist_connection()
+        return False
+
+    def verify_http(self):
+        """Checks that the TSD replies to a GET /api/version."""
+        try:
+            conn = self.http_connection()
+            conn.request('GET', '/api/version')
+            response = conn.getresponse()
+            response.read()
+        except (httplib.HTTPException, socket.error), e:
+            LOG.debug('TSD version request failed: %s', e)
+            return False
+        if conn.sock is None:
+            self.tsd = None
+        return response.status == 200
+
+    def report_stats(self):
+        """Adds our own stats to the data points to send."""
+        tags = self.stats_tags
+        strs = []
+        if self.spool is not None:
+            strs.append(('spool.bytes', tags, self.spool.bytes))
+            strs.append(('spool.dropped_bytes', tags,
+                         self.spool.dropped_bytes))
+            strs.append(('spool.lines_replayed', tags,
+                         self.lines_replayed))
+            strs.append(('spool.bytes_replayed', tags,
+                         self.bytes_replayed))
+        if self.http:
+            strs.append(('sender.lines_rejected', tags, self.lines_rejected))
+        else:
+            strs.append(('sender.tsd_errors', tags, self.tsd_errors))
+        if self.shared_stats:
+            strs.extend(self.shared_stats_lines())
+
+        ts = int(time.time())
+        self.enqueue([Datapoint('tcollector.' + x[0], ts, x[2], x[1])
+                      for x in strs])
+
+    def shared_stats_lines(self):
+        """Returns the stats of the reader and collectors, and of whatever
+           is shared by all the senders, as (metric, tags, value)."""
+        strs = [
+                ('reader.lines_collected',
+                 '', self.reader.lines_collected),
+                ('reader.lines_dropped',
+                 '', self.reader.lines_dropped),
+                ('reader.pause_ms', '',
+                 int(self.reader.pause_time * 1000)),
+                ('dedup.bytes', '',
+                 sum(col.values_size() for col in all_collectors())),
+                ('dns.lookups', '', self.dns.lookups),
+                ('dns.misses', '', self.dns.misses),
+               ]
+        if self.router is not None:
+            strs.append(('router.lines_dropped', '',
+                         self.router.lines_dropped))
+        if FORK_SERVER is not None:
+            strs.append(('fork_server.spawns', '', FORK_SERVER.spawns))
+            strs.append(('fork_server.spawn_time_us', '',
+                         int(FORK_SERVER.spawn_time * 1000000)))
+            strs.append(('fork_server.cpu_saved_ms', '',
+                         int(FORK_SERVER.spawns * FORK_SERVER.cpu_saved
+                             * 1000)))
+
+        for col in all_living_collectors():
+            tags = 'collector=' + col.name
+            strs.append(('collector.lines_sent', tags, col.lines_sent))
+            strs.append(('collector.lines_received', tags,
+                         col.lines_received))
+            strs.append(('collector.lines_invalid', tags,
+                         col.lines_invalid))
+            strs.append(('collector.dedup_evictions', tags,
+                         col.values.lru_evictions))
+            if self.http:
+                strs.append(('collector.lines_rejected', tags,
+                             col.lines_rejected))
+        return strs
+
     def maintain_conn(self):
         """Safely connect to the TSD and ensure that it's up and
            running and that we're not talking to a ghost connection
@@ -609,93 +2315,847 @@ class SenderThread(threading.Thread):
         # connection didn't verify, so create a new one.  we might be in
         # this method for a long time while we sort this out.
         try_delay = 1
+        first = True
         while ALIVE:
             if self.verify_conn():
+                if self.standby_enabled:
+                    self.maintain_standby()
                 return
 
-            # increase the try delay by some amount and some random value,
-            # in case the TSD is down for a while.  delay at most
-            # approximately 10 minutes.
-            try_delay *= 1 + random.random()
-            if try_delay > 600:
-                try_delay *= 0.5
-            LOG.debug('SenderThread blocking %0.2f seconds', try_delay)
-            time.sleep(try_delay)
-
-            # Now actually try the connection.
-            self.pick_connection()
+            if not first:
+                self.backoff(try_delay)
+                # increase the try delay by some amount and some random
+                # value, in case the TSD is down for a while.  delay at most
+                # approximately 10 minutes.
+                try_delay *= 1 + random.random()
+                if try_delay > 600:
+                    try_delay *= 0.5
+            first = False
+
+            # Fail over to the standby connection if we have one, otherwise
+            # actually try the connection.
+            if not self.promote_standby():
+                self.connect()
+
+    def backoff(self, delay):
+        """Waits before trying to connect again."""
+        LOG.debug('SenderThread blocking %0.2f seconds', delay)
+        if self.spool is None and self.router is None:
+            time.sleep(delay)
+            return
+        # Don't let the data pile up in memory in the meantime, hand
+        # it over to the other TSDs or spool it.
+        deadline = time.time() + delay
+        while ALIVE:
+            if self.router is not None:
+                self.router.reroute(self)
+            if self.spool is not None:
+                self.spill()
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(1, remaining))
+
+    def resolve(self, hostport):
+        """Returns the (family, socktype, proto, sockaddr) of the addresses
+           of the given TSD, IPv6 and IPv4 ones interleaved, or an empty list
+           if we can't resolve its name."""
+        addresses = self.dns.resolve(hostport)
+        # Alternate address families, like happy eyeballs (RFC 8305) do, so
+        # a broken IPv6 route doesn't delay the IPv4 addresses too much.
+        families = {}
+        for address in addresses:
+            families.setdefault(address[0], []).append(address)
+        interleaved = []
+        while families:
+            for family in sorted(families):
+                interleaved.append(families[family].pop(0))
+                if not families[family]:
+                    del families[family]
+        return interleaved
+
+    def fallback_hosts(self, exclude):
+        """Returns the TSDs we may use other than the given one, the best
+           ones first."""
+        now = time.time()
+        hosts = [hostport for hostport in self.hosts
+                 if hostport != exclude and self.health[hostport].available(now)]
+        return sorted(hosts, key=lambda hostport:
+                      -self.health[hostport].weight(DEFAULT_TSD_LATENCY))
+
+    def connect(self):
+        """Connects to the TSD pick_connection() picks.  All its addresses
+           and then the ones of the other TSDs we may use are tried in
+           parallel, each one a little after the previous one, and the first
+           connection to succeed wins."""
+        self.pick_connection()
+        hosts = [(self.host, self.port)]
+        hosts.extend(self.fallback_hosts((self.host, self.port)))
+        candidates = []
+        for hostport in hosts:
+            addresses = self.resolve(hostport)
+            if not addresses:
+                LOG.error('Failed to resolve %s', hostport[0])
+                self.health[hostport].record_failure()
+            candidates.extend([(hostport,) + address
+                               for address in addresses])
+        if not candidates:
+            return
+        winner, errors = connect_race(candidates, CONNECT_TIMEOUT)
+        for hostport in hosts:
+            attempts = len([c for c in candidates if c[0] == hostport])
+            if attempts and len(errors.get(hostport, ())) == attempts:
+                LOG.error('Failed to connect to %s:%d: %s', hostport[0],
+                          hostport[1], errors[hostport][-1])
+                self.health[hostport].record_failure()
+        if winner is None:
+            LOG.error('Failed to connect to any TSD')
+            return
+        (self.host, self.port), self.tsd, seconds = winner
+        LOG.debug('Connection to %s:%d was successful', self.host, self.port)
+        self.health[(self.host, self.port)].record_connect(seconds)
+        self.last_healthy = time.time()
+        self.responses = ''
+        self.probe_sent = None
+        self.tsd.settimeout(CONNECT_TIMEOUT)
+        if self.tsd.family in (socket.AF_INET, socket.AF_INET6):
+            self.tune_socket(self.tsd)
+
+    def maintain_standby(self):
+        """Makes sure we have a connection to another TSD to fail over to,
+           or one in progress, without blocking."""
+        if self.standby is not None:
+            hostport, sock, started = self.standby
+            if hostport == (self.host, self.port):
+                # It became our connection to the TSD.
+                self.standby = None
+            elif started is not None:
+                _, writable, _ = select.select([], [sock], [], 0)
+                error = 0
+                if writable:
+                    error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if writable and not error:
+                    self.health[hostport].record_connect(time.time() - started)
+                    LOG.debug('Standby connection to %s:%d ready', *hostport)
+                    self.standby = (hostport, sock, None)
+                elif error or time.time() - started > CONNECT_TIMEOUT:
+                    LOG.warning('Standby connection to %s:%d failed: %s',
+                                hostport[0], hostport[1],
+                                os.strerror(error) if error else 'timed out')
+                    sock.close()
+                    self.standby = None
+                    self.health[hostport].record_failure()
+        if self.standby is not None:
+            return
+        hosts = self.fallback_hosts((self.host, self.port))
+        if not hosts:
+            return
+        for address in self.resolve(hosts[0]):
+            family, socktype, proto, sockaddr = address
             try:
-                addresses = socket.getaddrinfo(self.host, self.port,
-                                               socket.AF_UNSPEC,
-                                               socket.SOCK_STREAM, 0)
-            except socket.gaierror, e:
-                # Don't croak on transient DNS resolution issues.
-                if e[0] in (socket.EAI_AGAIN, socket.EAI_NONAME,
-                            socket.EAI_NODATA):
-                    LOG.debug('DNS resolution failure: %s: %s', self.host, e)
-                    continue
-                raise
-            for family, socktype, proto, canonname, sockaddr in addresses:
-                try:
-                    self.tsd = socket.socket(family, socktype, proto)
-                    self.tsd.settimeout(15)
-                    self.tsd.connect(sockaddr)
-                    # if we get here it connected
-                    LOG.debug('Connection to %s was successful'%(str(sockaddr)))
-                    break
-                except socket.error, msg:
-                    LOG.warning('Connection attempt failed to %s:%d: %s',
-                                self.host, self.port, msg)
-                self.tsd.close()
-                self.tsd = None
-            if not self.tsd:
-                LOG.error('Failed to connect to %s:%d', self.host, self.port)
-                self.blacklist_connection()
-
-    def add_tags_to_line(self, line):
-        for tag, value in self.tags:
-            if ' %s=' % tag not in line:
-                line += ' %s=%s' % (tag, value)
-        return line
+                sock = socket.socket(family, socktype, proto)
+            except socket.error:
+                continue
+            sock.setblocking(0)
+            error = sock.connect_ex(sockaddr)
+            if error in (0, errno.EINPROGRESS):
+                self.standby = (hosts[0], sock, time.time())
+                return
+            sock.close()
 
-    def send_data(self):
-        """Sends outstanding data in self.sendq to the TSD in one operation."""
+    def promote_standby(self):
+        """Makes the standby connection our connection to the TSD if it's
+           ready.  Returns false if there isn't any."""
+        if self.standby is None:
+            return False
+        hostport, sock, started = self.standby
+        self.standby = None
+        readable, _, _ = select.select([sock], [], [], 0)
+        if (started is not None or readable
+            or not self.health[hostport].available(time.time())):
+            # Not connected yet, closed by the TSD in the meantime, or
+            # blacklisted since.
+            sock.close()
+            return False
+        LOG.info('Failing over to the standby connection to %s:%d',
+                 hostport[0], hostport[1])
+        self.host, self.port = hostport
+        self.tsd = sock
+        self.tsd.settimeout(CONNECT_TIMEOUT)
+        if self.tsd.family in (socket.AF_INET, socket.AF_INET6):
+            self.tune_socket(self.tsd)
+        self.responses = ''
+        self.probe_sent = None
+        self.last_verify = 0  # Make sure it works.
+        self.last_healthy = 0
+        return True
 
-        # construct the output string
-        out = ''
+    def format_datapoint(self, dp):
+        """Formats the given Datapoint into a line, adding our global tags
+           unless the datapoint already has a tag of the same name."""
+        tags = self.tag_sections.get(dp.tags)
+        if tags is None:
+            tags = (self.tag_sections.get_old(dp.tags)
+                    or self.tag_section(dp.tags))
+        return '%s %d %s%s' % (dp.metric, dp.timestamp, dp.value, tags)
+
+    def tag_section(self, tags):
+        """Formats the given tags followed by the global tags they don't
+           override, and remembers the result for the next data points with
+           the same tags."""
+        if not tags:
+            return self.tags_suffix
+        section = format_tags(tags)
+        if self.tags:
+            names = set(tag.split('=', 1)[0] for tag in tags.split(' '))
+            if names.isdisjoint(self.tag_names):
+                section += self.tags_suffix
+            else:
+                section += ''.join([' %s=%s' % tag for tag in self.tags
+                                    if tag[0] not in names])
+        return self.tag_sections.add(tags, section)
 
-        # in case of logging we use less efficient variant
-        if LOG.level == logging.DEBUG:
-            for line in self.sendq:
-                line = "put %s" % self.add_tags_to_line(line)
-                out += line + "\n"
-                LOG.debug('SENDING: %s', line)
-        else:
-            out = "".join("put %s\n" % self.add_tags_to_line(line) for line in self.sendq)
+    def enqueue(self, dps):
+        """Adds the given Datapoints to the batch we're about to send."""
+        if not dps:
+            return
+        if not self.sendq:
+            self.batch_start = time.time()
+        lines = [self.format_datapoint(dp) for dp in dps]
+        self.sendq.extend(lines)
+        self.sendq_sources.extend([dp.collector for dp in dps])
+        self.sendq_bytes += sum(len(line) for line in lines)
+
+    def clear_sendq(self):
+        """Forgets about the batch we were about to send."""
+        self.sendq = []
+        self.sendq_sources = []
+        self.sendq_bytes = 0
+
+    def spill(self):
+        """Moves the data waiting to be sent, ours and the reader's, to the
+           spool."""
+        self.enqueue(self.readerq.get_batch(0))
+        if self.sendq:
+            self.spool.write(self.sendq)
+            self.clear_sendq()
+
+    def replay_delay(self):
+        """Returns how many seconds to wait before the replay rate limits
+           let us send more data from the spool."""
+        return max([0] + [bucket.delay() for bucket in self.replay_limits])
+
+    def replay_spool(self):
+        """Sends the oldest batch of data from the spool, as much of it as
+           the replay rate limits allow.  If that fails, the batch goes back
+           to the front of the spool."""
+        if self.replay_delay() > 0:
+            return
+        max_lines = MAX_SENDQ_SIZE
+        if self.replay_points is not None:
+            max_lines = min(max_lines, int(self.replay_points.tokens))
+        lines = self.spool.read(max_lines)
+        if not lines:
+            return
+        if not self.send_lines(lines):
+            self.spool.unread(lines)
+            return
+        size = sum(len(line) for line in lines) + len('put \n') * len(lines)
+        # The bytes limit may go into debt, which delays the next batch.
+        if self.replay_points is not None:
+            self.replay_points.consume(len(lines))
+        if self.replay_bytes is not None:
+            self.replay_bytes.consume(size)
+        self.lines_replayed += len(lines)
+        self.bytes_replayed += size
 
-        if not out:
+    def send_data(self):
+        """Sends outstanding data in self.sendq to the TSD in one operation.
+           If that fails, the data the TSD didn't get goes to the spool if we
+           have one, or is kept in self.sendq to try again next time."""
+        if not self.sendq:
             LOG.debug('send_data no data?')
             return
+        if self.send_lines(self.sendq, self.sendq_sources):
+            self.clear_sendq()
+            return
+        del self.sendq_sources[:len(self.sendq_sources) - len(self.sendq)]
+        self.sendq_bytes = sum(len(line) for line in self.sendq)
+        if self.spool is not None:
+            self.spool.write(self.sendq)
+            self.clear_sendq()
+
+    def send_lines(self, lines, sources=None):
+        """Sends the given lines to the TSD in one operation.  Returns false
+           if that failed, in which case the lines the TSD got are removed
+           from `lines'.  The optional sources are the names of the
+           collectors the lines came from."""
+        if self.http and not self.dryrun:
+            return self.send_http(lines, sources)
 
-        # try sending our data.  if an exception occurs, just error and
-        # try sending again next time.
+        # in case of logging we use less efficient variant
+        if LOG.level == logging.DEBUG:
+            for line in lines:
+                LOG.debug('SENDING: put %s', line)
+
+        # try sending our data, a chunk of lines at a time so we never build
+        # one giant string.  if an exception occurs, just error and try
+        # sending what the TSD didn't get again next time.
+        self.written = 0
         try:
+            start = time.time()
+            for i in xrange(0, len(lines), SEND_CHUNK_LINES):
+                out = ''.join(['put %s\n' % line
+                               for line in lines[i:i + SEND_CHUNK_LINES]])
+                if self.dryrun:
+                    sys.stdout.write(out)
+                else:
+                    self.write_telnet(out)
             if self.dryrun:
-                print out
+                sys.stdout.flush()
             else:
-                self.tsd.sendall(out)
-            self.sendq = []
+                self.record_send(start)
+            return True
         except socket.error, msg:
             LOG.error('failed to send data: %s', msg)
+            delivered = self.delivered_lines(lines, msg)
+            if delivered:
+                LOG.info('%s:%d got %d of the %d lines', self.host, self.port,
+                         delivered, len(lines))
+                del lines[:delivered]
             try:
+                # Reset the connection rather than let the kernel keep
+                # sending what the TSD didn't acknowledge, since we'll send
+                # it again.
+                self.tsd.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                    struct.pack('ii', 1, 0))
                 self.tsd.close()
             except socket.error:
                 pass
             self.tsd = None
             self.blacklist_connection()
+            return False
 
-        # FIXME: we should be reading the result at some point to drain
-        # the packets out of the kernel's queue
+    def delivered_lines(self, lines, error):
+        """Returns how many of the given lines, which we failed to write
+           in full, the TSD acknowledged."""
+        if SIOCOUTQ is None or error.errno in (errno.ECONNRESET, errno.EPIPE):
+            # The kernel has thrown away what the TSD didn't acknowledge, we
+            # can't tell how much that was.
+            return 0
+        try:
+            unacked = struct.unpack('i', fcntl.ioctl(self.tsd, SIOCOUTQ,
+                                                     '\0' * 4))[0]
+        except (IOError, socket.error):
+            return 0
+        acked = self.written - unacked
+        delivered = 0
+        for line in lines:
+            acked -= len(line) + len('put \n')
+            if acked < 0:
+                break
+            delivered += 1
+        return delivered
+
+    def write_telnet(self, out):
+        """Writes the given data to the TSD as fast as it takes it, and
+           reads what it replies meanwhile, so that its error messages don't
+           fill up the socket's buffers until the connection wedges.  Raises
+           a socket.error if the TSD doesn't make any progress for as long as
+           the socket's timeout.  self.written counts the bytes written."""
+        view = memoryview(out)
+        sent = 0
+        timeout = self.tsd.gettimeout()
+        while sent < len(out):
+            readable, writable, _ = select.select([self.tsd], [self.tsd], [],
+                                                  timeout)
+            if not readable and not writable:
+                raise socket.timeout('timed out while sending data')
+            if readable:
+                self.read_responses()
+            if writable:
+                # The socket is ready, this doesn't block.
+                written = self.tsd.send(view[sent:])
+                sent += written
+                self.written += written
+        self.read_responses()
+
+    def read_responses(self):
+        """Reads and counts whatever error messages the TSD sent us, without
+           blocking."""
+        while select.select([self.tsd], [], [], 0)[0]:
+            data = self.tsd.recv(READ_BUFFER_SIZE)
+            if not data:
+                raise socket.error('connection closed by the TSD')
+            self.handle_responses(data)
+
+    def handle_responses(self, data):
+        """Counts the error messages (e.g. "put: illegal argument: ...") in
+           what the TSD sent us.  Anything else is the answer to our
+           `version' probe."""
+        lines = (self.responses + data).split('\n')
+        self.responses = lines.pop()[-READ_BUFFER_SIZE:]
+        errors = [line for line in lines if line.startswith('put:')]
+        if self.probe_sent is not None and len(errors) < len(lines):
+            self.record_send(self.probe_sent)
+            self.probe_sent = None
+        if errors:
+            self.tsd_errors += len(errors)
+            LOG.warning('TSD %s:%d reported %d errors, e.g.: %s',
+                        self.host, self.port, len(errors), errors[0])
+
+    def tune_socket(self, sock):
+        """Sets the options of a new TCP socket to a TSD."""
+        # We write whole batches at once, don't hold back their last packet.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.send_buffer_size:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                            self.send_buffer_size)
+
+    def http_connection(self):
+        """Returns an HTTP connection that goes through our socket to the
+           TSD, so it gets kept alive from one request to the next."""
+        if self.http_conn is None or self.http_conn.sock is not self.tsd:
+            self.http_conn = httplib.HTTPConnection(self.host, self.port)
+            self.http_conn.sock = self.tsd
+        return self.http_conn
+
+    def http_request(self, method, url, body=None, headers={}):
+        """Sends an HTTP request to the TSD and returns the response, whose
+           body has already been read, or None if that failed."""
+        try:
+            conn = self.http_connection()
+            conn.request(method, url, body, headers)
+            response = conn.getresponse()
+            response.body = response.read()
+        except (httplib.HTTPException, socket.error), e:
+            LOG.error('HTTP request to %s:%d failed: %s', self.host, self.port,
+                      e)
+            try:
+                self.tsd.close()
+            except socket.error:
+                pass
+            self.tsd = None
+            self.blacklist_connection()
+            return None
+        if conn.sock is None:
+            # The TSD closed the connection, we'll reconnect next time.
+            self.tsd = None
+        return response
+
+    def send_http(self, lines, sources=None):
+        """POSTs the given lines to the TSD's /api/put, and counts the data
+           points it rejected against the collectors they came from.
+           Returns false if that failed, in which case the lines should be
+           sent again later.  Rejected data points aren't."""
+        objects = [format_json(line) for line in lines]
+        if None in objects:
+            # Don't let a single line get the whole batch rejected.
+            keep = [i for i, obj in enumerate(objects) if obj is not None]
+            for i in xrange(len(lines)):
+                if objects[i] is None:
+                    LOG.error('Not sending invalid UTF-8: %r', lines[i])
+                    self.count_rejected_line(sources and sources[i])
+            lines = [lines[i] for i in keep]
+            objects = [objects[i] for i in keep]
+            if sources:
+                sources = [sources[i] for i in keep]
+            if not lines:
+                return True
+        body = '[%s]' % ','.join(objects)
+        if LOG.level == logging.DEBUG:
+            LOG.debug('SENDING: %s', body)
+        headers = {'Content-Type': 'application/json'}
+        if self.http_compress:
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            headers['Content-Encoding'] = 'gzip'
+        start = time.time()
+        response = self.http_request('POST', '/api/put?details', body,
+                                     headers)
+        if response is None:
+            return False
+        if response.status in (200, 204, 400):
+            self.record_send(start)
+        if response.status in (200, 204):
+            return True
+        if response.status != 400:
+            LOG.error('TSD %s:%d failed to store the data points: %d %s: %s',
+                      self.host, self.port, response.status, response.reason,
+                      response.body[:1024])
+            if self.tsd is not None:
+                self.tsd.close()
+                self.tsd = None
+            self.blacklist_connection()
+            return False
+        return self.count_rejected(response.body, lines, sources)
+
+    def count_rejected_line(self, source):
+        """Counts a data point rejected by the TSD against the collector it
+           came from, if known."""
+        self.lines_rejected += 1
+        col = COLLECTORS.get(source)
+        if col is not None:
+            col.lines_rejected += 1
+
+    def count_rejected(self, details, lines, sources):
+        """Counts the data points that /api/put?details says it rejected.
+           Returns false if the TSD didn't say, i.e. it rejected the request
+           as a whole and none of the data points were stored."""
+        try:
+            parsed = json.loads(details)
+            failed = int(parsed['failed'])
+            int(parsed['success'])
+            errors = parsed.get('errors') or []
+        except (ValueError, KeyError, TypeError, AttributeError):
+            LOG.error('TSD %s:%d rejected the data points: %s', self.host,
+                      self.port, details[:1024])
+            return False
+        self.lines_rejected += failed
+        if errors:
+            LOG.warning('TSD rejected %d data points, e.g. %s: %s', failed,
+                        errors[0].get('datapoint'), errors[0].get('error'))
+        if not sources:
+            return True
+        index = {}  # (metric, timestamp) -> collector
+        for line, source in zip(lines, sources):
+            if source is not None:
+                metric, timestamp = line.split(None, 2)[:2]
+                index[(metric, timestamp)] = source
+        for error in errors:
+            dp = error.get('datapoint') or {}
+            source = index.get((dp.get('metric'), str(dp.get('timestamp'))))
+            col = COLLECTORS.get(source)
+            if col is not None:
+                col.lines_rejected += 1
+        return True
+
+
+def ewma(average, value):
+    """Returns the exponentially weighted moving average `average' updated
+       with a new value."""
+    if average is None:
+        return value
+    return average + EWMA_WEIGHT * (value - average)
+
+
+def connect_race(candidates, timeout, delay=CONNECT_RACE_DELAY):
+    """Connects to the first of the given addresses that accepts, trying them
+       in parallel, each one `delay' seconds after the previous one or as
+       soon as the previous one failed, as happy eyeballs (RFC 8305) do.
+
+    Args:
+      candidates: A list of (key, family, socktype, proto, sockaddr) tuples,
+        the preferred ones first.
+      timeout: How many seconds to give up after.
+      delay: How many seconds to wait for an attempt before starting the
+        next one in parallel.
+    Returns: A (key, socket, seconds) tuple for the winner, or None, and a
+      dictionary of the errors of the attempts that failed, as lists keyed by
+      the keys of their candidates.
+    """
+    start = time.time()
+    deadline = start + timeout
+    pending = {}  # socket -> (key, when we started connecting)
+    errors = {}
+    candidates = deque(candidates)
+    next_attempt = start
+    try:
+        while True:
+            now = time.time()
+            if candidates and (now >= next_attempt or not pending):
+                key, family, socktype, proto, sockaddr = candidates.popleft()
+                try:
+                    sock = socket.socket(family, socktype, proto)
+                except socket.error, e:
+                    errors.setdefault(key, []).append(str(e))
+                    continue
+                sock.setblocking(0)
+                error = sock.connect_ex(sockaddr)
+                if error in (0, errno.EINPROGRESS):
+                    pending[sock] = (key, now)
+                    next_attempt = now + delay
+                else:
+                    sock.close()
+                    errors.setdefault(key, []).append(os.strerror(error))
+                continue
+            if not pending or now >= deadline:
+                return None, errors
+            wait = deadline - now
+            if candidates:
+                wait = min(wait, next_attempt - now)
+            _, writable, _ = select.select([], pending.keys(), [], wait)
+            for sock in writable:
+                key, started = pending.pop(sock)
+                error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if not error:
+                    sock.setblocking(1)
+                    return (key, sock, time.time() - started), errors
+                sock.close()
+                errors.setdefault(key, []).append(os.strerror(error))
+                next_attempt = now  # Don't wait to try the next one.
+    finally:
+        for sock in pending:
+            sock.close()
+
+
+class TSDHealth(object):
+    """What we know of how well a TSD is doing: moving averages of how long it
+       takes to connect to it and to send it data, and of how often that
+       fails, and a circuit breaker.
+
+       After a failure, the breaker opens: the TSD is left alone for a delay
+       which doubles with every failure in a row.  Once the delay is over,
+       the breaker is half-open: we may try the TSD once more.  The breaker
+       closes again on the first success."""
+
+    def __init__(self):
+        self.connect_time = None  # Moving average, in seconds.
+        self.send_time = None     # Moving average, in seconds.
+        self.error_rate = 0.0     # Moving average of 1 per failure, 0 else.
+        self.failures = 0         # How many failures in a row.
+        self.retry_at = 0         # When the breaker lets us try again.
+
+    def available(self, now):
+        """Returns true unless the breaker is open."""
+        return self.retry_at <= now
+
+    def latency(self):
+        """Returns how many seconds it typically takes the TSD to take our
+           data, or None if we don't know yet."""
+        if self.connect_time is None and self.send_time is None:
+            return None
+        return (self.connect_time or 0) + (self.send_time or 0)
+
+    def weight(self, default_latency):
+        """Returns how much we want to use this TSD, the higher the better.
+
+        Args:
+          default_latency: The latency to assume if we don't know it.
+        """
+        latency = self.latency()
+        if latency is None:
+            latency = default_latency
+        latency = max(latency, MIN_TSD_LATENCY)
+        return 1 / (latency * (1 + ERROR_RATE_PENALTY * self.error_rate))
+
+    def record_connect(self, seconds):
+        self.connect_time = ewma(self.connect_time, seconds)
+
+    def record_send(self, seconds):
+        self.send_time = ewma(self.send_time, seconds)
+        self.error_rate = ewma(self.error_rate, 0.0)
+        self.failures = 0
+        self.retry_at = 0
+
+    def record_failure(self):
+        self.error_rate = ewma(self.error_rate, 1.0)
+        self.failures += 1
+        self.retry_at = time.time() + min(
+            BREAKER_MIN_DELAY * 2 ** (self.failures - 1), BREAKER_MAX_DELAY)
+
+
+class DNSCache(object):
+    """Remembers the addresses of the TSDs for a while, so that reconnecting
+       doesn't wait on the DNS.
+
+       Once an answer is older than the TTL, we keep using it but resolve the
+       name again in the background.  If that fails transiently, the old
+       answer is kept and we try again after the negative TTL.  Names that
+       don't resolve are remembered for the negative TTL."""
+
+    def __init__(self, ttl=DEFAULT_DNS_TTL, negative_ttl=DEFAULT_DNS_NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.entries = {}         # (host, port) -> (addresses, expiry time).
+        self.refreshing = set()   # The (host, port) being resolved again.
+        self.lookups = 0
+        self.misses = 0
+
+    def resolve(self, hostport):
+        """Returns the (family, socktype, proto, sockaddr) of the addresses of
+           the given (host, port), or an empty list if it doesn't resolve.
+           Only blocks if we know nothing recent about it."""
+        now = time.time()
+        with self.lock:
+            self.lookups += 1
+            entry = self.entries.get(hostport)
+            if entry is not None and self.ttl > 0:
+                addresses, expiry = entry
+                if expiry <= now and hostport not in self.refreshing:
+                    self.refreshing.add(hostport)
+                    thread = threading.Thread(target=self.refresh,
+                                              args=(hostport,))
+                    thread.setDaemon(True)
+                    thread.start()
+                # Rotate the addresses, so round-robin DNS still spreads the
+                # load when --reconnect-interval is used.
+                if len(addresses) > 1:
+                    addresses = addresses[1:] + addresses[:1]
+                    self.entries[hostport] = (addresses, expiry)
+                return addresses
+            self.misses += 1
+        return self.store(hostport, self.getaddrinfo(hostport), None)
+
+    def refresh(self, hostport):
+        """Resolves the given (host, port) again, in the background."""
+        try:
+            try:
+                addresses = self.getaddrinfo(hostport)
+            except socket.gaierror, e:
+                LOG.error('DNS resolution failure: %s: %s', hostport[0], e)
+                addresses = None
+            with self.lock:
+                stale = self.entries.get(hostport, ((), 0))[0]
+            self.store(hostport, addresses, stale)
+        finally:
+            with self.lock:
+                self.refreshing.discard(hostport)
+
+    def store(self, hostport, addresses, stale):
+        """Caches and returns the addresses of the given (host, port).
+
+        Args:
+          addresses: What we resolved, an empty list if the name doesn't
+            resolve, or None if the resolution failed transiently.
+          stale: The addresses we knew before, if any.
+        """
+        if addresses is None:
+            # Keep what we had, if anything, and try again soon.
+            addresses = stale or []
+            ttl = self.negative_ttl
+        elif addresses:
+            ttl = self.ttl
+        else:
+            ttl = self.negative_ttl
+        if self.ttl > 0:
+            with self.lock:
+                self.entries[hostport] = (addresses, time.time() + ttl)
+        return addresses
+
+    def getaddrinfo(self, hostport):
+        """Resolves the given (host, port).  Returns an empty list if the
+           name doesn't resolve, or None if the DNS is having transient
+           issues."""
+        host, port = hostport
+        try:
+            addresses = socket.getaddrinfo(host, port, socket.AF_UNSPEC,
+                                           socket.SOCK_STREAM, 0)
+        except socket.gaierror, e:
+            if e[0] == socket.EAI_AGAIN:
+                LOG.debug('DNS resolution failure: %s: %s', host, e)
+                return None
+            if e[0] in (socket.EAI_NONAME, socket.EAI_NODATA):
+                LOG.debug('DNS resolution failure: %s: %s', host, e)
+                return []
+            raise
+        return [(family, socktype, proto, sockaddr)
+                for family, socktype, proto, _, sockaddr in addresses]
+
+
+class HashRing(object):
+    """A consistent hash ring, to spread keys over nodes so that when a node
+       goes away, only the keys it had move to the other nodes."""
+
+    def __init__(self, nodes, replicas=HASH_RING_REPLICAS):
+        """Constructor.
+
+        Args:
+          nodes: A list of (host, port) pairs.
+          replicas: How many points each node gets on the ring.  The more,
+            the more evenly the keys are spread.
+        """
+        points = []
+        for host, port in nodes:
+            for i in xrange(replicas):
+                digest = hashlib.md5('%s:%d-%d' % (host, port, i)).hexdigest()
+                points.append((int(digest[:8], 16), (host, port)))
+        points.sort()
+        self.hashes = [point[0] for point in points]
+        self.nodes = [point[1] for point in points]
+
+    def lookup(self, key, healthy=None):
+        """Returns the node the given key goes to.
+
+        Args:
+          key: A string.
+          healthy: If given, a set of nodes.  The key goes to the first of
+            these after its point on the ring, unless the set is empty.
+        """
+        i = bisect.bisect(self.hashes, zlib.crc32(key) & 0xffffffff)
+        i %= len(self.nodes)
+        if healthy:
+            for j in xrange(i, i + len(self.nodes)):
+                node = self.nodes[j % len(self.nodes)]
+                if node in healthy:
+                    return node
+        return self.nodes[i]
+
+
+class ShardRouter(threading.Thread):
+    """Spreads the data points of the reader over several SenderThreads, one
+       per TSD, so that each time series always goes to the same TSD as long
+       as it's healthy."""
+
+    def __init__(self, reader, senders):
+        """Constructor.
+
+        Args:
+          reader: A reference to a ReaderThread instance.
+          senders: A list of SenderThreads, each of them with its own queue
+            and a single TSD in its list of hosts.
+        """
+        super(ShardRouter, self).__init__()
+        self.reader = reader
+        self.senders = dict((sender.hosts[0], sender) for sender in senders)
+        self.ring = HashRing(sorted(self.senders))
+        # Data points dropped because the queue of their sender was full.
+        # route() is also called by the senders, see reroute().
+        self.lines_dropped = 0
+        self.lock = threading.Lock()
+        for sender in senders:
+            sender.router = self
+
+    def run(self):
+        """Main loop.  Routes the data points as they come, and when we're
+           exiting, whatever is left in the reader queue so that the senders
+           can spool it."""
+        while ALIVE:
+            try:
+                self.route(self.reader.readerq.get_batch(1))
+            except (ArithmeticError, EnvironmentError, LookupError,
+                    ValueError):
+                LOG.exception('Uncaught exception in ShardRouter, ignoring')
+                time.sleep(1)
+            except:
+                LOG.exception('Uncaught exception in ShardRouter, going to exit')
+                shutdown()
+                raise
+        self.route(self.reader.readerq.get_batch(0))
+
+    def route(self, dps):
+        """Hands over each of the given Datapoints to the SenderThread of the
+           TSD its time series goes to."""
+        if not dps:
+            return
+        healthy = set(hostport for hostport, sender in self.senders.iteritems()
+                      if sender.healthy())
+        shards = {}
+        for dp in dps:
+            hostport = self.ring.lookup(dp.metric + ' ' + dp.tags, healthy)
+            shards.setdefault(hostport, []).append(dp)
+        for hostport, shard in shards.iteritems():
+            dropped = self.senders[hostport].readerq.nput_batch(shard)
+            if dropped:
+                with self.lock:
+                    self.lines_dropped += dropped
+
+    def reroute(self, sender):
+        """Routes again whatever is waiting in the queue of a SenderThread
+           that lost its TSD."""
+        self.route(sender.readerq.get_batch(0))
 
 
 def setup_logging(logfile=DEFAULT_LOG, max_bytes=None, backup_count=None):
@@ -767,6 +3227,22 @@ def parse_cmdline(argv):
                       help='Number of seconds after which to remove cached '
                            'values of old data points to save memory. '
                            'default=%default')
+    parser.add_option('--dedup-max-series', dest='dedup_max_series', type='int',
+                      default=0, metavar='SERIES',
+                      help='Maximum number of time series, across all '
+                           'collectors, to keep track of for deduplication. '
+                           'The least recently seen ones are forgotten first. '
+                           'Use zero for no limit. default=%default')
+    parser.add_option('--dedup-state-file', dest='dedup_state_file',
+                      default=None, metavar='FILE',
+                      help='File where to save the dedup state when exiting '
+                           'and periodically, and to restore it from on '
+                           'startup, to avoid resending every time series '
+                           'after a restart.')
+    parser.add_option('--dedup-state-interval', dest='dedup_state_interval',
+                      type='int', default=600, metavar='SECONDS',
+                      help='Number of seconds between two saves of the '
+                           'dedup state. default=%default')
     parser.add_option('--allowed-inactivity-time', dest='allowed_inactivity_time', type='int',
                       default=ALLOWED_INACTIVITY_TIME, metavar='ALLOWEDINACTIVITYTIME',
                       help='How long to wait for datapoints before assuming '
@@ -775,6 +3251,26 @@ def parse_cmdline(argv):
     parser.add_option('--remove-inactive-collectors', dest='remove_inactive_collectors', action='store_true',
                       default=False, help='Remove collectors not sending data '
                                           'in the max allowed inactivity interval')
+    parser.add_option('--in-process', dest='in_process', default='',
+                      metavar='NAMES',
+                      help='Comma-separated names of Python collectors (e.g. '
+                           'ifstat.py) to run in threads of tcollector rather '
+                           'than in processes of their own, or "all".  Only '
+                           'those whose shebang line names the interpreter '
+                           'of tcollector are, the others are still run '
+                           'with their own interpreter.  They '
+                           'then share the privileges of tcollector, and '
+                           'must not use signals.  One that is blocked in a '
+                           'system call can\'t be killed: it\'s left running '
+                           'and considered dead, so it may be run again.')
+    parser.add_option('--fork-server', dest='fork_server', action='store_true',
+                      default=False,
+                      help='Spawn the Python collectors that run at an '
+                           'interval from a process which has already '
+                           'imported the common modules, instead of '
+                           'starting a new interpreter every time.  Only '
+                           'those whose shebang line names the interpreter '
+                           'of tcollector are forked this way.')
     parser.add_option('--max-bytes', dest='max_bytes', type='int',
                       default=64 * 1024 * 1024,
                       help='Maximum bytes per a logfile.')
@@ -789,14 +3285,123 @@ def parse_cmdline(argv):
                            'the TSD hostname reconnects itself. This is useful'
                            'when the hostname is a multiple A record (RRDNS).'
                            )
+    parser.add_option('--pipe-buffer-size', dest='pipe_buffer_size',
+                      type='int', default=0, metavar='BYTES',
+                      help='Size of the pipe buffer of the collectors\' '
+                           'stdout, so bursty collectors don\'t block while '
+                           'writing.  Linux only, limited by '
+                           '/proc/sys/fs/pipe-max-size.  Use zero to keep '
+                           'the kernel default. default=%default')
+    parser.add_option('--spool-dir', dest='spool_dir', default=None,
+                      metavar='DIR',
+                      help='Directory where to spool the data points that '
+                           'can\'t be sent while the TSDs are unreachable, '
+                           'to send them later.  Disabled by default.')
+    parser.add_option('--spool-max-bytes', dest='spool_max_bytes', type='int',
+                      default=1024 * 1024 * 1024, metavar='BYTES',
+                      help='Maximum size of the spool on disk.  The oldest '
+                           'data points are dropped past that. '
+                           'default=%default')
+    parser.add_option('--spool-compress', dest='spool_compress',
+                      action='store_true', default=False,
+                      help='Compress the spool with gzip.')
+    parser.add_option('--spool-replay-points', dest='spool_replay_points',
+                      type='int', default=0, metavar='POINTS',
+                      help='Maximum number of spooled data points to send '
+                           'per second once the TSDs are back, on top of the '
+                           'new ones.  Use zero for no limit. '
+                           'default=%default')
+    parser.add_option('--spool-replay-bytes', dest='spool_replay_bytes',
+                      type='int', default=0, metavar='BYTES',
+                      help='Maximum number of bytes of spooled data to send '
+                           'per second once the TSDs are back, on top of the '
+                           'new data.  Use zero for no limit. '
+                           'default=%default')
+    parser.add_option('--batch-max-lines', dest='batch_max_lines',
+                      type='int', default=MAX_SENDQ_SIZE, metavar='LINES',
+                      help='Send the data points to the TSD as soon as we '
+                           'have that many. default=%default')
+    parser.add_option('--batch-max-bytes', dest='batch_max_bytes',
+                      type='int', default=MAX_BATCH_BYTES, metavar='BYTES',
+                      help='Send the data points to the TSD as soon as we '
+                           'have that many bytes of them. default=%default')
+    parser.add_option('--batch-max-delay', dest='batch_max_delay',
+                      type='int', default=1000, metavar='MILLISECONDS',
+                      help='Send the data points to the TSD at the latest '
+                           'that long after we got the first one of a batch. '
+                           'default=%default')
+    parser.add_option('--http', dest='http', action='store_true',
+                      default=False,
+                      help='Send the data points to the HTTP API of the TSD '
+                           '(/api/put) instead of using the telnet-style '
+                           'protocol, to find out about rejected ones.')
+    parser.add_option('--http-compress', dest='http_compress',
+                      action='store_true', default=False,
+                      help='Gzip the data points sent to the HTTP API.')
+    parser.add_option('--send-buffer-size', dest='send_buffer_size',
+                      type='int', default=0, metavar='BYTES',
+                      help='Size of the send buffer of the connections to '
+                           'the TSD.  Use zero to let the kernel tune it. '
+                           'default=%default')
+    parser.add_option('--standby', dest='standby', action='store_true',
+                      default=False,
+                      help='Keep a connection to another TSD of '
+                           '--hosts-list ready, to fail over to it right '
+                           'away.')
+    parser.add_option('--shard', dest='shard', action='store_true',
+                      default=False,
+                      help='Send to all the TSDs of --hosts-list at once, '
+                           'each time series always to the same TSD, instead '
+                           'of to only one of them at a time.  The stats of '
+                           'the sender and spool of each TSD are tagged with '
+                           'tsd=<host>-<port>.')
+    parser.add_option('--dns-ttl', dest='dns_ttl', type='int',
+                      default=DEFAULT_DNS_TTL, metavar='SECONDS',
+                      help='How long to use the addresses of the TSDs before '
+                           'resolving their names again, in the background.  '
+                           'Use zero to resolve them on every connection.  '
+                           'default=%default')
+    parser.add_option('--dns-negative-ttl', dest='dns_negative_ttl',
+                      type='int', default=DEFAULT_DNS_NEGATIVE_TTL,
+                      metavar='SECONDS',
+                      help='How long to remember that the name of a TSD '
+                           'failed to resolve.  default=%default')
     (options, args) = parser.parse_args(args=argv[1:])
     if options.dedupinterval < 0:
         parser.error('--dedup-interval must be at least 0 seconds')
     if options.evictinterval <= options.dedupinterval:
         parser.error('--evict-interval must be strictly greater than '
                      '--dedup-interval')
+    if options.dedup_max_series < 0:
+        parser.error('--dedup-max-series must be at least 0')
+    if options.dedup_state_interval <= 0:
+        parser.error('--dedup-state-interval must be at least 1 second')
     if options.reconnectinterval < 0:
         parser.error('--reconnect-interval must be at least 0 seconds')
+    if options.pipe_buffer_size < 0:
+        parser.error('--pipe-buffer-size must be at least 0 bytes')
+    if options.spool_max_bytes <= 0:
+        parser.error('--spool-max-bytes must be at least 1 byte')
+    if options.spool_replay_points < 0:
+        parser.error('--spool-replay-points must be at least 0')
+    if options.spool_replay_bytes < 0:
+        parser.error('--spool-replay-bytes must be at least 0')
+    if options.batch_max_lines <= 0:
+        parser.error('--batch-max-lines must be at least 1')
+    if options.batch_max_bytes <= 0:
+        parser.error('--batch-max-bytes must be at least 1')
+    if options.batch_max_delay < 0:
+        parser.error('--batch-max-delay must be at least 0 milliseconds')
+    if options.send_buffer_size < 0:
+        parser.error('--send-buffer-size must be at least 0 bytes')
+    if options.dns_ttl < 0:
+        parser.error('--dns-ttl must be at least 0 seconds')
+    if options.dns_negative_ttl < 0:
+        parser.error('--dns-negative-ttl must be at least 0 seconds')
+    options.in_process = set(name for name in options.in_process.split(',')
+                             if name)
+    if options.http_compress and not options.http:
+        parser.error('--http-compress requires --http')
     # We cannot write to stdout when we're a daemon.
     if (options.daemonize or options.max_bytes) and not options.backup_count:
         options.backup_count = 1
@@ -840,11 +3445,15 @@ def setup_python_path(collector_dir):
     pythonpath += mydir
     os.environ['PYTHONPATH'] = pythonpath
     LOG.debug('Set PYTHONPATH to %r', pythonpath)
+    # And for the collectors we run in-process.
+    if mydir not in sys.path:
+        sys.path.append(mydir)
 
 
 def main(argv):
     """The main tcollector entry point and loop."""
 
+    global POLLER, FORK_SERVER
     options, args = parse_cmdline(argv)
     if options.daemonize:
         daemonize()
@@ -879,14 +3488,39 @@ def main(argv):
 
     setup_python_path(options.cdir)
 
+    # The fork server must be forked before we start any thread.
+    if options.fork_server and not options.stdin:
+        try:
+            FORK_SERVER = ForkServer()
+            LOG.info('Fork server started (pid=%d), each Python interval '
+                     'collector run will save about %dms of CPU',
+                     FORK_SERVER.pid, FORK_SERVER.cpu_saved * 1000)
+        except EnvironmentError, e:
+            LOG.error('Failed to start the fork server: %s', e)
+
     # gracefully handle death for normal termination paths and abnormal
     atexit.register(shutdown)
     for sig in (signal.SIGTERM, signal.SIGINT):
         signal.signal(sig, shutdown_signal)
 
+    # stdin is read with blocking reads, there is nothing to wait for then
+    if not options.stdin and hasattr(select, 'epoll'):
+        POLLER = CollectorPoller()
+
     # at this point we're ready to start processing, so start the ReaderThread
     # so we can have it running and pulling in data for us
-    reader = ReaderThread(options.dedupinterval, options.evictinterval)
+    if options.dedup_state_file and options.dedupinterval != 0:
+        try:
+            loaded = load_dedup_state(options.dedup_state_file,
+                                      int(time.time()) - options.evictinterval)
+            LOG.info('Restored %d dedup entries from %s',
+                     loaded, options.dedup_state_file)
+        except (EOFError, IOError, OSError, ValueError), e:
+            LOG.error('Failed to restore the dedup state from %s: %s',
+                      options.dedup_state_file, e)
+    reader = ReaderThread(options.dedupinterval, options.evictinterval,
+                          options.dedup_max_series, options.dedup_state_file,
+                          options.dedup_state_interval)
     reader.start()
 
     # prepare list of (host, port) of TSDs given on CLI
@@ -907,10 +3541,52 @@ def main(argv):
         if options.host != "localhost" or options.port != DEFAULT_PORT:
             options.hosts.append((options.host, options.port))
 
+    # All the senders share what we know of the DNS.
+    dns = DNSCache(options.dns_ttl, options.dns_negative_ttl)
+
+    def make_sender(hosts, self_report_stats, spool_dir, spool_max_bytes,
+                    queue=None, shared_stats=True, stats_tags=''):
+        spool = None
+        if spool_dir:
+            spool = DiskSpool(spool_dir, spool_max_bytes,
+                              options.spool_compress)
+            if spool.bytes:
+                LOG.info('%d bytes of spooled data to send from %s',
+                         spool.bytes, spool_dir)
+        return SenderThread(reader, options.dryrun, hosts, self_report_stats,
+                            tags, options.reconnectinterval, spool,
+                            options.spool_replay_points,
+                            options.spool_replay_bytes,
+                            options.batch_max_lines, options.batch_max_bytes,
+                            options.batch_max_delay / 1000.0, options.http,
+                            options.http_compress, options.send_buffer_size,
+                            queue, options.standby, dns, shared_stats,
+                            stats_tags)
+
     # and setup the sender to start writing out to the tsd
-    sender = SenderThread(reader, options.dryrun, options.hosts,
-                          not options.no_tcollector_stats, tags, options.reconnectinterval)
-    sender.start()
+    router = None
+    self_report_stats = not options.no_tcollector_stats
+    if options.shard and len(options.hosts) > 1:
+        # One sender per TSD.  Each reports the stats of its own sender and
+        # spool, tagged with its TSD, only the first one the rest of ours.
+        senders = []
+        for hostport in sorted(set(options.hosts)):
+            spool_dir = None
+            if options.spool_dir:
+                spool_dir = os.path.join(options.spool_dir, '%s-%d' % hostport)
+            senders.append(make_sender([hostport], self_report_stats,
+                                       spool_dir, options.spool_max_bytes
+                                       // len(set(options.hosts)),
+                                       ReaderQueue(MAX_READQ_SIZE),
+                                       shared_stats=not senders,
+                                       stats_tags='tsd=%s-%d' % hostport))
+        router = ShardRouter(reader, senders)
+        router.start()
+    else:
+        senders = [make_sender(options.hosts, self_report_stats,
+                               options.spool_dir, options.spool_max_bytes)]
+    for sender in senders:
+        sender.start()
     LOG.info('SenderThread startup complete')
 
     # if we're in stdin mode, build a stdin collector and just join on the
@@ -927,8 +3603,12 @@ def main(argv):
       col.shutdown()
     LOG.debug('Shutting down -- joining the reader thread.')
     reader.join()
+    if router is not None:
+        LOG.debug('Shutting down -- joining the router thread.')
+        router.join()
     LOG.debug('Shutting down -- joining the sender thread.')
-    sender.join()
+    for sender in senders:
+        sender.join()
 
 def stdin_loop(options, modules, sender, tags):
     """The main loop of the program that runs when we are in stdin mode."""
@@ -947,14 +3627,36 @@ def stdin_loop(options, modules, sender, tags):
 def main_loop(options, modules, sender, tags):
     """The main loop of the program that runs when we're not in stdin mode."""
 
+    # Find out about changes to the collectors with inotify if we can, and
+    # only walk the collector directory once in a while just in case.
+    try:
+        inotify = Inotify()
+        scan_interval = FULL_SCAN_INTERVAL
+    except OSError, e:
+        LOG.warning('Cannot watch %s for changes, scanning it every %ds: %s',
+                    options.cdir, SCAN_INTERVAL, e)
+        inotify = None
+        scan_interval = SCAN_INTERVAL
+
     next_heartbeat = int(time.time() + 600)
+    next_scan = 0
     while ALIVE:
-        populate_collectors(options.cdir)
-        reload_changed_config_modules(modules, options, sender, tags)
+        if time.time() >= next_scan:
+            if inotify is not None:
+                # Watch any new directory before walking it, so we can't
+                # miss a change.
+                watch_collectors(inotify, options.cdir)
+            populate_collectors(options.cdir)
+            reload_changed_config_modules(modules, options, sender, tags)
+            next_scan = time.time() + scan_interval
         reap_children()
         check_children(options)
-        spawn_children()
-        time.sleep(15)
+        spawn_children(options)
+        if inotify is None:
+            time.sleep(15)
+        elif handle_collector_events(inotify.read(15), options, modules,
+                                     sender, tags):
+            next_scan = 0
         now = int(time.time())
         if now >= next_heartbeat:
             LOG.info('Heartbeat (%d collectors running)'
@@ -1068,9 +3770,12 @@ def write_pid(pidfile):
 
 
 def all_collectors():
-    """Generator to return all collectors."""
+    """Returns a list of all collectors.
+
+       It's a copy, so that the reader and sender threads can go through it
+       while the main thread adds and removes collectors."""
 
-    return COLLECTORS.itervalues()
+    return COLLECTORS.values()
 
 
 # collectors that are not marked dead
@@ -1102,6 +3807,9 @@ def shutdown_signal(signum, frame):
 
 
 def kill(proc, signum=signal.SIGTERM):
+  if isinstance(proc, CollectorThread):
+    proc.send_signal(signum)
+    return
   os.killpg(proc.pid, signum)
 
 
@@ -1121,6 +3829,8 @@ def shutdown():
     # tell everyone to die
     for col in all_living_collectors():
         col.shutdown()
+    if FORK_SERVER is not None:
+        FORK_SERVER.close()
 
     LOG.info('exiting')
     sys.exit(1)
@@ -1138,6 +3848,8 @@ def reap_children():
         status = col.proc.poll()
         if status is None:
             continue
+        if POLLER is not None:
+            POLLER.unregister(col)
         col.proc = None
 
         # behavior based on status.  a code 0 is normal termination, code 13
@@ -1179,20 +3891,32 @@ def set_nonblocking(fd):
     fcntl.fcntl(fd, fcntl.F_SETFL, fl)
 
 
-def spawn_collector(col):
+def set_pipe_size(fd, size):
+    """Resizes the buffer of the pipe behind the given file descriptor."""
+    try:
+        fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except IOError, e:
+        # EPERM when above /proc/sys/fs/pipe-max-size, EINVAL on old kernels.
+        LOG.warning('Failed to set pipe buffer size to %d: %s', size, e)
+
+
+def spawn_collector(col, options):
     """Takes a Collector object and creates a process for it."""
 
     LOG.info('%s (interval=%d) needs to be spawned', col.name, col.interval)
 
-    # FIXME: do custom integration of Python scripts into memory/threads
-    # if re.search('\.py$', col.name) is not None:
-    #     ... load the py module directly instead of using a subprocess ...
     try:
-        col.proc = subprocess.Popen(col.filename, stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
-                                    close_fds=True,
-                                    preexec_fn=os.setsid)
-    except OSError, e:
+        if runs_in_process(col, options):
+            col.proc = CollectorThread(col.name, col.filename)
+            col.proc.start()
+        elif runs_forked(col):
+            col.proc = FORK_SERVER.spawn(col.filename)
+        else:
+            col.proc = subprocess.Popen(col.filename, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        close_fds=True,
+                                        preexec_fn=os.setsid)
+    except (EnvironmentError, threading.ThreadError), e:
         LOG.error('Failed to spawn collector %s: %s' % (col.filename, e))
         return
     # The following line needs to move below this line because it is used in
@@ -1201,6 +3925,14 @@ def spawn_collector(col):
     col.lastspawn = int(time.time())
     set_nonblocking(col.proc.stdout.fileno())
     set_nonblocking(col.proc.stderr.fileno())
+    if options.pipe_buffer_size:
+        set_pipe_size(col.proc.stdout.fileno(), options.pipe_buffer_size)
+    if POLLER is not None:
+        POLLER.register(col)
+    if isinstance(col.proc, CollectorThread):
+        col.dead = False
+        LOG.info('spawned %s in-process', col.name)
+        return
     if col.proc.pid > 0:
         col.dead = False
         LOG.info('spawned %s (pid=%d)', col.name, col.proc.pid)
@@ -1209,7 +3941,55 @@ def spawn_collector(col):
     LOG.error('failed to spawn collector: %s', col.filename)
 
 
-def spawn_children():
+def runs_in_process(col, options):
+    """Returns true if the given collector is to be run in a thread of ours
+       rather than in a process of its own."""
+    if not col.filename.endswith('.py'):
+        return False
+    return (('all' in options.in_process or col.name in options.in_process)
+            and runs_our_python(col.filename))
+
+
+def runs_forked(col):
+    """Returns true if the given collector is to be spawned by the
+       ForkServer."""
+    return (FORK_SERVER is not None and not FORK_SERVER.dead
+            and col.interval > 0 and col.filename.endswith('.py')
+            and runs_our_python(col.filename))
+
+
+def runs_our_python(filename):
+    """Returns true if the shebang line of the given script names the same
+       interpreter as the one we run with, without options, so that it can
+       run in our interpreter or one forked from it."""
+    try:
+        f = open(filename)
+        try:
+            line = f.readline(1024)
+        finally:
+            f.close()
+    except IOError:
+        return False
+    if not line.startswith('#!'):
+        return False
+    args = line[2:].split()
+    if len(args) == 2 and os.path.basename(args[0]) == 'env':
+        args = [find_in_path(args[1])]
+    if len(args) != 1 or args[0] is None:
+        return False
+    return os.path.realpath(args[0]) == os.path.realpath(sys.executable)
+
+
+def find_in_path(name):
+    """Returns the path of the given executable in $PATH, or None."""
+    for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def spawn_children(options):
     """Iterates over our defined collectors and performs the logic to
        determine if we need to spawn, kill, or otherwise take some
        action on them."""
@@ -1221,10 +4001,10 @@ def spawn_children():
         now = int(time.time())
         if col.interval == 0:
             if col.proc is None:
-                spawn_collector(col)
+                spawn_collector(col, options)
         elif col.interval <= now - col.lastspawn:
             if col.proc is None:
-                spawn_collector(col)
+                spawn_collector(col, options)
                 continue
 
             # I'm not very satisfied with this path.  It seems fragile and
@@ -1272,54 +4052,109 @@ def populate_collectors(coldir):
         interval = int(interval)
 
         for colname in os.listdir('%s/%d' % (coldir, interval)):
-            if colname.startswith('.'):
-                continue
-
-            filename = '%s/%d/%s' % (coldir, interval, colname)
-            if os.path.isfile(filename) and os.access(filename, os.X_OK):
-                mtime = os.path.getmtime(filename)
-
-                # if this collector is already 'known', then check if it's
-                # been updated (new mtime) so we can kill off the old one
-                # (but only if it's interval 0, else we'll just get
-                # it next time it runs)
-                if colname in COLLECTORS:
-                    col = COLLECTORS[colname]
-
-                    # if we get a dupe, then ignore the one we're trying to
-                    # add now.  there is probably a more robust way of doing
-                    # this...
-                    if col.interval != interval:
-                        LOG.error('two collectors with the same name %s and '
-                                   'different intervals %d and %d',
-                                   colname, interval, col.interval)
-                        continue
-
-                    # we have to increase the generation or we will kill
-                    # this script again
-                    col.generation = GENERATION
-                    if col.mtime < mtime:
-                        LOG.info('%s has been updated on disk', col.name)
-                        col.mtime = mtime
-                        if not col.interval:
-                            col.shutdown()
-                            LOG.info('Respawning %s', col.name)
-                            register_collector(Collector(colname, interval,
-                                                         filename, mtime))
-                else:
-                    register_collector(Collector(colname, interval, filename,
-                                                 mtime))
+            update_collector(coldir, interval, colname)
 
     # now iterate over everybody and look for old generations
-    to_delete = []
-    for col in all_collectors():
+    for col in list(all_collectors()):
         if col.generation < GENERATION:
-            LOG.info('collector %s removed from the filesystem, forgetting',
-                      col.name)
-            col.shutdown()
-            to_delete.append(col.name)
-    for name in to_delete:
-        del COLLECTORS[name]
+            forget_collector(col)
+    # also forget the dedup state of collectors that are gone, including
+    # the ones restored by load_dedup_state() that no longer exist
+    for name in DEDUP_CACHES.keys():
+        if name not in COLLECTORS:
+            del DEDUP_CACHES[name]
+
+
+def update_collector(coldir, interval, colname):
+    """Brings the collector of the given interval and name in line with its
+       file: registers it if it's new, respawns it if it's been updated and
+       forgets about it if it's been removed."""
+    if colname.startswith('.'):
+        return
+
+    filename = '%s/%d/%s' % (coldir, interval, colname)
+    if not (os.path.isfile(filename) and os.access(filename, os.X_OK)):
+        col = COLLECTORS.get(colname)
+        if col is not None and col.interval == interval:
+            forget_collector(col)
+        return
+    mtime = os.path.getmtime(filename)
+
+    # if this collector is already 'known', then check if it's
+    # been updated (new mtime) so we can kill off the old one
+    # (but only if it's interval 0, else we'll just get
+    # it next time it runs)
+    if colname in COLLECTORS:
+        col = COLLECTORS[colname]
+
+        # if we get a dupe, then ignore the one we're trying to
+        # add now.  there is probably a more robust way of doing
+        # this...
+        if col.interval != interval:
+            LOG.error('two collectors with the same name %s and '
+                       'different intervals %d and %d',
+                       colname, interval, col.interval)
+            return
+
+        # we have to increase the generation or we will kill
+        # this script again
+        col.generation = GENERATION
+        if col.mtime < mtime:
+            LOG.info('%s has been updated on disk', col.name)
+            col.mtime = mtime
+            if not col.interval:
+                col.shutdown()
+                LOG.info('Respawning %s', col.name)
+                register_collector(Collector(colname, interval,
+                                             filename, mtime))
+    else:
+        register_collector(Collector(colname, interval, filename,
+                                     mtime))
+
+
+def forget_collector(col):
+    """Stops and forgets about a collector removed from the filesystem."""
+    LOG.info('collector %s removed from the filesystem, forgetting',
+              col.name)
+    col.shutdown()
+    del COLLECTORS[col.name]
+    DEDUP_CACHES.pop(col.name, None)
+
+
+def watch_collectors(inotify, coldir):
+    """Watches the collector directory, its interval directories and its
+       'etc' directory for changes."""
+    inotify.watch(coldir)
+    for name in os.listdir(coldir):
+        path = os.path.join(coldir, name)
+        if (name.isdigit() or name == 'etc') and os.path.isdir(path):
+            inotify.watch(path)
+
+
+def handle_collector_events(events, options, modules, sender, tags):
+    """Applies the changes inotify told us about to our collectors and config
+       modules.  Returns true if we have to walk the collector directory
+       to find out what changed."""
+    coldir = options.cdir
+    etcdir = os.path.join(coldir, 'etc')
+    etc_changed = False
+    for path, name, mask in events:
+        if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF):
+            return True
+        if path == coldir:
+            # An interval or etc directory came or went.
+            if name.isdigit() or name == 'etc':
+                return True
+        elif path == etcdir:
+            etc_changed = True
+        elif mask & IN_CREATE and not os.path.islink(os.path.join(path, name)):
+            # Wait for the file to be fully written, or moved in place.
+            continue
+        else:
+            update_collector(coldir, int(os.path.basename(path)), name)
+    if etc_changed:
+        reload_changed_config_modules(modules, options, sender, tags)
+    return False
 
 
 if __name__ == '__main__':
@@ -12,10 +12,21 @@
 # of the GNU Lesser General Public License along with this program.  If not,
 # see <http://www.gnu.org/licenses/>.
 
+import BaseHTTPServer
+import json
 import os
+import re
+import shutil
+import signal
+import socket
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 from stat import S_ISDIR, S_ISREG, ST_MODE
 import unittest
+import zlib
 
 import mocks
 import tcollector
@@ -104,6 +115,1735 @@ class TSDBlacklistingTests(unittest.TestCase):
         sender.pick_connection()
         self.assertEqual(tsd1, (sender.host, sender.port))
 
+class TSDHealthTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tsd1 = ("localhost", 4242)
+        self.tsd2 = ("localhost", 4243)
+        self.sender = tcollector.SenderThread(None, True, [self.tsd1, self.tsd2],
+                                              False, {}, reconnectinterval=5)
+
+    def test_breaker(self):
+        health = tcollector.TSDHealth()
+        now = time.time()
+        later = now + tcollector.BREAKER_MIN_DELAY + 1
+        self.assertTrue(health.available(now))
+        health.record_failure()
+        self.assertFalse(health.available(now))
+        self.assertTrue(health.available(later))
+        health.record_failure()  # The half-open try failed.
+        self.assertFalse(health.available(later))
+        health.record_send(0.01)
+        self.assertTrue(health.available(now))
+        self.assertEqual(0, health.failures)
+        self.assertTrue(0 < health.error_rate < 1)
+
+    def test_weighted(self):
+        self.sender.health[self.tsd1].record_send(0.01)
+        self.sender.health[self.tsd2].record_send(0.1)
+        picks = []
+        for _ in xrange(110):
+            self.sender.pick_connection()
+            picks.append((self.sender.host, self.sender.port))
+        self.assertEqual(100, picks.count(self.tsd1))
+        self.assertEqual(10, picks.count(self.tsd2))
+
+    def test_errors(self):
+        self.sender.health[self.tsd1].record_send(0.01)
+        self.sender.health[self.tsd2].record_send(0.01)
+        self.sender.host, self.sender.port = self.tsd1
+        self.sender.blacklist_connection()
+        self.sender.health[self.tsd1].retry_at = 0  # Half-open.
+        self.sender.pick_connection()
+        picks = [(self.sender.host, self.sender.port)]
+        for _ in xrange(99):
+            self.sender.pick_connection()
+            picks.append((self.sender.host, self.sender.port))
+        self.assertTrue(picks.count(self.tsd1) < 30, picks.count(self.tsd1))
+
+    def test_slower_than_others(self):
+        self.sender.host, self.sender.port = self.tsd1
+        self.sender.health[self.tsd1].record_send(0.5)
+        self.assertFalse(self.sender.slower_than_others())
+        self.sender.health[self.tsd2].record_send(0.1)
+        self.assertTrue(self.sender.slower_than_others())
+        self.sender.host, self.sender.port = self.tsd2
+        self.sender.blacklist_connection()
+        self.sender.host, self.sender.port = self.tsd1
+        self.assertFalse(self.sender.slower_than_others())
+
+
+class ParseLineTests(unittest.TestCase):
+
+    VALID = [
+        ('foo.bar 1 1', ('foo.bar', 1, '1', '')),
+        ('foo.bar 1 -1.5e3', ('foo.bar', 1, '-1.5e3', '')),
+        ('foo.bar 1 1 a=b', ('foo.bar', 1, '1', 'a=b')),
+        ('foo.bar 1 1 c-d=e/f_g.h a=b',
+         ('foo.bar', 1, '1', 'a=b c-d=e/f_g.h')),
+        ('foo.bar\t1  1\t c=d   a=b', ('foo.bar', 1, '1', 'a=b c=d')),
+        ('-_./aZ09 1234567890 x', ('-_./aZ09', 1234567890, 'x', '')),
+    ]
+
+    INVALID = [
+        '',
+        'foo.bar',
+        'foo.bar 1',
+        'foo.bar 1a 1',
+        'foo.bar -1 1',
+        'foo.bar 1.5 1',
+        'foo:bar 1 1',
+        'foo.bar 1 1 a',
+        'foo.bar 1 1 a=',
+        'foo.bar 1 1 =b',
+        'foo.bar 1 1 a=b=c',
+        'foo.bar 1 1 a==b',
+        'foo.bar 1 1 a=b c',
+        'foo.bar 1 1 a=b\t=c',
+        'foo.bar 1 1 a=b:c',
+        'put foo.bar 1 1',
+    ]
+
+    def parse(self, line):
+        dp = tcollector.parse_line(line)
+        return dp.metric, dp.timestamp, dp.value, dp.tags
+
+    def test_valid(self):
+        for line, expected in self.VALID:
+            self.assertEqual(expected, self.parse(line), line)
+
+    def test_invalid(self):
+        for line in self.INVALID:
+            self.assertIsNone(tcollector.parse_line(line), line)
+
+    def test_cache(self):
+        tcollector.TAGS_CACHE.reset()
+        tcollector.METRICS_CACHE.reset()
+        for _ in range(2):
+            self.assertEqual(('foo.bar', 1, '1', 'a=b c=d'),
+                             self.parse('foo.bar 1 1 c=d  a=b'))
+        self.assertEqual({'c=d  a=b': 'a=b c=d'}, tcollector.TAGS_CACHE)
+        self.assertEqual({'foo.bar': 'foo.bar'}, tcollector.METRICS_CACHE)
+
+    def test_cache_generations(self):
+        cache = tcollector.ParseCache(2)
+        cache.add('a', 1)
+        cache.add('b', 2)
+        cache.add('c', 3)  # Full, a and b are now the old generation.
+        self.assertEqual({'c': 3}, cache)
+        self.assertEqual(1, cache.get_old('a'))
+        self.assertEqual({'a': 1, 'c': 3}, cache)
+        cache.add('d', 4)  # b goes away with its generation.
+        self.assertEqual(None, cache.get_old('b'))
+        self.assertEqual(3, cache.get_old('c'))
+
+    def test_format(self):
+        self.assertEqual('foo.bar 1 1.5 a=b c=d',
+                         str(tcollector.parse_line('foo.bar 1 1.5 c=d  a=b')))
+        self.assertEqual('foo.bar 1 1', str(tcollector.parse_line('foo.bar 1 1')))
+
+    def test_matches_regexp(self):
+        line_re = re.compile('^([-_./a-zA-Z0-9]+)\s+'  # Metric name.
+                             '(\d+)\s+'               # Timestamp.
+                             '(\S+?)'                  # Value.
+                             '((?:\s+[-_./a-zA-Z0-9]+=[-_./a-zA-Z0-9]+)*)$')
+        for line in [line for line, _ in self.VALID] + self.INVALID:
+            parsed = line_re.match(line)
+            self.assertEqual(parsed is None,
+                             tcollector.parse_line(line) is None, line)
+
+
+class DedupTests(unittest.TestCase):
+
+    def setUp(self):
+        self.reader = tcollector.ReaderThread(300, 6000)
+        self.col = tcollector.Collector('test', 0, 'test')
+
+    def process(self, *lines):
+        for line in lines:
+            self.reader.process_line(self.col, line)
+        sent = [str(dp) for dp in self.reader.pending]
+        self.reader.pending = []
+        return sent
+
+    def test_dedup(self):
+        self.assertEqual(['foo 1000 1'], self.process('foo 1000 1'))
+        self.assertEqual([], self.process('foo 1010 1', 'foo 1020 1'))
+        # The last repeated value is sent before the new one.
+        self.assertEqual(['foo 1020 1', 'foo 1030 2'], self.process('foo 1030 2'))
+        # Suppressed values are sent again after the dedup interval.
+        self.assertEqual(['foo 1330 2'], self.process('foo 1330 2'))
+
+    def test_tags_order(self):
+        self.assertEqual(['foo 1000 1 a=1 b=2'], self.process('foo 1000 1 a=1 b=2'))
+        self.assertEqual([], self.process('foo 1010 1 b=2 a=1'))
+
+    def test_numeric_values(self):
+        self.assertEqual(['foo 1000 1'], self.process('foo 1000 1'))
+        self.assertEqual([], self.process('foo 1010 1.0', 'foo 1020 1e0'))
+        self.assertEqual(['bar 1000 nan'], self.process('bar 1000 nan'))
+        self.assertEqual([], self.process('bar 1010 NaN'))
+
+    def test_values_size(self):
+        empty = self.col.values_size()
+        self.process('foo 1000 1 a=1', 'foo 1000 1 a=2', 'foo 1010 1 a=2')
+        self.assertEqual(2, len(self.col.values))
+        self.assertEqual(empty + 2 * (tcollector.DedupEntry.SIZE
+                                      + sys.getsizeof('a=1')),
+                         self.col.values_size())
+        # Evicted entries are no longer accounted for.
+        self.col.values.evict(2000, 100)
+        self.assertEqual(empty, self.col.values_size())
+
+    def test_out_of_order(self):
+        self.assertEqual(['foo 1000 1'], self.process('foo 1000 1'))
+        self.assertEqual([], self.process('foo 1000 2', 'foo 999 3'))
+        self.assertEqual(2, self.col.lines_invalid)
+
+
+class AllCollectorsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.collectors = tcollector.COLLECTORS.copy()
+        self.dedup_caches = tcollector.DEDUP_CACHES.copy()
+        tcollector.COLLECTORS.clear()
+
+    def tearDown(self):
+        tcollector.COLLECTORS.clear()
+        tcollector.COLLECTORS.update(self.collectors)
+        tcollector.DEDUP_CACHES.clear()
+        tcollector.DEDUP_CACHES.update(self.dedup_caches)
+
+    def test_changes_while_iterating(self):
+        for name in ('a', 'b'):
+            tcollector.register_collector(tcollector.Collector(name, 0, name))
+        for col in tcollector.all_collectors():
+            # What the main thread does while the sender reports stats.
+            del tcollector.COLLECTORS[col.name]
+            tcollector.register_collector(
+                tcollector.Collector(col.name + '2', 0, col.name))
+        self.assertEqual(['a2', 'b2'], sorted(tcollector.COLLECTORS))
+
+
+class DedupCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = tcollector.DedupCache()
+        for i in range(10):
+            self.cache.add(('foo', ('i=%d' % i,)),
+                           tcollector.DedupEntry('1', i * 60))
+
+    def test_evict(self):
+        self.assertEqual(0, self.cache.evict(59, 100))
+        self.assertEqual(10, len(self.cache))
+        self.assertEqual(5, self.cache.evict(300, 100))
+        self.assertEqual(5, len(self.cache))
+        self.assertNotIn(('foo', ('i=4',)), self.cache)
+        self.assertIn(('foo', ('i=5',)), self.cache)
+
+    def test_limit(self):
+        self.assertEqual(3, self.cache.evict(600, 3))
+        self.assertEqual(7, len(self.cache))
+        self.assertEqual(7, self.cache.evict(600, 100))
+        self.assertEqual(0, len(self.cache))
+        self.assertEqual({}, self.cache.wheel)
+        self.assertEqual([], self.cache.buckets)
+
+    def test_seen_again(self):
+        self.cache[('foo', ('i=0',))].last_timestamp = 500
+        self.assertEqual(5, self.cache.evict(300, 100))
+        self.assertIn(('foo', ('i=0',)), self.cache)
+        self.assertEqual(6, len(self.cache))
+        self.assertEqual(6, self.cache.evict(600, 100))
+        self.assertEqual(0, len(self.cache))
+
+
+class MaxSeriesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.collectors = tcollector.COLLECTORS.copy()
+        self.dedup_caches = tcollector.DEDUP_CACHES.copy()
+        tcollector.COLLECTORS.clear()
+        tcollector.DEDUP_CACHES.clear()
+        self.max_reasonable_timestamp = tcollector.MAX_REASONABLE_TIMESTAMP
+        tcollector.MAX_REASONABLE_TIMESTAMP = int(time.time()) + 3600
+        self.reader = tcollector.ReaderThread(300, 6000, max_series=3)
+        self.col1 = tcollector.Collector('col1', 0, 'col1')
+        self.col2 = tcollector.Collector('col2', 0, 'col2')
+        tcollector.register_collector(self.col1)
+        tcollector.register_collector(self.col2)
+
+    def tearDown(self):
+        tcollector.COLLECTORS.clear()
+        tcollector.COLLECTORS.update(self.collectors)
+        tcollector.DEDUP_CACHES.clear()
+        tcollector.DEDUP_CACHES.update(self.dedup_caches)
+        tcollector.MAX_REASONABLE_TIMESTAMP = self.max_reasonable_timestamp
+
+    def test_evict_least_recently_seen(self):
+        now = int(time.time())
+        self.reader.process_line(self.col1, 'foo %d 1 a=1' % (now - 600))
+        self.reader.process_line(self.col2, 'foo %d 1 a=2' % (now - 500))
+        self.reader.process_line(self.col1, 'foo %d 1 a=3' % (now - 400))
+        self.reader.process_line(self.col2, 'foo %d 1 a=4' % (now - 300))
+        self.reader.process_line(self.col2, 'foo %d 1 a=5' % (now - 200))
+        # Seen again, it's now the most recently seen series.
+        self.reader.process_line(self.col1, 'foo %d 1 a=1' % (now - 100))
+        self.reader.evict_old_keys()
+        self.assertEqual([('foo', 'a=1')], self.col1.values.keys())
+        self.assertEqual(sorted([('foo', 'a=4'), ('foo', 'a=5')]),
+                         sorted(self.col2.values.keys()))
+        self.assertEqual(1, self.col1.values.lru_evictions)
+        self.assertEqual(1, self.col2.values.lru_evictions)
+
+    def test_batches(self):
+        now = int(time.time())
+        for i in range(5):
+            self.reader.process_line(self.col1,
+                                     'foo %d 1 a=%d' % (now - 500 + i, i))
+        evict_batch_size = tcollector.EVICT_BATCH_SIZE
+        tcollector.EVICT_BATCH_SIZE = 1
+        try:
+            self.reader.evict_old_keys()
+            self.assertEqual(4, len(self.col1.values))
+            self.reader.evict_old_keys()
+            self.assertEqual(3, len(self.col1.values))
+            self.reader.evict_old_keys()
+            self.assertEqual(3, len(self.col1.values))
+        finally:
+            tcollector.EVICT_BATCH_SIZE = evict_batch_size
+
+    def test_no_limit(self):
+        self.reader.max_series = 0
+        now = int(time.time())
+        for i in range(5):
+            self.reader.process_line(self.col1, 'foo %d 1 a=%d' % (now, i))
+        self.reader.evict_old_keys()
+        self.assertEqual(5, len(self.col1.values))
+
+
+class RespawnTests(unittest.TestCase):
+
+    class Proc(object):
+        pid = 42
+
+        def poll(self):
+            return 0
+
+    def setUp(self):
+        self.collectors = tcollector.COLLECTORS.copy()
+        self.dedup_caches = tcollector.DEDUP_CACHES.copy()
+        tcollector.COLLECTORS.clear()
+        tcollector.DEDUP_CACHES.clear()
+        self.reader = tcollector.ReaderThread(300, 6000)
+        self.col = tcollector.Collector('test', 60, 'test')
+        tcollector.register_collector(self.col)
+
+    def tearDown(self):
+        tcollector.COLLECTORS.clear()
+        tcollector.COLLECTORS.update(self.collectors)
+        tcollector.DEDUP_CACHES.clear()
+        tcollector.DEDUP_CACHES.update(self.dedup_caches)
+
+    def test_reaped(self):
+        self.reader.process_line(self.col, 'foo 1000 1')
+        self.col.proc = self.Proc()
+        tcollector.reap_children()
+        col = tcollector.COLLECTORS['test']
+        self.assertIsNot(self.col, col)
+        self.assertIs(self.col.values, col.values)
+        self.reader.process_line(col, 'foo 1060 1')
+        self.assertEqual(['foo 1000 1'], [str(dp) for dp in self.reader.pending])
+
+    def test_removed(self):
+        self.reader.process_line(self.col, 'foo 1000 1')
+        cdir = tempfile.mkdtemp()
+        try:
+            tcollector.populate_collectors(cdir)
+        finally:
+            os.rmdir(cdir)
+        self.assertNotIn('test', tcollector.COLLECTORS)
+        self.assertNotIn('test', tcollector.DEDUP_CACHES)
+
+
+class CollectorWatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.collectors = tcollector.COLLECTORS.copy()
+        tcollector.COLLECTORS.clear()
+        self.cdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.cdir, '0'))
+        self.options = tcollector.parse_cmdline(['tcollector',
+                                                 '-c', self.cdir])[0]
+        self.inotify = tcollector.Inotify()
+        tcollector.watch_collectors(self.inotify, self.cdir)
+
+    def tearDown(self):
+        self.inotify.close()
+        shutil.rmtree(self.cdir)
+        tcollector.COLLECTORS.clear()
+        tcollector.COLLECTORS.update(self.collectors)
+
+    def handle_events(self):
+        return tcollector.handle_collector_events(self.inotify.read(1),
+                                                  self.options, {}, None, {})
+
+    def test_add_remove(self):
+        tmp = os.path.join(self.cdir, 'tmp')
+        with open(tmp, 'w') as f:
+            f.write('#!/bin/sh\n')
+        os.chmod(tmp, 0755)
+        os.rename(tmp, os.path.join(self.cdir, '0', 'c'))
+        self.assertFalse(self.handle_events())
+        self.assertEqual(0, tcollector.COLLECTORS['c'].interval)
+        os.remove(os.path.join(self.cdir, '0', 'c'))
+        self.assertFalse(self.handle_events())
+        self.assertNotIn('c', tcollector.COLLECTORS)
+
+    def test_new_interval(self):
+        os.mkdir(os.path.join(self.cdir, '60'))
+        self.assertTrue(self.handle_events())
+
+
+class CollectorThreadTests(unittest.TestCase):
+
+    def setUp(self):
+        self.stdout = sys.stdout
+        self.stderr = sys.stderr
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        sys.stderr = self.stderr
+        shutil.rmtree(self.tmpdir)
+
+    def start(self, source):
+        filename = os.path.join(self.tmpdir, 'test.py')
+        with open(filename, 'w') as f:
+            f.write(source)
+        proc = tcollector.CollectorThread('test.py', filename)
+        proc.start()
+        return proc
+
+    def test_run(self):
+        proc = self.start('import sys\n'
+                          'def main():\n'
+                          '    print "foo 1 1"\n'
+                          '    print >>sys.stderr, "oops"\n'
+                          '    sys.exit(13)\n')
+        self.assertEqual(13, proc.wait())
+        self.assertEqual('foo 1 1\n', proc.stdout.read())
+        self.assertEqual('oops\n', proc.stderr.read())
+        self.assertNotIn(proc.module_name, sys.modules)
+
+    def test_kill(self):
+        proc = self.start('import time\n'
+                          'def main():\n'
+                          '    while True:\n'
+                          '        time.sleep(0.01)\n')
+        self.assertEqual(None, proc.poll())
+        tcollector.kill(proc)
+        self.assertEqual(-signal.SIGTERM, proc.wait())
+        self.assertEqual('', proc.stdout.read())
+
+
+    def test_kill_stuck(self):
+        tcollector.THREAD_KILL_TIMEOUT = 0.1
+        try:
+            proc = self.start('import select, sys\n'
+                              'def main():\n'
+                              '    print "ready"\n'
+                              '    sys.stdout.flush()\n'
+                              '    select.select([], [], [], 2)\n')
+            self.assertEqual('ready\n', proc.stdout.readline())
+            tcollector.kill(proc)
+            self.assertEqual(-signal.SIGTERM, proc.wait())
+        finally:
+            tcollector.THREAD_KILL_TIMEOUT = 5
+        self.assertTrue(proc.is_alive())
+        self.assertEqual(-signal.SIGTERM, proc.poll())
+        self.assertEqual('', proc.stdout.read())  # EOF for the reader.
+        self.assertNotIn(proc.module_name, sys.modules)
+        tcollector.kill(proc, signal.SIGKILL)  # Not again.
+        self.assertEqual(-signal.SIGTERM, proc.poll())
+
+    def test_drop_privileges(self):
+        if os.getuid() != 0:
+            self.skipTest('not running as root')
+        proc = self.start('import os\n'
+                          'from collectors.lib import utils\n'
+                          'def main():\n'
+                          '    utils.drop_privileges()\n'
+                          '    print "uid 1 %d" % os.getuid()\n')
+        self.assertEqual(0, proc.wait())
+        self.assertEqual('uid 1 0\n', proc.stdout.read())
+        self.assertIn("can't drop privileges", proc.stderr.read())
+
+class ForkServerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = tcollector.ForkServer(('os',))
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.tmpdir)
+
+    def spawn(self, source):
+        filename = os.path.join(self.tmpdir, 'test.py')
+        with open(filename, 'w') as f:
+            f.write(source)
+        return self.server.spawn(filename)
+
+    def test_spawn(self):
+        proc = self.spawn('import sys\n'
+                          'if __name__ == "__main__":\n'
+                          '    print "foo 1 1"\n'
+                          '    print >>sys.stderr, "oops"\n'
+                          '    sys.exit(13)\n')
+        self.assertEqual(13, proc.wait())
+        self.assertEqual('foo 1 1\n', proc.stdout.read())
+        self.assertEqual('oops\n', proc.stderr.read())
+        self.assertEqual(1, self.server.spawns)
+
+    def test_kill(self):
+        proc = self.spawn('import time\n'
+                          'while True:\n'
+                          '    time.sleep(1)\n')
+        self.assertEqual(None, proc.poll())
+        tcollector.kill(proc)
+        self.assertEqual(-signal.SIGTERM, proc.wait())
+
+
+class RunsOurPythonTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = tcollector.FORK_SERVER
+        tcollector.FORK_SERVER = tcollector.ForkServer(('os',))
+
+    def tearDown(self):
+        tcollector.FORK_SERVER.close()
+        tcollector.FORK_SERVER = self.server
+        shutil.rmtree(self.tmpdir)
+
+    def collector(self, shebang, interval=10):
+        filename = os.path.join(self.tmpdir, 'test.py')
+        with open(filename, 'w') as f:
+            f.write(shebang + '\nprint "foo 1 1"\n')
+        return tcollector.Collector('test.py', interval, filename)
+
+    def test_our_python(self):
+        col = self.collector('#!' + sys.executable)
+        self.assertTrue(tcollector.runs_forked(col))
+        options = tcollector.parse_cmdline(['tcollector.py',
+                                            '--in-process=all'])[0]
+        self.assertTrue(tcollector.runs_in_process(col, options))
+
+    def test_env(self):
+        bindir = os.path.join(self.tmpdir, 'bin')
+        os.mkdir(bindir)
+        os.symlink(sys.executable, os.path.join(bindir, 'ourpython'))
+        path = os.environ.get('PATH')
+        os.environ['PATH'] = bindir + os.pathsep + (path or '')
+        try:
+            col = self.collector('#!/usr/bin/env ourpython')
+            self.assertTrue(tcollector.runs_forked(col))
+            col = self.collector('#!/usr/bin/env notourpython')
+            self.assertFalse(tcollector.runs_forked(col))
+        finally:
+            if path is None:
+                del os.environ['PATH']
+            else:
+                os.environ['PATH'] = path
+
+    def test_other_python(self):
+        options = tcollector.parse_cmdline(['tcollector.py',
+                                            '--in-process=all'])[0]
+        for shebang in ('#!/opt/venv/bin/python',
+                        '#!%s -u' % sys.executable,
+                        '# no shebang'):
+            col = self.collector(shebang)
+            self.assertFalse(tcollector.runs_forked(col), shebang)
+            self.assertFalse(tcollector.runs_in_process(col, options),
+                             shebang)
+
+    def test_not_at_an_interval(self):
+        self.assertFalse(tcollector.runs_forked(
+            self.collector('#!' + sys.executable, interval=0)))
+
+
+class DedupStateTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dedup_caches = tcollector.DEDUP_CACHES.copy()
+        tcollector.DEDUP_CACHES.clear()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'state')
+
+    def tearDown(self):
+        tcollector.DEDUP_CACHES.clear()
+        tcollector.DEDUP_CACHES.update(self.dedup_caches)
+        shutil.rmtree(self.tmpdir)
+
+    def test_save_and_load(self):
+        reader = tcollector.ReaderThread(300, 6000)
+        col = tcollector.Collector('test', 0, 'test')
+        tcollector.DEDUP_CACHES['test'] = col.values
+        for line in ('foo 1000 1 b=2 a=1', 'foo 1010 1 b=2 a=1',
+                     'bar 1000 1.5', 'old 500 1'):
+            reader.process_line(col, line)
+        tcollector.save_dedup_state(self.path)
+        self.assertEqual(['state'], os.listdir(self.tmpdir))
+
+        tcollector.DEDUP_CACHES.clear()
+        self.assertEqual(2, tcollector.load_dedup_state(self.path, 900))
+        col = tcollector.Collector('test', 0, 'test')
+        tcollector.register_collector(col)
+        entry = col.values[('foo', 'a=1 b=2')]
+        self.assertEqual(('1', 1000, 1010),
+                         (entry.value, entry.timestamp, entry.last_timestamp))
+        self.assertIn(('bar', ''), col.values)
+        self.assertNotIn(('old', ''), col.values)
+        # The repeated value gets replayed when it changes.
+        reader.pending = []
+        reader.process_line(col, 'foo 1020 2 a=1 b=2')
+        self.assertEqual(['foo 1010 1 a=1 b=2', 'foo 1020 2 a=1 b=2'],
+                         [str(dp) for dp in reader.pending])
+
+    def test_missing_file(self):
+        self.assertEqual(0, tcollector.load_dedup_state(self.path, 0))
+
+    def test_save_in_background(self):
+        reader = tcollector.ReaderThread(300, 6000, state_file=self.path)
+        col = tcollector.Collector('test', 0, 'test')
+        tcollector.DEDUP_CACHES['test'] = col.values
+        reader.process_line(col, 'foo 1000 1')
+        writer = threading.Event()
+        write_dedup_state = tcollector.write_dedup_state
+        def slow_write(path, snapshot):
+            writer.wait()
+            write_dedup_state(path, snapshot)
+        tcollector.write_dedup_state = slow_write
+        try:
+            reader.save_state()
+            # What changes once the snapshot is taken isn't saved.
+            reader.process_line(col, 'foo 1010 2')
+            # Nor is a snapshot taken while the previous one is written.
+            reader.save_state()
+            self.assertFalse(os.path.exists(self.path))
+            writer.set()
+            reader.state_writer.join()
+        finally:
+            tcollector.write_dedup_state = write_dedup_state
+        self.assertEqual(['state'], os.listdir(self.tmpdir))
+        tcollector.DEDUP_CACHES.clear()
+        self.assertEqual(1, tcollector.load_dedup_state(self.path, 0))
+        entry = tcollector.DEDUP_CACHES['test'][('foo', '')]
+        self.assertEqual(('1', 1000), (entry.value, entry.timestamp))
+
+        # When exiting, we wait for the state to be saved.
+        tcollector.DEDUP_CACHES['test'] = col.values
+        reader.save_state(wait=True)
+        tcollector.DEDUP_CACHES.clear()
+        tcollector.load_dedup_state(self.path, 0)
+        entry = tcollector.DEDUP_CACHES['test'][('foo', '')]
+        self.assertEqual(('2', 1010), (entry.value, entry.timestamp))
+
+
+class ReaderQueueTests(unittest.TestCase):
+
+    def test_batches(self):
+        q = tcollector.ReaderQueue(10)
+        self.assertEqual(0, q.nput_batch(['a', 'b']))
+        self.assertTrue(q.nput('c'))
+        self.assertEqual(3, q.qsize())
+        self.assertEqual(['a', 'b', 'c'], q.get_batch(0))
+        self.assertEqual(0, q.qsize())
+
+    def test_capacity(self):
+        q = tcollector.ReaderQueue(3)
+        self.assertEqual(0, q.nput_batch(['a', 'b']))
+        self.assertEqual(1, q.nput_batch(['c', 'd']))
+        self.assertFalse(q.nput('e'))
+        self.assertEqual(['a', 'b', 'c'], q.get_batch(0))
+
+    def test_max_values(self):
+        q = tcollector.ReaderQueue(10)
+        q.nput_batch(['a', 'b', 'c'])
+        q.nput_batch(['d', 'e'])
+        self.assertEqual(['a', 'b'], q.get_batch(0, 2))
+        self.assertEqual(['c', 'd'], q.get_batch(0, 2))
+        self.assertEqual(1, q.qsize())
+        self.assertEqual(['e'], q.get_batch(0, 2))
+
+    def test_timeout(self):
+        q = tcollector.ReaderQueue(10)
+        self.assertEqual([], q.get_batch(0))
+        self.assertEqual([], q.get_batch(0.01))
+
+    def test_wakeup(self):
+        q = tcollector.ReaderQueue(10)
+        threading.Timer(0.01, q.nput_batch, [['a']]).start()
+        self.assertEqual(['a'], q.get_batch(5))
+
+
+class CollectorPollerTests(unittest.TestCase):
+
+    def setUp(self):
+        if not hasattr(tcollector.select, 'epoll'):
+            self.skipTest('epoll is not available')
+        self.poller = tcollector.CollectorPoller()
+        self.col = tcollector.Collector('test', 0, '/bin/cat')
+        self.col.proc = subprocess.Popen(['/bin/cat'], stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE)
+        tcollector.set_nonblocking(self.col.proc.stdout.fileno())
+        tcollector.set_nonblocking(self.col.proc.stderr.fileno())
+
+    def tearDown(self):
+        if self.col.proc.poll() is None:
+            self.col.proc.kill()
+            self.col.proc.wait()
+
+    def test_idle(self):
+        self.poller.register(self.col)
+        self.assertEqual(([], []), self.poller.poll(0))
+
+    def test_output(self):
+        self.poller.register(self.col)
+        self.col.proc.stdin.write('foo.bar 1 1\n')
+        self.col.proc.stdin.flush()
+        collectors, hungup = self.poller.poll(5)
+        self.assertEqual([self.col], collectors)
+        self.assertEqual([], hungup)
+        self.assertEqual(['foo.bar 1 1'], list(self.col.collect()))
+
+    def test_hangup(self):
+        self.poller.register(self.col)
+        self.col.proc.stdin.close()
+        self.col.proc.wait()
+        collectors, hungup = self.poller.poll(5)
+        self.assertEqual([self.col], collectors)
+        self.assertIn((self.col.proc.stdout.fileno(), self.col), hungup)
+        for fd, col in hungup:
+            self.poller.unregister_fd(fd, col)
+        self.assertEqual([], list(self.poller.fds))
+
+    def test_hangup_recycled_fd(self):
+        self.poller.register(self.col)
+        self.col.proc.stdin.close()
+        self.col.proc.wait()
+        collectors, hungup = self.poller.poll(5)
+        # The collector gets reaped and a new one spawned on the same fds
+        # before the reader gets around to unregistering them.
+        other = tcollector.Collector('other', 0, '/bin/cat')
+        other.proc = self.col.proc
+        self.poller.unregister(self.col)
+        self.poller.register(other)
+        for fd, col in hungup:
+            self.poller.unregister_fd(fd, col)
+        self.assertEqual(set([other]), set(self.poller.fds.values()))
+        self.assertEqual(2, len(self.poller.fds))
+
+    def test_unregister(self):
+        self.poller.register(self.col)
+        self.poller.unregister(self.col)
+        self.col.proc.stdin.write('foo.bar 1 1\n')
+        self.col.proc.stdin.flush()
+        self.assertEqual(([], []), self.poller.poll(0.1))
+
+
+class CollectorReadTests(unittest.TestCase):
+
+    class Proc(object):
+        def __init__(self):
+            out_r, self.out_w = os.pipe()
+            err_r, self.err_w = os.pipe()
+            self.stdout = os.fdopen(out_r)
+            self.stderr = os.fdopen(err_r)
+            tcollector.set_nonblocking(out_r)
+            tcollector.set_nonblocking(err_r)
+
+        def close(self):
+            for f in (self.stdout, self.stderr):
+                f.close()
+            for fd in (self.out_w, self.err_w):
+                os.close(fd)
+
+    def setUp(self):
+        self.read_buffer_size = tcollector.READ_BUFFER_SIZE
+        self.col = tcollector.Collector('test', 0, 'test')
+        self.col.proc = self.Proc()
+
+    def tearDown(self):
+        tcollector.READ_BUFFER_SIZE = self.read_buffer_size
+        self.col.proc.close()
+
+    def write(self, data):
+        os.write(self.col.proc.out_w, data)
+
+    def test_partial_lines(self):
+        self.write('foo.bar 1 1\nfoo')
+        self.assertEqual(['foo.bar 1 1'], list(self.col.collect()))
+        self.write('.baz 2 2\n\n  \nfoo.qux')
+        self.assertEqual(['foo.baz 2 2'], list(self.col.collect()))
+        self.write(' 3 3\n')
+        self.assertEqual(['foo.qux 3 3'], list(self.col.collect()))
+        self.assertEqual(0, self.col.buffered)
+
+    def test_line_longer_than_buffer(self):
+        tcollector.READ_BUFFER_SIZE = 8
+        line = 'foo.bar 1 1 ' + ' '.join('tag%d=%d' % (i, i) for i in range(10))
+        self.write(line + '\nfoo.bar 2 2\n')
+        self.assertEqual([line, 'foo.bar 2 2'], list(self.col.collect()))
+
+    def test_burst(self):
+        lines = ['foo.bar %d %d' % (i, i) for i in xrange(100000)]
+        data = ''.join(line + '\n' for line in lines)
+        collected = []
+        # Write in chunks that split lines at random places.
+        for i in xrange(0, len(data), 4000):
+            self.write(data[i:i + 4000])
+            collected.extend(self.col.collect())
+        self.assertEqual(lines, collected)
+
+
+class StdinTests(unittest.TestCase):
+
+    def setUp(self):
+        self.stdin = sys.stdin
+        stdin_r, self.stdin_w = os.pipe()
+        sys.stdin = os.fdopen(stdin_r)
+        self.col = tcollector.StdinCollector()
+        tcollector.register_collector(self.col)
+        self.reader = tcollector.ReaderThread(0, 1)
+        self.reader.start()
+
+    def tearDown(self):
+        if self.stdin_w is not None:
+            os.close(self.stdin_w)
+        self.reader.join()
+        tcollector.ALIVE = True
+        sys.stdin.close()
+        sys.stdin = self.stdin
+        del tcollector.COLLECTORS[self.col.name]
+        del tcollector.DEDUP_CACHES[self.col.name]
+
+    def test_lines_are_not_held_until_eof(self):
+        os.write(self.stdin_w, 'foo.bar 1500000000 1\n')
+        dps = self.reader.readerq.get_batch(5)
+        self.assertEqual(['foo.bar'], [dp.metric for dp in dps])
+        os.close(self.stdin_w)
+        self.stdin_w = None
+        self.reader.join(5)
+        self.assertFalse(self.reader.isAlive())
+
+class DiskSpoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check_oldest_first(self, compress):
+        spool = tcollector.DiskSpool(self.tmpdir, 1000, compress)
+        spool.segment_size = 10  # Every write starts a new segment.
+        spool.write(['foo 1 1', 'foo 2 2'])
+        spool.write(['foo 3 3'])
+        self.assertEqual(2, len(os.listdir(self.tmpdir)))
+        self.assertEqual(['foo 1 1'], spool.read(1))
+        spool.write(['foo 4 4'])
+        self.assertEqual(['foo 2 2', 'foo 3 3', 'foo 4 4'], spool.read(10))
+        self.assertEqual([], spool.read(10))
+        self.assertEqual(0, spool.bytes)
+        self.assertEqual([], os.listdir(self.tmpdir))
+
+    def test_oldest_first(self):
+        self.check_oldest_first(False)
+
+    def test_compressed(self):
+        self.check_oldest_first(True)
+
+    def test_budget(self):
+        spool = tcollector.DiskSpool(self.tmpdir, 20)
+        spool.write(['foo 1 1', 'foo 2 2'])
+        spool.write(['foo 3 3', 'foo 4 4'])
+        self.assertEqual(16, spool.dropped_bytes)
+        self.assertEqual(['foo 3 3', 'foo 4 4'], spool.read(10))
+
+    def test_budget_with_unread(self):
+        spool = tcollector.DiskSpool(self.tmpdir, 20)
+        spool.write(['foo 1 1', 'foo 2 2'])
+        spool.unread(spool.read(10))
+        self.assertEqual(0, spool.bytes)
+        self.assertEqual(16, spool.head_bytes)
+        self.assertFalse(spool.empty())
+        # The lines put back don't count against the budget on disk.
+        spool.write(['foo 3 3'])
+        self.assertEqual(0, spool.dropped_bytes)
+        # The segment we write to is never dropped, even over budget.
+        spool.write(['foo %d %d' % (i, i) for i in xrange(4, 10)])
+        self.assertEqual(8, spool.dropped_bytes)
+        self.assertEqual(48, spool.bytes)
+        self.assertEqual(['foo 1 1', 'foo 2 2'] +
+                         ['foo %d %d' % (i, i) for i in xrange(4, 10)],
+                         spool.read(10))
+        self.assertTrue(spool.empty())
+
+    def test_close(self):
+        spool = tcollector.DiskSpool(self.tmpdir, 1000, True)
+        spool.write(['foo 1 1', 'foo 2 2', 'foo 3 3'])
+        self.assertEqual(['foo 1 1'], spool.read(1))
+        spool.close()
+        spool = tcollector.DiskSpool(self.tmpdir, 1000)
+        self.assertEqual(['foo 2 2', 'foo 3 3'], spool.read(10))
+
+    def test_unread(self):
+        spool = tcollector.DiskSpool(self.tmpdir, 1000)
+        spool.segment_size = 10  # Every write starts a new segment.
+        spool.write(['foo 1 1', 'foo 2 2'])
+        lines = spool.read(2)
+        spool.write(['foo 3 3'])
+        spool.unread(lines)
+        self.assertEqual(['foo 1 1'], spool.read(1))
+        self.assertEqual(['foo 2 2', 'foo 3 3'], spool.read(10))
+        self.assertEqual(0, spool.bytes)
+
+    def check_unread_close(self, compress, read):
+        spool = tcollector.DiskSpool(self.tmpdir, 1000, compress)
+        spool.segment_size = 10
+        spool.write(['foo 1 1', 'foo 2 2'])
+        spool.write(['foo 3 3', 'foo 4 4'])
+        spool.unread(spool.read(read))
+        spool.write(['foo 5 5'])
+        spool.close()
+        spool = tcollector.DiskSpool(self.tmpdir, 1000)
+        self.assertEqual(['foo %d %d' % (i, i) for i in xrange(1, 6)],
+                         spool.read(10))
+
+    def test_unread_close(self):
+        self.check_unread_close(False, 1)  # Partly read segment.
+        self.check_unread_close(True, 2)  # Entirely read segment.
+        self.check_unread_close(False, 3)  # Across segments.
+
+    def test_restart(self):
+        spool = tcollector.DiskSpool(self.tmpdir, 1000)
+        spool.write(['foo 1 1', 'foo 2 2'])
+        spool = tcollector.DiskSpool(self.tmpdir, 1000, True)
+        self.assertEqual(16, spool.bytes)
+        spool.write(['foo 3 3'])
+        # A write interrupted half-way.
+        f = open(spool.segments[-1][0], 'ab')
+        f.write('\x1f\x8b')
+        f.close()
+        self.assertEqual(['foo 1 1', 'foo 2 2', 'foo 3 3'], spool.read(10))
+        self.assertEqual([], os.listdir(self.tmpdir))
+
+
+class SenderThreadTests(unittest.TestCase):
+
+    def test_format_datapoint(self):
+        sender = tcollector.SenderThread(None, True, [("localhost", 4242)],
+                                         False, {'host': 'x', 'a': 'g'},
+                                         reconnectinterval=0)
+        dp = tcollector.parse_line('foo 1 1 b=2 a=1')
+        self.assertEqual('foo 1 1 a=1 b=2 host=x', sender.format_datapoint(dp))
+        dp = tcollector.parse_line('foo 1 1')
+        self.assertEqual('foo 1 1 a=g host=x', sender.format_datapoint(dp))
+        # Lines with the same tags reuse the same tag section.
+        dp = tcollector.parse_line('bar 2 2 a=1 b=2')
+        self.assertEqual('bar 2 2 a=1 b=2 host=x', sender.format_datapoint(dp))
+        dp = tcollector.parse_line('foo 1 1 c=3')
+        self.assertEqual('foo 1 1 c=3 a=g host=x', sender.format_datapoint(dp))
+        self.assertEqual(' a=1 b=2 host=x',
+                         sender.tag_sections['a=1 b=2'])
+
+    def test_replay_rate(self):
+        tmpdir = tempfile.mkdtemp()
+        tsd, peer = socket.socketpair()
+        try:
+            spool = tcollector.DiskSpool(tmpdir, 10000)
+            spool.write(['foo %d 1' % i for i in xrange(25)])
+            sender = tcollector.SenderThread(None, False, [("localhost", 4242)],
+                                             False, {}, 0, spool,
+                                             replay_points=10)
+            sender.tsd = tsd
+            sender.replay_spool()
+            data = peer.recv(65536)
+            self.assertEqual(10, data.count('put '))
+            self.assertTrue(sender.replay_delay() > 0)
+            sender.replay_spool()
+            self.assertEqual(10, sender.lines_replayed)
+            sender.replay_points.last_refill -= 0.5
+            sender.replay_spool()
+            self.assertEqual(15, sender.lines_replayed)
+            data += peer.recv(65536)
+            self.assertTrue(data.startswith('put foo 0 1\n'))
+            self.assertEqual(len(data), sender.bytes_replayed)
+        finally:
+            tsd.close()
+            peer.close()
+            shutil.rmtree(tmpdir)
+
+    def test_spool_on_failure(self):
+        tmpdir = tempfile.mkdtemp()
+        tsd, peer = socket.socketpair()
+        peer.close()
+        try:
+            spool = tcollector.DiskSpool(tmpdir, 1000)
+            sender = tcollector.SenderThread(None, False, [("localhost", 4242)],
+                                             False, {'host': 'x'}, 0, spool)
+            sender.tsd = tsd
+            sender.enqueue([tcollector.parse_line('foo 1 1')])
+            sender.send_data()
+            self.assertEqual([], sender.sendq)
+            self.assertEqual(None, sender.tsd)
+            self.assertEqual(['foo 1 1 host=x'], spool.read(10))
+        finally:
+            tsd.close()
+            shutil.rmtree(tmpdir)
+
+    def test_tsd_errors(self):
+        """The TSD answers every line with an error, and blocks when we
+           don't read them."""
+        tsd, peer = socket.socketpair()
+        received = []
+        def serve():
+            pending = ''
+            while True:
+                data = peer.recv(65536)
+                if not data:
+                    break
+                lines = (pending + data).split('\n')
+                pending = lines.pop()
+                received.extend(lines)
+                peer.sendall('put: illegal argument: bad line\n' * len(lines))
+        thread = threading.Thread(target=serve)
+        thread.start()
+        try:
+            sender = tcollector.SenderThread(None, False, [("localhost", 4242)],
+                                             False, {}, 0)
+            sender.tsd = tsd
+            tsd.settimeout(5)
+            lines = ['foo %d 1' % i for i in xrange(100000)]
+            self.assertTrue(sender.send_lines(lines))
+            tsd.shutdown(socket.SHUT_WR)
+            deadline = time.time() + 5
+            while sender.tsd_errors < len(lines) and time.time() < deadline:
+                time.sleep(0.01)
+                sender.read_responses()
+            self.assertEqual(len(lines), len(received))
+            self.assertEqual(len(lines), sender.tsd_errors)
+        finally:
+            tsd.close()
+            thread.join()
+            peer.close()
+
+
+    def test_partial_write(self):
+        """The TSD stops reading in the middle of a batch: only what it
+           didn't get is kept to be sent again."""
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        tsd = socket.create_connection(server.getsockname())
+        peer, _ = server.accept()
+        server.close()
+        try:
+            sender = tcollector.SenderThread(None, False, [("localhost", 4242)],
+                                             False, {}, 0)
+            sender.host, sender.port = "localhost", 4242
+            sender.tsd = tsd
+            tsd.settimeout(0.5)
+            lines = ['foo %d 1' % i for i in xrange(1000000)]
+            sender.sendq = list(lines)
+            sender.sendq_sources = [None] * len(lines)
+            sender.send_data()
+            self.assertEqual(None, sender.tsd)
+            self.assertEqual(len(sender.sendq), len(sender.sendq_sources))
+            received = ''
+            while True:
+                try:
+                    data = peer.recv(65536)
+                except socket.error:
+                    break  # The sender reset the connection.
+                if not data:
+                    break
+                received += data
+            received = [line[len('put '):]
+                        for line in received.split('\n')[:-1]]
+            self.assertTrue(received)
+            self.assertTrue(sender.sendq)
+            self.assertEqual(lines, received + sender.sendq)
+        finally:
+            tsd.close()
+            peer.close()
+
+    def test_probe(self):
+        """The TSD is probed without waiting for its answer, only once the
+           connection is idle."""
+        tsd, peer = socket.socketpair()
+        peer.setblocking(0)
+        try:
+            sender = tcollector.SenderThread(None, False, [("localhost", 4242)],
+                                             False, {}, 0)
+            sender.host, sender.port = "localhost", 4242
+            sender.tsd = tsd
+            tsd.settimeout(5)
+            sender.last_healthy = time.time()
+            self.assertTrue(sender.verify_conn())
+            self.assertRaises(socket.error, peer.recv, 4096)
+
+            sender.last_verify = sender.last_healthy = 0
+            self.assertTrue(sender.verify_conn())
+            self.assertEqual('version\n', peer.recv(4096))
+            self.assertNotEqual(None, sender.probe_sent)
+            peer.sendall('net.opentsdb.tools 2.0\n')
+            self.assertTrue(sender.verify_conn())
+            self.assertEqual(None, sender.probe_sent)
+            self.assertTrue(sender.last_healthy > 0)
+        finally:
+            tsd.close()
+            peer.close()
+
+    def test_unanswered_probe(self):
+        tsd, peer = socket.socketpair()
+        try:
+            sender = tcollector.SenderThread(None, False, [("localhost", 4242)],
+                                             False, {}, 0)
+            sender.host, sender.port = "localhost", 4242
+            sender.tsd = tsd
+            sender.last_verify = time.time()
+            sender.probe_sent = time.time() - tcollector.CONNECT_TIMEOUT - 1
+            self.assertFalse(sender.verify_conn())
+            self.assertEqual(None, sender.tsd)
+            self.assertTrue(sender.health[("localhost", 4242)].failures)
+        finally:
+            peer.close()
+
+class SenderEndToEndTests(unittest.TestCase):
+    """Sends data points through a SenderThread to a fake TSD."""
+
+    class Reader(object):
+        def __init__(self):
+            self.readerq = tcollector.ReaderQueue(tcollector.MAX_READQ_SIZE)
+
+    def setUp(self):
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.received = []  # (time, line) of every line the TSD got.
+        self.tsd = threading.Thread(target=self.serve)
+        self.tsd.start()
+        self.reader = self.Reader()
+        self.sender = tcollector.SenderThread(
+            self.reader, False, [self.server.getsockname()], False, {}, 0,
+            batch_delay=0.1)
+        self.sender.tsd = socket.create_connection(self.server.getsockname())
+        self.sender.last_verify = time.time()
+        self.sender.start()
+
+    def tearDown(self):
+        tcollector.ALIVE = False
+        self.reader.readerq.nput(tcollector.parse_line('wake.up 1 1'))
+        self.sender.join()
+        tcollector.ALIVE = True
+        self.sender.tsd.close()
+        self.tsd.join()
+        self.server.close()
+
+    def serve(self):
+        conn, _ = self.server.accept()
+        pending = ''
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            now = time.time()
+            lines = (pending + data).split('\n')
+            pending = lines.pop()
+            self.received.extend((now, line) for line in lines)
+        conn.close()
+
+    def wait_for(self, count, timeout):
+        deadline = time.time() + timeout
+        while len(self.received) < count and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(count, len(self.received))
+
+    def test_freshness(self):
+        sent = []
+        for i in xrange(10):
+            sent.append(time.time())
+            self.reader.readerq.nput(tcollector.parse_line('foo %d 1' % i))
+            time.sleep(0.05)
+        self.wait_for(10, 5)
+        delays = sorted(t - sent[i] for i, (t, _) in
+                        enumerate(self.received))
+        # It used to take 5 seconds at best.
+        self.assertTrue(delays[5] < 1, delays)
+
+    def test_throughput(self):
+        dps = [tcollector.parse_line('foo %d 1 a=b' % i)
+               for i in xrange(100000)]
+        start = time.time()
+        for i in xrange(0, len(dps), 1000):
+            while self.reader.readerq.qsize() > 50000:
+                time.sleep(0.001)
+            self.reader.readerq.nput_batch(dps[i:i + 1000])
+        self.wait_for(len(dps), 20)
+        rate = len(dps) / (self.received[-1][0] - start)
+        # It used to be capped at 2000 data points per second.
+        self.assertTrue(rate > 10000, rate)
+        self.assertEqual('put foo 99999 1 a=b', self.received[-1][1])
+
+
+class HTTPSenderTests(unittest.TestCase):
+    """Sends data points to a local stand-in for the TSD's HTTP API."""
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            if self.headers.get('Content-Encoding') == 'gzip':
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            self.server.requests.append((self.client_address, self.path,
+                                         json.loads(body)))
+            status, reply = self.server.reply
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(reply)))
+            self.end_headers()
+            self.wfile.write(reply)
+
+        def log_message(self, *args):
+            pass
+
+    def setUp(self):
+        self.collectors = tcollector.COLLECTORS.copy()
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), self.Handler)
+        self.server.requests = []
+        self.server.reply = (200, '{"success":1,"failed":0,"errors":[]}')
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        address = self.server.server_address
+        self.sender = tcollector.SenderThread(None, False, [address], False,
+                                              {'host': 'x'}, 0, http=True,
+                                              http_compress=True)
+        self.sender.host, self.sender.port = address
+        self.sender.tsd = socket.create_connection(address)
+
+    def tearDown(self):
+        if self.sender.tsd is not None:
+            self.sender.tsd.close()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        tcollector.COLLECTORS.clear()
+        tcollector.COLLECTORS.update(self.collectors)
+
+    def test_format_json(self):
+        self.assertEqual({'metric': 'foo', 'timestamp': 1, 'value': '2.5',
+                          'tags': {'a': 'b', 'c': 'd'}},
+                         json.loads(tcollector.format_json('foo 1 2.5 a=b c=d')))
+        self.assertEqual({'metric': 'foo', 'timestamp': 1, 'value': '2',
+                          'tags': {'a': '"b\\'}},
+                         json.loads(tcollector.format_json('foo 1 2 a="b\\')))
+        self.assertEqual({'metric': 'foo', 'timestamp': 1, 'value': '2\x01',
+                          'tags': {'a': u'\xe9'}},
+                         json.loads(tcollector.format_json('foo 1 2\x01 a=\xc3\xa9')))
+        self.assertEqual(None, tcollector.format_json('foo 1 2\xff'))
+
+    def test_put(self):
+        for i in xrange(2):
+            self.sender.enqueue([tcollector.parse_line('foo %d 1' % i)])
+            self.sender.send_data()
+            self.assertEqual([], self.sender.sendq)
+        self.assertEqual(2, len(self.server.requests))
+        (client1, path, dps), (client2, _, _) = self.server.requests
+        self.assertEqual('/api/put?details', path)
+        self.assertEqual([{'metric': 'foo', 'timestamp': 0, 'value': '1',
+                           'tags': {'host': 'x'}}], dps)
+        self.assertEqual(client1, client2)  # Kept alive.
+
+    def test_rejected(self):
+        col = tcollector.Collector('c1', 0, 'c1')
+        tcollector.COLLECTORS['c1'] = col
+        self.server.reply = (400, json.dumps({
+            'success': 1, 'failed': 1, 'errors': [{
+                'datapoint': {'metric': 'bar', 'timestamp': 2, 'value': 'x',
+                              'tags': {'host': 'x'}},
+                'error': 'Unable to parse value to a number'}]}))
+        self.sender.enqueue([tcollector.Datapoint('foo', 1, '1', '', 'c1'),
+                             tcollector.Datapoint('bar', 2, 'x', '', 'c1')])
+        self.sender.send_data()
+        self.assertEqual([], self.sender.sendq)
+        self.assertEqual(1, self.sender.lines_rejected)
+        self.assertEqual(1, col.lines_rejected)
+
+    def test_invalid_utf8(self):
+        col = tcollector.Collector('c1', 0, 'c1')
+        tcollector.COLLECTORS['c1'] = col
+        self.sender.enqueue([tcollector.Datapoint('foo', 1, '1', '', 'c1'),
+                             tcollector.Datapoint('bar', 2, '\xff', '', 'c1')])
+        self.sender.send_data()
+        self.assertEqual([], self.sender.sendq)
+        self.assertEqual([{'metric': 'foo', 'timestamp': 1, 'value': '1',
+                           'tags': {'host': 'x'}}],
+                         self.server.requests[0][2])
+        self.assertEqual(1, self.sender.lines_rejected)
+        self.assertEqual(1, col.lines_rejected)
+
+    def test_rejected_request(self):
+        self.server.reply = (400, json.dumps({'error': {
+            'code': 400, 'message': 'Unable to parse the given JSON'}}))
+        self.sender.enqueue([tcollector.parse_line('foo 1 1')])
+        self.sender.send_data()
+        self.assertEqual(['foo 1 1 host=x'], self.sender.sendq)
+
+    def test_server_error(self):
+        self.server.reply = (500, 'oops')
+        self.sender.enqueue([tcollector.parse_line('foo 1 1')])
+        self.sender.send_data()
+        self.assertEqual(['foo 1 1 host=x'], self.sender.sendq)
+        self.assertEqual(None, self.sender.tsd)
+
+
+class ConnectRaceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.listeners = []
+
+    def tearDown(self):
+        for sock in self.listeners:
+            sock.close()
+
+    def listener(self, backlog=5):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(backlog)
+        self.listeners.append(sock)
+        return sock.getsockname()
+
+    def black_hole(self):
+        """Returns an address connections to which hang."""
+        address = self.listener(0)
+        filler = socket.socket()
+        filler.connect(address)
+        self.listeners.append(filler)
+        return address
+
+    def refused(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        address = sock.getsockname()
+        sock.close()
+        return address
+
+    def candidate(self, key, address):
+        return (key, socket.AF_INET, socket.SOCK_STREAM, 0, address)
+
+    def test_refused(self):
+        (key, sock, _), errors = tcollector.connect_race(
+            [self.candidate('a', self.refused()),
+             self.candidate('b', self.listener())], 5)
+        sock.close()
+        self.assertEqual('b', key)
+        self.assertEqual(['a'], errors.keys())
+
+    def test_black_hole(self):
+        start = time.time()
+        (key, sock, _), errors = tcollector.connect_race(
+            [self.candidate('a', self.black_hole()),
+             self.candidate('b', self.listener())], 5, 0.1)
+        sock.close()
+        self.assertEqual('b', key)
+        self.assertEqual({}, errors)
+        self.assertTrue(time.time() - start < 1)
+
+    def test_timeout(self):
+        start = time.time()
+        winner, errors = tcollector.connect_race(
+            [self.candidate('a', self.black_hole())], 0.2)
+        self.assertEqual(None, winner)
+        self.assertTrue(time.time() - start < 1)
+
+
+    def test_unresolvable_host(self):
+        good = self.listener()
+        bad = ('no-such-host.invalid', 4242)
+
+        class DNS(object):
+            def resolve(self, hostport):
+                if hostport == bad:
+                    return []
+                return [(socket.AF_INET, socket.SOCK_STREAM, 0, hostport)]
+
+        sender = tcollector.SenderThread(None, False, [good, bad], False, {},
+                                         0, dns=DNS())
+        for _ in xrange(2):  # Whichever one gets picked first.
+            sender.connect()
+            self.assertEqual(good, (sender.host, sender.port))
+            self.assertNotEqual(None, sender.tsd)
+            sender.tsd.close()
+            sender.tsd = None
+        self.assertTrue(sender.health[bad].failures)
+        self.assertFalse(sender.health[good].failures)
+
+class StandbyTests(unittest.TestCase):
+    """Fails over between two fake TSDs that answer `version'."""
+
+    def setUp(self):
+        self.servers = {}  # address -> (listener, connections)
+        self.killed = []
+        self.threads = []
+        for _ in xrange(2):
+            server = socket.socket()
+            server.bind(('127.0.0.1', 0))
+            server.listen(5)
+            self.servers[server.getsockname()] = (server, [])
+            thread = threading.Thread(target=self.accept, args=(server,))
+            thread.start()
+            self.threads.append(thread)
+        self.sender = tcollector.SenderThread(None, False, self.servers.keys(),
+                                              False, {}, 0, standby=True)
+
+    def tearDown(self):
+        for address in self.servers:
+            self.kill(address)
+        for thread in self.threads:
+            thread.join()
+        for sock in (self.sender.tsd, self.sender.standby
+                     and self.sender.standby[1]):
+            if sock:
+                sock.close()
+
+    def accept(self, server):
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.error:
+                return
+            self.servers[server.getsockname()][1].append(conn)
+            thread = threading.Thread(target=self.serve, args=(conn,))
+            thread.start()
+            self.threads.append(thread)
+
+    def serve(self, conn):
+        while True:
+            try:
+                data = conn.recv(65536)
+            except socket.error:
+                return
+            if not data:
+                return
+            if 'version' in data:
+                try:
+                    conn.sendall('net.opentsdb.tools 2.0\n')
+                except socket.error:  # kill() closed it under our feet.
+                    return
+
+    def kill(self, address):
+        """Stops a fake TSD."""
+        server, conns = self.servers[address]
+        if server in self.killed:
+            return
+        self.killed.append(server)
+        server.shutdown(socket.SHUT_RDWR)
+        server.close()
+        for conn in conns:
+            conn.shutdown(socket.SHUT_RDWR)
+            conn.close()
+
+    def test_failover(self):
+        self.sender.maintain_conn()
+        primary = (self.sender.host, self.sender.port)
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            self.sender.maintain_standby()
+            if self.sender.standby and self.sender.standby[2] is None:
+                break
+            time.sleep(0.01)
+        standby = self.sender.standby[0]
+        self.assertNotEqual(primary, standby)
+
+        self.kill(primary)
+        start = time.time()
+        self.assertFalse(self.sender.send_lines(['foo 1 1']))
+        self.sender.maintain_conn()
+        self.assertEqual(standby, (self.sender.host, self.sender.port))
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertTrue(self.sender.send_lines(['foo 1 1']))
+
+
+class DNSCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.getaddrinfo = socket.getaddrinfo
+        socket.getaddrinfo = self.fake_getaddrinfo
+        self.answers = []  # What to answer, an exception or IP addresses.
+        self.queries = 0
+        self.unblock = threading.Event()
+        self.unblock.set()
+
+    def tearDown(self):
+        socket.getaddrinfo = self.getaddrinfo
+
+    def fake_getaddrinfo(self, host, port, family, socktype, proto):
+        self.queries += 1
+        self.unblock.wait()
+        answer = self.answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return [(socket.AF_INET, socktype, 6, '', (ip, port))
+                for ip in answer]
+
+    def ips(self, addresses):
+        return sorted(address[3][0] for address in addresses)
+
+    def wait_refresh(self, dns):
+        deadline = time.time() + 5
+        while dns.refreshing and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_cached(self):
+        dns = tcollector.DNSCache(60)
+        self.answers = [['10.0.0.1', '10.0.0.2']]
+        for _ in xrange(3):
+            addresses = dns.resolve(('tsd', 4242))
+            self.assertEqual(['10.0.0.1', '10.0.0.2'], self.ips(addresses))
+        self.assertEqual(1, self.queries)
+        self.assertEqual((3, 1), (dns.lookups, dns.misses))
+
+    def test_no_cache(self):
+        dns = tcollector.DNSCache(0)
+        self.answers = [['10.0.0.1'], ['10.0.0.2']]
+        self.assertEqual(['10.0.0.1'], self.ips(dns.resolve(('tsd', 4242))))
+        self.assertEqual(['10.0.0.2'], self.ips(dns.resolve(('tsd', 4242))))
+
+    def test_refresh_in_background(self):
+        dns = tcollector.DNSCache(60)
+        self.answers = [['10.0.0.1'], ['10.0.0.2']]
+        dns.resolve(('tsd', 4242))
+        dns.entries[('tsd', 4242)] = (dns.entries[('tsd', 4242)][0], 0)
+        # The DNS hangs, we don't.
+        self.unblock.clear()
+        start = time.time()
+        self.assertEqual(['10.0.0.1'], self.ips(dns.resolve(('tsd', 4242))))
+        self.assertTrue(time.time() - start < 0.5)
+        self.unblock.set()
+        self.wait_refresh(dns)
+        self.assertEqual(['10.0.0.2'], self.ips(dns.resolve(('tsd', 4242))))
+        self.assertEqual(2, self.queries)
+
+    def test_refresh_failure_keeps_stale_answer(self):
+        dns = tcollector.DNSCache(60, 10)
+        self.answers = [['10.0.0.1'],
+                        socket.gaierror(socket.EAI_AGAIN, 'try again')]
+        dns.resolve(('tsd', 4242))
+        dns.entries[('tsd', 4242)] = (dns.entries[('tsd', 4242)][0], 0)
+        dns.resolve(('tsd', 4242))
+        self.wait_refresh(dns)
+        addresses, expiry = dns.entries[('tsd', 4242)]
+        self.assertEqual(['10.0.0.1'], self.ips(addresses))
+        self.assertTrue(expiry < time.time() + 11)
+
+    def test_negative(self):
+        dns = tcollector.DNSCache(60, 10)
+        self.answers = [socket.gaierror(socket.EAI_NONAME, 'unknown')]
+        self.assertEqual([], dns.resolve(('tsd', 4242)))
+        self.assertEqual([], dns.resolve(('tsd', 4242)))
+        self.assertEqual(1, self.queries)
+
+
+class HashRingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.nodes = [('tsd%d' % i, 4242) for i in xrange(4)]
+        self.ring = tcollector.HashRing(self.nodes)
+        self.keys = ['foo.%d host=web%d' % (i, i % 7) for i in xrange(4000)]
+
+    def test_spread(self):
+        counts = {}
+        for key in self.keys:
+            node = self.ring.lookup(key)
+            counts[node] = counts.get(node, 0) + 1
+        self.assertEqual(sorted(self.nodes), sorted(counts))
+        for count in counts.itervalues():
+            self.assertTrue(500 < count < 1500, counts)
+
+    def test_only_the_keys_of_a_missing_node_move(self):
+        healthy = set(self.nodes[1:])
+        for key in self.keys:
+            node = self.ring.lookup(key)
+            if node == self.nodes[0]:
+                self.assertIn(self.ring.lookup(key, healthy), healthy)
+            else:
+                self.assertEqual(node, self.ring.lookup(key, healthy))
+
+    def test_none_healthy(self):
+        self.assertEqual(self.ring.lookup('foo'),
+                         self.ring.lookup('foo', set()))
+
+
+class ShardRouterTests(unittest.TestCase):
+    """Sends data points to several fake TSDs at once."""
+
+    class Reader(object):
+        def __init__(self):
+            self.readerq = tcollector.ReaderQueue(tcollector.MAX_READQ_SIZE)
+            self.lines_collected = 0
+            self.lines_dropped = 0
+            self.pause_time = 0.0
+
+    def setUp(self):
+        self.reader = self.Reader()
+        self.servers = []
+        self.received = {}  # address -> lines the fake TSD got
+        self.threads = []
+        self.senders = []
+        for _ in xrange(3):
+            server = socket.socket()
+            server.bind(('127.0.0.1', 0))
+            server.listen(1)
+            address = server.getsockname()
+            self.servers.append(server)
+            self.received[address] = []
+            self.senders.append(tcollector.SenderThread(
+                self.reader, False, [address], False, {}, 0, batch_delay=0.05,
+                queue=tcollector.ReaderQueue(tcollector.MAX_READQ_SIZE)))
+        self.router = tcollector.ShardRouter(self.reader, self.senders)
+
+    def tearDown(self):
+        tcollector.ALIVE = False
+        for sender in self.senders:
+            if sender.isAlive():
+                sender.readerq.nput(tcollector.parse_line('wake.up 1 1'))
+                sender.join()
+            if sender.tsd is not None:
+                sender.tsd.close()
+        if self.router.isAlive():
+            self.router.join()
+        tcollector.ALIVE = True
+        for thread in self.threads:
+            thread.join()
+        for server in self.servers:
+            server.close()
+
+    def serve(self, server):
+        conn, _ = server.accept()
+        received = self.received[server.getsockname()]
+        pending = ''
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            lines = (pending + data).split('\n')
+            pending = lines.pop()
+            received.extend(lines)
+        conn.close()
+
+    def connect(self):
+        for server, sender in zip(self.servers, self.senders):
+            thread = threading.Thread(target=self.serve, args=(server,))
+            thread.start()
+            self.threads.append(thread)
+            sender.host, sender.port = sender.hosts[0]
+            sender.tsd = socket.create_connection(sender.hosts[0])
+            sender.last_verify = time.time()
+
+    def dps(self, timestamp):
+        return [tcollector.parse_line('foo.%d %d 1 host=web%d'
+                                      % (i, timestamp, i % 5))
+                for i in xrange(300)]
+
+    def routes(self):
+        """Returns which TSD each time series got routed to."""
+        routes = {}
+        for sender in self.senders:
+            for dp in sender.readerq.get_batch(0):
+                routes[(dp.metric, dp.tags)] = sender.hosts[0]
+        return routes
+
+    def test_route(self):
+        self.connect()
+        self.router.route(self.dps(1))
+        routes = self.routes()
+        self.assertEqual(300, len(routes))
+        self.assertEqual(3, len(set(routes.values())))
+        self.router.route(self.dps(2))
+        self.assertEqual(routes, self.routes())
+
+        # Only the time series of the TSD we lost move.
+        lost = self.senders[0]
+        lost.blacklist_connection()
+        lost.readerq.nput_batch(self.dps(3)[:10])
+        self.router.reroute(lost)
+        self.router.route(self.dps(3))
+        new_routes = self.routes()
+        for series, hostport in routes.iteritems():
+            if hostport == lost.hosts[0]:
+                self.assertNotEqual(hostport, new_routes[series])
+            else:
+                self.assertEqual(hostport, new_routes[series])
+
+    def test_dropped(self):
+        self.senders[0].readerq = tcollector.ReaderQueue(10)
+        self.router.route(self.dps(1))
+        routed = sum(sender.readerq.qsize() for sender in self.senders)
+        self.assertEqual(300 - routed, self.router.lines_dropped)
+        self.assertTrue(self.router.lines_dropped > 0)
+        self.assertEqual(0, self.reader.lines_dropped)
+
+    def test_stats(self):
+        for i, sender in enumerate(self.senders):
+            sender.shared_stats = i == 0
+            sender.stats_tags = 'tsd=127.0.0.1-%d' % sender.hosts[0][1]
+            sender.tsd_errors = i
+            sender.report_stats()
+        for i, sender in enumerate(self.senders):
+            errors = [line.split() for line in sender.sendq
+                      if line.startswith('tcollector.sender.tsd_errors ')]
+            self.assertEqual(1, len(errors))
+            self.assertEqual([str(i), sender.stats_tags], errors[0][2:])
+        # The stats shared by the senders are only reported once.
+        collected = [line for sender in self.senders for line in sender.sendq
+                     if line.startswith('tcollector.reader.lines_collected ')]
+        self.assertEqual(1, len(collected))
+        self.assertIn(collected[0], self.senders[0].sendq)
+
+    def test_drain_at_exit(self):
+        self.reader.readerq.nput_batch(self.dps(1))
+        tcollector.ALIVE = False
+        self.router.start()
+        self.router.join()
+        self.assertEqual(0, self.reader.readerq.qsize())
+        self.assertEqual(300, len(self.routes()))
+
+    def test_send(self):
+        self.connect()
+        self.router.start()
+        for sender in self.senders:
+            sender.start()
+        for timestamp in xrange(1, 4):
+            self.reader.readerq.nput_batch(self.dps(timestamp))
+        deadline = time.time() + 5
+        while (sum(len(lines) for lines in self.received.itervalues()) < 900
+               and time.time() < deadline):
+            time.sleep(0.01)
+        series = {}
+        for address, lines in self.received.iteritems():
+            self.assertTrue(lines)
+            for line in lines:
+                metric = line.split()[1]
+                self.assertEqual(address, series.setdefault(metric, address))
+        self.assertEqual(300, len(series))
+        self.assertEqual(900, sum(len(lines)
+                                  for lines in self.received.itervalues()))
+
+
 class UDPCollectorTests(unittest.TestCase):
 
     def setUp(self):